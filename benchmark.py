@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark of `ConfluencePageCopier.copy` against local fake Confluence server.
+
+Fake server keeps everything in memory and implements only REST endpoints used by the copier. Tree shape, body and
+attachment sizes, pagination limit and latency of every request are configurable. Benchmark reports pages/sec,
+requests per page, bytes moved and peak RSS, and fails if any of them is worse than stored baseline.
+"""
+import re
+import cgi
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+from copier import ConfluencePageCopier
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+
+class FakeConfluence(object):
+    """
+    In-memory Confluence with HTTP server implementing REST endpoints used by the copier.
+    Source space `SRC` is filled with tree of `depth` levels, each page has `fan_out` children, destination space
+    `DST` is empty.
+    """
+    SRC_SPACE = u'SRC'
+    DST_SPACE = u'DST'
+    CQL_RE = re.compile(r'space = "(?P<space>[^"]*)" and title ~ "(?P<title>[^"]*)"')
+
+    def __init__(self, depth=3, fan_out=3, body_size=2048, attachments_per_page=0, attachment_size=0,
+                 labels_per_page=1, page_limit=25, latency=0.0):
+        self.page_limit = page_limit
+        self.latency = latency
+
+        self.pages = dict()
+        self.attachments = dict()
+        self._children = dict()
+        self._next_id = 1000
+        self._lock = threading.RLock()
+
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.root_id = self._add_tree(None, depth, fan_out, body_size, attachments_per_page, attachment_size,
+                                      labels_per_page)
+        self._server = None
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return unicode(self._next_id)
+
+    def _add_page(self, space_key, title, body, parent_id=None):
+        page = {
+            'id': self._new_id(),
+            'type': 'page',
+            'title': title,
+            'space': space_key,
+            'parent_id': parent_id,
+            'version': 1,
+            'body': body,
+            'labels': list(),
+            'attachments': list(),
+        }
+        self.pages[page['id']] = page
+        self._children.setdefault(parent_id, list()).append(page['id'])
+        return page
+
+    def _move_page(self, page, parent_id):
+        self._children[page['parent_id']].remove(page['id'])
+        self._children.setdefault(parent_id, list()).append(page['id'])
+        page['parent_id'] = parent_id
+
+    def _add_attachment(self, page, title, size, media_type=u'application/octet-stream', comment=u''):
+        attachment = {
+            'id': self._new_id(),
+            'title': title,
+            'page_id': page['id'],
+            'size': size,
+            'media_type': media_type,
+            'comment': comment,
+            'version': 1,
+            'when': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+        }
+        self.attachments[attachment['id']] = attachment
+        page['attachments'].append(attachment['id'])
+        return attachment
+
+    def _add_tree(self, parent_id, depth, fan_out, body_size, attachments_per_page, attachment_size,
+                  labels_per_page, path=u'0'):
+        page = self._add_page(self.SRC_SPACE, u'Page {}'.format(path), u'<p>{}</p>'.format(u'x' * body_size),
+                              parent_id)
+        page['labels'] = [{'prefix': u'global', 'name': u'label-{}'.format(i)} for i in range(labels_per_page)]
+        for i in range(attachments_per_page):
+            self._add_attachment(page, u'file-{}.bin'.format(i), attachment_size)
+        if depth > 0:
+            for i in range(fan_out):
+                self._add_tree(page['id'], depth - 1, fan_out, body_size, attachments_per_page, attachment_size,
+                               labels_per_page, path=u'{}.{}'.format(path, i))
+        return page['id']
+
+    def children(self, page_id):
+        return [self.pages[child_id] for child_id in self._children.get(page_id, [])]
+
+    def ancestors(self, page):
+        result = list()
+        while page['parent_id'] is not None:
+            page = self.pages[page['parent_id']]
+            result.insert(0, page)
+        return result
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:{}/'.format(self._server.server_port)
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _FakeConfluenceHandler)
+        self._server.confluence = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, bytes_in, bytes_out):
+        with self._lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    # representations
+
+    def paginate(self, items, params, base_path):
+        start = int(params.get('start', 0))
+        limit = min(int(params.get('limit', self.page_limit)), self.page_limit)
+        results = items[start:start + limit]
+        response = {'results': results, 'start': start, 'limit': limit, 'size': len(results), '_links': {}}
+        if start + limit < len(items):
+            response['_links']['next'] = '{path}?start={start}&limit={limit}'.format(
+                path=base_path, start=start + limit, limit=limit
+            )
+        return response
+
+    def page_repr(self, page, expand):
+        expand = set(expand.split(',')) if expand else set()
+        result = {'id': page['id'], 'type': 'page', 'title': page['title'], 'status': 'current'}
+        if 'space' in expand:
+            result['space'] = {'key': page['space'], 'name': page['space']}
+        if 'version' in expand:
+            result['version'] = {'number': page['version']}
+        if 'body.storage' in expand:
+            result['body'] = {'storage': {'value': page['body'], 'representation': 'storage'}}
+        if 'ancestors' in expand:
+            result['ancestors'] = [{'id': a['id'], 'type': 'page', 'title': a['title']} for a in self.ancestors(page)]
+        if 'metadata.labels' in expand:
+            result['metadata'] = {'labels': self.paginate(page['labels'], {}, '')}
+        children = dict()
+        if any(e.startswith('children.page') for e in expand):
+            children['page'] = self.paginate(
+                [self.page_repr(c, 'version') for c in self.children(page['id'])], {}, ''
+            )
+        if any(e.startswith('children.attachment') for e in expand):
+            children['attachment'] = self.paginate(
+                [self.attachment_repr(self.attachments[a]) for a in page['attachments']], {}, ''
+            )
+        if children:
+            result['children'] = children
+        return result
+
+    @staticmethod
+    def attachment_repr(attachment):
+        return {
+            'id': attachment['id'],
+            'type': 'attachment',
+            'title': attachment['title'],
+            'version': {'number': attachment['version'], 'when': attachment['when']},
+            'metadata': {'mediaType': attachment['media_type'], 'comment': attachment['comment']},
+            'extensions': {'mediaType': attachment['media_type'], 'fileSize': attachment['size']},
+            '_links': {'download': u'/download/attachments/{page}/{id}'.format(
+                page=attachment['page_id'], id=attachment['id']
+            )},
+        }
+
+    def find_by_title(self, space_key, title):
+        return [p for p in self.pages.values() if p['space'] == space_key and p['title'] == title]
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _FakeConfluenceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one packet, otherwise delayed ACK adds ~40ms to every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def confluence(self):
+        return self.server.confluence
+
+    def _respond(self, data, status=200, raw=False):
+        body = data if raw else json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream' if raw else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _handle(self, method):
+        if self.confluence.latency:
+            time.sleep(self.confluence.latency)
+
+        url = urlparse(self.path)
+        params = dict((k, v[0].decode('utf-8')) for k, v in parse_qs(url.query).items())
+        path = url.path.rstrip('/')
+        bytes_in = int(self.headers.get('Content-Length') or 0)
+
+        with self.confluence._lock:
+            for route, handler in self.ROUTES:
+                match = re.match(route, method + ' ' + path)
+                if match:
+                    result = handler(self, params, **match.groupdict())
+                    break
+            else:
+                result = ({'message': 'Not found'}, 404)
+
+        data, status = result if isinstance(result, tuple) else (result, 200)
+        bytes_out = self._respond(data, status, raw=isinstance(data, str))
+        self.confluence.count(bytes_in, bytes_out)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def _json_body(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def get_content(self, params):
+        pages = sorted(self.confluence.pages.values(), key=lambda p: int(p['id']))
+        if 'spaceKey' in params:
+            pages = [p for p in pages if p['space'] == params['spaceKey']]
+        if 'title' in params:
+            pages = [p for p in pages if p['title'] == params['title']]
+        return self.confluence.paginate(
+            [self.confluence.page_repr(p, params.get('expand')) for p in pages], params, '/rest/api/content'
+        )
+
+    def search_content(self, params):
+        match = FakeConfluence.CQL_RE.match(params.get('cql', ''))
+        pages = list()
+        if match:
+            from urllib import unquote_plus
+            title = unquote_plus(match.group('title').encode('utf-8')).decode('utf-8')
+            pages = [p for p in self.confluence.pages.values()
+                     if p['space'] == match.group('space') and title in p['title']]
+        return self.confluence.paginate(
+            [self.confluence.page_repr(p, None) for p in pages], params, '/rest/api/content/search'
+        )
+
+    def get_page(self, params, page_id):
+        if page_id not in self.confluence.pages:
+            return {'message': 'Not found'}, 404
+        return self.confluence.page_repr(self.confluence.pages[page_id], params.get('expand'))
+
+    def get_children(self, params, page_id):
+        return self.confluence.paginate(
+            [self.confluence.page_repr(c, params.get('expand')) for c in self.confluence.children(page_id)],
+            params, self.path.split('?')[0]
+        )
+
+    def get_attachments(self, params, page_id):
+        page = self.confluence.pages[page_id]
+        return self.confluence.paginate(
+            [self.confluence.attachment_repr(self.confluence.attachments[a]) for a in page['attachments']],
+            params, self.path.split('?')[0]
+        )
+
+    def get_labels(self, params, page_id):
+        return self.confluence.paginate(self.confluence.pages[page_id]['labels'], params, self.path.split('?')[0])
+
+    def download(self, params, page_id, attachment_id):
+        return b'a' * self.confluence.attachments[attachment_id]['size']
+
+    def create_page(self, params):
+        data = self._json_body()
+        if self.confluence.find_by_title(data['space']['key'], data['title']):
+            return {'message': 'Page already exists'}, 400
+        parent_id = data['ancestors'][-1]['id'] if data.get('ancestors') else None
+        page = self.confluence._add_page(data['space']['key'], data['title'], data['body']['storage']['value'],
+                                         parent_id)
+        return self.confluence.page_repr(page, 'space,version,ancestors')
+
+    def update_page(self, params, page_id):
+        data = self._json_body()
+        page = self.confluence.pages[page_id]
+        if data['version']['number'] != page['version'] + 1:
+            return {'message': 'Version must be incremented on update'}, 409
+        page['title'] = data['title']
+        page['body'] = data['body']['storage']['value']
+        self.confluence._move_page(page, data['ancestors'][-1]['id'] if data.get('ancestors') else None)
+        page['version'] = data['version']['number']
+        return self.confluence.page_repr(page, 'space,version,ancestors')
+
+    def add_labels(self, params, page_id):
+        page = self.confluence.pages[page_id]
+        for label in self._json_body():
+            if label not in page['labels']:
+                page['labels'].append(label)
+        return self.confluence.paginate(page['labels'], {}, '')
+
+    def _upload(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': self.headers['Content-Type'],
+            'CONTENT_LENGTH': self.headers['Content-Length'],
+        })
+        item = form['file']
+        item.file.seek(0, 2)
+        return item.filename.decode('utf-8'), item.file.tell(), item.type
+
+    def create_attachment(self, params, page_id):
+        title, size, media_type = self._upload()
+        attachment = self.confluence._add_attachment(self.confluence.pages[page_id], title, size, media_type)
+        return self.confluence.paginate([self.confluence.attachment_repr(attachment)], {}, '')
+
+    def update_attachment(self, params, page_id, attachment_id):
+        title, size, media_type = self._upload()
+        attachment = self.confluence.attachments[attachment_id]
+        attachment.update(size=size, media_type=media_type, version=attachment['version'] + 1,
+                          when=time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+        return self.confluence.attachment_repr(attachment)
+
+    ROUTES = [
+        (r'^GET /rest/api/content$', get_content),
+        (r'^GET /rest/api/content/search$', search_content),
+        (r'^GET /rest/api/content/(?P<page_id>\d+)$', get_page),
+        (r'^GET /rest/api/content/(?P<page_id>\d+)/child/page$', get_children),
+        (r'^GET /rest/api/content/(?P<page_id>\d+)/child/attachment$', get_attachments),
+        (r'^GET /rest/api/content/(?P<page_id>\d+)/label$', get_labels),
+        (r'^GET /download/attachments/(?P<page_id>\d+)/(?P<attachment_id>\d+)$', download),
+        (r'^POST /rest/api/content$', create_page),
+        (r'^PUT /rest/api/content/(?P<page_id>\d+)$', update_page),
+        (r'^POST /rest/api/content/(?P<page_id>\d+)/label$', add_labels),
+        (r'^POST /rest/api/content/(?P<page_id>\d+)/child/attachment$', create_attachment),
+        (r'^POST /rest/api/content/(?P<page_id>\d+)/child/attachment/(?P<attachment_id>\d+)/data$',
+         update_attachment),
+    ]
+
+
+def run(depth=3, fan_out=3, body_size=2048, attachments_per_page=1, attachment_size=64 * 1024, page_limit=25,
+        latency=0.0, workers=None, overwrite=False, **copier_kwargs):
+    """
+    Copy whole source tree of fresh fake Confluence into destination space.
+    :param overwrite: copy the tree once and change the source before measuring, so measured copy updates every
+                      existing page.
+    :return: dictionary of measured metrics.
+    """
+    confluence = FakeConfluence(
+        depth=depth, fan_out=fan_out, body_size=body_size, attachments_per_page=attachments_per_page,
+        attachment_size=attachment_size, page_limit=page_limit, latency=latency
+    ).start()
+    try:
+        source_pages = len(confluence.pages)
+        if overwrite:
+            _copy_tree(confluence, workers, copier_kwargs)
+            for page in confluence.pages.values():
+                if page['space'] == FakeConfluence.SRC_SPACE:
+                    page['body'] += u'<p>changed</p>'
+                    page['version'] += 1
+            confluence.requests = confluence.bytes_in = confluence.bytes_out = 0
+
+        started = time.time()
+        _copy_tree(confluence, workers, copier_kwargs, overwrite=overwrite)
+        elapsed = time.time() - started
+
+        copies = [p for p in confluence.pages.values() if p['space'] == FakeConfluence.DST_SPACE]
+        copied = len(copies)
+        if copied != source_pages:
+            raise AssertionError('Copied {} page(s) out of {}'.format(copied, source_pages))
+        if overwrite and any(p['version'] == 1 for p in copies):
+            raise AssertionError('Overwritten {} page(s) out of {}'.format(
+                len([p for p in copies if p['version'] > 1]), source_pages
+            ))
+    finally:
+        confluence.stop()
+
+    return {
+        'pages': copied,
+        'seconds': round(elapsed, 3),
+        'pages_per_sec': round(copied / elapsed, 2),
+        'requests_per_page': round(float(confluence.requests) / copied, 2),
+        'bytes_moved': confluence.bytes_in + confluence.bytes_out,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _copy_tree(confluence, workers, copier_kwargs, overwrite=False):
+    copier = ConfluencePageCopier(username='admin', password='admin', uri_base=confluence.uri, **copier_kwargs)
+    try:
+        copier.copy(
+            src={'content_id': confluence.root_id},
+            dst_space_key=FakeConfluence.DST_SPACE,
+            dst_title_template=ConfluencePageCopier.TITLE_FIELD,
+            overwrite=overwrite,
+            workers=workers
+        )
+    finally:
+        if copier._client.session:
+            copier._client.session.close()
+
+
+# metric -> True if bigger value is better
+METRICS = {
+    'pages_per_sec': True,
+    'requests_per_page': False,
+    'bytes_moved': False,
+    'peak_rss_kb': False,
+}
+
+
+def compare(result, baseline, tolerance):
+    """
+    :return: list of messages about metrics, which are worse than baseline by more than `tolerance` fraction.
+    """
+    regressions = list()
+    for metric, bigger_is_better in sorted(METRICS.items()):
+        if metric not in baseline:
+            continue
+        expected = baseline[metric]
+        if bigger_is_better:
+            failed = result[metric] < expected * (1 - tolerance)
+        else:
+            failed = result[metric] > expected * (1 + tolerance)
+        if failed:
+            regressions.append('{metric}: {value} vs baseline {expected}'.format(
+                metric=metric, value=result[metric], expected=expected
+            ))
+    return regressions
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='Benchmark of page copying against local fake Confluence.')
+    parser.add_argument('--depth', type=int, default=3, help='Depth of source page tree.')
+    parser.add_argument('--fan-out', type=int, default=3, help='Number of children of every page.')
+    parser.add_argument('--body-size', type=int, default=2048, help='Size of page body in characters.')
+    parser.add_argument('--attachments-per-page', type=int, default=1, help='Number of attachments of every page.')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='Size of every attachment in bytes.')
+    parser.add_argument('--page-limit', type=int, default=25, help='Maximal number of results per page.')
+    parser.add_argument('--latency', type=float, default=0.005, help='Latency of every request in seconds.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of copier workers.')
+    parser.add_argument('--overwrite', action="store_true", default=False,
+                        help='Measure copy overwriting pages of previous copy instead of creating new ones.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='File with baseline metrics.')
+    parser.add_argument('--scenario', default='default',
+                        help='Name of the scenario, baselines are stored separately for every scenario.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fraction by which metric could be worse than baseline.')
+    parser.add_argument('--update-baseline', action="store_true", default=False,
+                        help='Store results as new baseline of the scenario instead of comparing with it.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = init_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    result = run(
+        depth=args.depth,
+        fan_out=args.fan_out,
+        body_size=args.body_size,
+        attachments_per_page=args.attachments_per_page,
+        attachment_size=args.attachment_size,
+        page_limit=args.page_limit,
+        latency=args.latency,
+        workers=args.workers,
+        overwrite=args.overwrite
+    )
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = dict()
+
+    if args.update_baseline:
+        baselines[args.scenario] = result
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    elif args.scenario in baselines:
+        regressions = compare(result, baselines[args.scenario], args.tolerance)
+        if regressions:
+            print('Regressions of scenario {}:\n  {}'.format(args.scenario, '\n  '.join(regressions)))
+            sys.exit(1)
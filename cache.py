@@ -0,0 +1,198 @@
+# coding=utf-8
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class _SizedLRU(object):
+    """
+    LRU mapping limited by total size of values instead of their count. Not thread safe.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        value, size = self._items.pop(key)
+        self._items[key] = (value, size)
+        return value
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def put(self, key, value, size):
+        self.pop(key)
+        if size > self.max_size:
+            return
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key):
+        if key in self._items:
+            value, size = self._items.pop(key)
+            self.size -= size
+            return value
+        return None
+
+
+class PageBodyStore(object):
+    """
+    Persistent store of page bodies in SQLite database, keyed by page id and version. Repeated run needs to fetch
+    only metadata of the page to check it's version, body of unchanged page is taken from the store.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bodies (
+            page_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            PRIMARY KEY (page_id, version)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(self.SCHEMA)
+
+    def get(self, page_id, version):
+        """
+        :return: body of given version of the page or `None` if it's not stored.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body FROM bodies WHERE page_id = ? AND version = ?', (unicode(page_id), version)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, page_id, version, body):
+        with self._lock, self._db:
+            # older versions are never requested again
+            self._db.execute('DELETE FROM bodies WHERE page_id = ? AND version < ?', (unicode(page_id), version))
+            self._db.execute(
+                'INSERT OR REPLACE INTO bodies (page_id, version, body) VALUES (?, ?, ?)',
+                (unicode(page_id), version, body)
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class PageCache(object):
+    """
+    Cache of page lookups with two tiers, each limited by size in bytes: metadata tier keeps lookup results without
+    bodies (including "not found" results) and body tier keeps bodies by page id and version. Page is served from
+    the cache only if both its metadata and body of the same version are present, so eviction of big bodies
+    doesn't leave stale entries.
+    """
+    DEFAULT_SIZE = 64 * 1024 * 1024
+    DEFAULT_METADATA_SIZE = 16 * 1024 * 1024
+    # approximate size of "not found" entry
+    EMPTY_ENTRY_SIZE = 64
+
+    def __init__(self, max_size=None, max_metadata_size=None, store=None):
+        """
+        :param max_size: maximal total size of cached bodies in bytes.
+        :param max_metadata_size: maximal total size of cached metadata in bytes.
+        :param store: optional `PageBodyStore`, bodies of pages put with `persist` flag are saved there as well.
+        """
+        self._metadata = _SizedLRU(self.DEFAULT_METADATA_SIZE if max_metadata_size is None else max_metadata_size)
+        self._bodies = _SizedLRU(self.DEFAULT_SIZE if max_size is None else max_size)
+        self._store = store
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _split(page):
+        body = page.get('body', {}).get('storage', {}).get('value')
+        if body is None:
+            return page, None
+        metadata = dict(page)
+        metadata.pop('body')
+        return metadata, body
+
+    @staticmethod
+    def _body_size(body):
+        # size of UTF-8 encoded body, non-ASCII characters take up to 4 bytes
+        return len(body.encode('utf-8')) if isinstance(body, unicode) else len(body)
+
+    @staticmethod
+    def _join(metadata, body):
+        page = dict(metadata)
+        page['body'] = {'storage': {'value': body, 'representation': 'storage'}}
+        return page
+
+    def get(self, key):
+        """
+        :return: tuple of flag whether lookup result is cached and the result itself (page or `None` if page
+                 wasn't found).
+        """
+        with self._lock:
+            if key not in self._metadata:
+                return False, None
+            metadata = self._metadata.get(key)
+            if metadata is None:
+                return True, None
+            if not metadata.get('has_body'):
+                return True, metadata['page']
+
+            page = metadata['page']
+            body = self._bodies.get((unicode(page['id']), page['version']['number']))
+            if body is None:
+                # body was evicted, metadata alone is useless
+                self._metadata.pop(key)
+                return False, None
+            return True, self._join(page, body)
+
+    def put(self, key, page, persist=False):
+        """
+        Cache result of lookup by `key`, `None` page means page wasn't found.
+        :param persist: save body of the page to persistent store too.
+        """
+        if page is None:
+            with self._lock:
+                self._metadata.put(key, None, self.EMPTY_ENTRY_SIZE)
+            return
+
+        metadata, body = self._split(page)
+        metadata_size = len(json.dumps(metadata))
+        with self._lock:
+            self._metadata.put(key, {'page': metadata, 'has_body': body is not None}, metadata_size)
+            if body is not None:
+                self._bodies.put((unicode(page['id']), page['version']['number']), body, self._body_size(body))
+
+        if persist and body is not None and self._store is not None:
+            self._store.put(page['id'], page['version']['number'], body)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._metadata.pop(key)
+
+    def get_body(self, page_id, version):
+        """
+        :return: body of given version of the page from memory or persistent store, `None` if it's unknown.
+        """
+        key = (unicode(page_id), version)
+        with self._lock:
+            body = self._bodies.get(key)
+        if body is None and self._store is not None:
+            body = self._store.get(page_id, version)
+            if body is not None:
+                with self._lock:
+                    self._bodies.put(key, body, self._body_size(body))
+        return body
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
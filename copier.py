@@ -1,12 +1,38 @@
 #!/usr/bin/env python
 # coding=utf-8
+import os
 import re
+import json
+import uuid
+import random
 import urllib
 import logging
+import hashlib
+import time
+import types
+import calendar
+import fnmatch
 import argparse
-
+import tempfile
+import threading
+from functools import partial
+from io import BytesIO
+from urlparse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from PythonConfluenceAPI import ConfluenceAPI
-from boltons.cacheutils import LRU, cachedmethod
+
+from cache import PageCache, PageBodyStore
+from journal import CopyJournal
+from links import LinkRewriter
+from spool import AttachmentSpool
+from metrics import CopyMetrics
+from plan import PlanWriter, PlanExecutor, read_plan
+from pool import TaskPool
+from transport import AdaptiveRateLimiter, parse_retry_after
+from xmlexport import XmlExportSource
 
 __author__ = 'Grigory Chernyshev <systray@yandex.ru>'
 
@@ -14,14 +40,33 @@ __author__ = 'Grigory Chernyshev <systray@yandex.ru>'
 class ConfluenceAPIDryRunProxy(ConfluenceAPI):
     MOD_METH_RE = re.compile(r'^(create|update|convert|delete)_.*$')
 
-    def __init__(self, username, password, uri_base, user_agent=ConfluenceAPI.DEFAULT_USER_AGENT, dry_run=False):
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_MAX_RETRIES = 5
+    BACKOFF_FACTOR = 0.5
+    MAX_BACKOFF = 60
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    # server rejected request without processing it, so it's safe to retry any request
+    PUSHBACK_STATUSES = (429, 503)
+    RETRY_STATUSES = PUSHBACK_STATUSES + (502, 504)
+
+    _metrics = None
+
+    def __init__(self, username, password, uri_base, user_agent=ConfluenceAPI.DEFAULT_USER_AGENT, dry_run=False,
+                 pool_size=None, max_retries=None, rate_limit=None, metrics=None):
         super(ConfluenceAPIDryRunProxy, self).__init__(username, password, uri_base, user_agent)
         self._dry_run = dry_run
         self.log = logging.getLogger('api-proxy')
+        self._pool_size = self.DEFAULT_POOL_SIZE if pool_size is None else pool_size
+        self._max_retries = self.DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+        self._rate_limiter = AdaptiveRateLimiter(rate=rate_limit)
+        self._session_lock = threading.Lock()
+        # `CopyMetrics` instance, which collects statistics of every API method call
+        self._metrics = metrics
 
     def __getattribute__(self, name):
         attr = object.__getattribute__(self, name)
         is_dry = object.__getattribute__(self, '_dry_run')
+        metrics = object.__getattribute__(self, '_metrics')
         if is_dry and hasattr(attr, '__call__') and self.MOD_METH_RE.match(name):
             def dry_run(*args, **kwargs):
                 func_args = list()
@@ -33,27 +78,381 @@ class ConfluenceAPIDryRunProxy(ConfluenceAPI):
                 self.log.info("[DRY-RUN] {name}({func_args})".format(name=name, func_args=', '.join(func_args)))
 
             return dry_run
+        elif metrics is not None and not name.startswith('_') and isinstance(attr, types.MethodType):
+            def measured(*args, **kwargs):
+                with metrics.call(name):
+                    return attr(*args, **kwargs)
+
+            return measured
         else:
             return attr
 
+    def _start_http_session(self):
+        super(ConfluenceAPIDryRunProxy, self)._start_http_session()
+        # keep up to `pool_size` connections alive, so parallel workers don't reconnect on every request
+        adapter = HTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _service_request(self, request_type, sub_uri, params=None, callback=None,
+                         raise_for_status=True, raw=False, **kwargs):
+        """
+        Same as original `_service_request`, but requests are rate limited and retried with jittered exponential
+        backoff. Only idempotent requests are retried after connection errors and gateway failures, while any
+        request is retried when server explicitly pushed back with 429 or 503 status.
+        """
+        with self._session_lock:
+            if not self.session:
+                self._start_http_session()
+
+        uri = urljoin(self.uri_base, sub_uri)
+        if params:
+            kwargs.update(params=params)
+        idempotent = request_type in self.IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            attempt += 1
+            self._rate_limiter.acquire()
+            self.log.debug("Sending request: {} ({})".format(sub_uri, request_type))
+            try:
+                response = self.session.request(request_type, uri, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._account_request(None, kwargs)
+                if attempt > self._max_retries or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+                reason = str(e)
+                delay = self._backoff(attempt)
+            else:
+                self._account_request(response, kwargs)
+                if response.status_code in self.PUSHBACK_STATUSES:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    self._rate_limiter.on_pushback(retry_after)
+                else:
+                    retry_after = None
+
+                if (
+                    attempt > self._max_retries or
+                    response.status_code not in self.RETRY_STATUSES or
+                    not (idempotent or response.status_code in self.PUSHBACK_STATUSES)
+                ):
+                    break
+                response.close()
+                reason = 'HTTP {}'.format(response.status_code)
+                delay = max(retry_after or 0, self._backoff(attempt))
+
+            self.log.warning("Request {method} {uri} failed ({reason}), retrying in {delay:.1f}s".format(
+                method=request_type, uri=sub_uri, reason=reason, delay=delay
+            ))
+            if hasattr(kwargs.get('data'), 'rewind'):
+                kwargs['data'].rewind()
+            time.sleep(delay)
+
+        if response.ok:
+            self._rate_limiter.on_success()
+        if raise_for_status:
+            response.raise_for_status()
+        if callback:
+            return callback(response)
+        elif not response.text and not raw:
+            return None
+        else:
+            return response.content if raw else json.loads(response.text)
+
+    def _account_request(self, response, kwargs):
+        if self._metrics is None:
+            return
+        data = kwargs.get('data')
+        self._metrics.add_request(
+            # streamed response is not read yet, it's accounted by consumer
+            bytes_in=len(response.content) if response is not None and not kwargs.get('stream') else 0,
+            bytes_out=len(data) if hasattr(data, '__len__') else 0
+        )
+
+    def _backoff(self, attempt):
+        # "full jitter" exponential backoff
+        return random.uniform(0, min(self.MAX_BACKOFF, self.BACKOFF_FACTOR * 2 ** attempt))
+
+    def download_attachment(self, download_link, fileobj, chunk_size):
+        """
+        Download attachment content into `fileobj` by chunks of `chunk_size` bytes.
+        :return: number of downloaded bytes.
+        """
+        def save(response):
+            size = 0
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                fileobj.write(chunk)
+                size += len(chunk)
+            if self._metrics is not None:
+                self._metrics.add_bytes(bytes_in=size)
+            return size
+
+        return self._service_get_request(sub_uri=download_link, callback=save, stream=True)
+
+    def create_new_attachment_stream_by_content_id(self, content_id, attachment, callback=None):
+        """
+        Same as `create_new_attachment_by_content_id`, but sends `MultipartAttachmentStream` without loading it into
+        memory.
+        """
+        return self._service_post_request(
+            "rest/api/content/{id}/child/attachment".format(id=content_id),
+            headers={"X-Atlassian-Token": "nocheck", "Content-Type": attachment.content_type},
+            data=attachment,
+            callback=callback
+        )
+
+    def update_attachment_stream(self, content_id, attachment_id, attachment, callback=None):
+        """
+        Same as `update_attachment`, but sends `MultipartAttachmentStream` without loading it into memory.
+        """
+        return self._service_post_request(
+            "rest/api/content/{content_id}/child/attachment/{attachment_id}/data".format(
+                content_id=content_id, attachment_id=attachment_id
+            ),
+            headers={"X-Atlassian-Token": "nocheck", "Content-Type": attachment.content_type},
+            data=attachment,
+            callback=callback
+        )
+
+
+class MultipartAttachmentStream(object):
+    """
+    File-like multipart/form-data request body for attachment upload. File content is read from `fileobj` by chunks
+    while request is being sent, so memory usage doesn't depend on the file size.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, name, fileobj, content_type, comment=None):
+        self.name = name
+        self.boundary = uuid.uuid4().hex
+
+        head = (
+            '--{boundary}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            'Content-Type: {content_type}\r\n\r\n'
+        ).format(
+            boundary=self.boundary,
+            name=name.replace('"', '\\"'),
+            content_type=(content_type or 'application/octet-stream').encode('utf-8')
+        )
+        tail = '\r\n'
+        if comment:
+            tail += (
+                '--{boundary}\r\n'
+                'Content-Disposition: form-data; name="comment"\r\n\r\n'
+                '{comment}\r\n'
+            ).format(boundary=self.boundary, comment=comment.encode('utf-8'))
+        tail += '--{boundary}--\r\n'.format(boundary=self.boundary)
+
+        fileobj.seek(0, os.SEEK_END)
+        file_size = fileobj.tell()
+
+        self._head = head
+        self._tail = tail
+        self._fileobj = fileobj
+        self._length = len(head) + file_size + len(tail)
+        self.rewind()
+
+    def rewind(self):
+        """
+        Start reading body from the beginning, e.g. to send it again.
+        """
+        self._fileobj.seek(0)
+        self._parts = [BytesIO(self._head), self._fileobj, BytesIO(self._tail)]
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def __str__(self):
+        return '<attachment {name} ({size} bytes)>'.format(name=self.name, size=self._length)
+
+    def read(self, size=-1):
+        result = b''
+        while self._parts and (size < 0 or len(result) < size):
+            chunk = self._parts[0].read(-1 if size < 0 else size - len(result))
+            if chunk:
+                result += chunk
+            else:
+                self._parts.pop(0)
+        return result
+
+
+class _CopyTarget(object):
+    """
+    Destination of the page copy. For children of the copied page it's ancestor is the page copy.
+    """
+    __slots__ = ('dst_space_key', 'dst_title_template', 'dst_parent_id', 'dst_parent_title', 'ancestor_id')
+
+    def __init__(self, dst_space_key, dst_title_template, dst_parent_id, dst_parent_title, ancestor_id):
+        self.dst_space_key = dst_space_key
+        self.dst_title_template = dst_title_template
+        self.dst_parent_id = dst_parent_id
+        self.dst_parent_title = dst_parent_title
+        self.ancestor_id = ancestor_id
+
+
+class _CopyNode(object):
+    """
+    Compact record of the page waiting to be copied: how to find the source page and where to put it's copies.
+    """
+    __slots__ = ('src', 'summary', 'targets', 'recursion_limit')
+
+    def __init__(self, src, summary, targets, recursion_limit):
+        self.src = src
+        self.summary = summary
+        self.targets = targets
+        self.recursion_limit = recursion_limit
+
+    @staticmethod
+    def summarize(page, space_key=None):
+        """
+        :return: id, title, version and space of the page from children listing, without other expanded fields.
+        """
+        summary = {'id': page['id'], 'title': page.get('title')}
+        if space_key is not None:
+            summary['space'] = {'key': space_key}
+        if 'version' in page:
+            summary['version'] = {'number': page['version']['number']}
+        return summary
+
+
+class PageFilter(object):
+    """
+    Selection of page trees by title patterns (shell-style, e.g. `Archive*`) and labels. Rules are checked on pages
+    from listings, so pages filtered out are never fetched. Include rules select top-level pages of the space,
+    exclude rules skip subtrees at any depth.
+    """
+
+    def __init__(self, include_titles=None, exclude_titles=None, include_labels=None, exclude_labels=None):
+        self.include_titles = include_titles or []
+        self.exclude_titles = exclude_titles or []
+        self.include_labels = set(include_labels or [])
+        self.exclude_labels = set(exclude_labels or [])
+
+    @staticmethod
+    def _labels(page):
+        return set(label['name'] for label in page.get('metadata', {}).get('labels', {}).get('results', []))
+
+    @staticmethod
+    def _matches(title, patterns):
+        return any(fnmatch.fnmatchcase(title, pattern) for pattern in patterns)
+
+    def includes(self, page):
+        """
+        :return: whether top-level page should be copied with it's subtree.
+        """
+        if self.excludes(page):
+            return False
+        if not self.include_titles and not self.include_labels:
+            return True
+        return self._matches(page['title'], self.include_titles) or bool(self._labels(page) & self.include_labels)
+
+    def excludes(self, page):
+        """
+        :return: whether page should be skipped with it's subtree.
+        """
+        return self._matches(page['title'], self.exclude_titles) or bool(self._labels(page) & self.exclude_labels)
+
 
 class ConfluencePageCopier(object):
-    EXPAND_FIELDS = 'body.storage,space,ancestors,version'
+    BODY_EXPAND_FIELD = 'body.storage'
+    EXPAND_FIELDS = BODY_EXPAND_FIELD + ',space,ancestors,version'
+    # besides page itself, labels, attachments and children are fetched by the same request
+    CONSOLIDATED_EXPAND_FIELDS = ','.join([
+        EXPAND_FIELDS,
+        'metadata.labels',
+        'children.page.version',
+        'children.attachment.version',
+        'children.attachment.metadata',
+    ])
+    INDEX_EXPAND_FIELDS = 'ancestors,version'
+    LABELS_EXPAND_FIELD = 'metadata.labels'
+    ROOT_EXPAND_FIELDS = 'version,' + LABELS_EXPAND_FIELD
+    SUMMARY_EXPAND_FIELDS = 'space,ancestors,version'
+    CHILDREN_EXPAND_FIELDS = 'version'
+    ATTACHMENT_EXPAND_FIELDS = 'version'
     TITLE_FIELD = '{title}'
     COUNTER_FIELD = '{counter}'
     DEFAULT_TEMPLATE = '{t} ({c})'.format(t=TITLE_FIELD, c=COUNTER_FIELD)
+    DEFAULT_ATTACHMENT_SPOOL_SIZE = 10 * 1024 * 1024
+    PREFETCH_WORKERS = 4
+    TIMESTAMP_RE = re.compile(
+        r'^(?P<datetime>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?'
+        r'(?:Z|(?P<sign>[+-])(?P<hours>\d\d):?(?P<minutes>\d\d))?$'
+    )
 
-    def __init__(self, username, password, uri_base, dry_run=False):
+    def __init__(self, username, password, uri_base, dry_run=False, attachment_spool_size=None, page_size=None,
+                 index_destination=True, journal_path=None, pool_size=None, max_retries=None, rate_limit=None,
+                 consolidated_fetch=True, source=None, progress_interval=None, cache_size=None,
+                 page_store_path=None, attachment_cache_size=None, rewrite_links=True):
         self.log = logging.getLogger('confl-copier')
         self._dry_run = dry_run
+        # attachments smaller than this are kept in memory while transferring, bigger ones are spilled to temp file
+        self._attachment_spool_size = (
+            self.DEFAULT_ATTACHMENT_SPOOL_SIZE if attachment_spool_size is None else attachment_spool_size
+        )
+        # number of results requested per page from paginated endpoints, `None` means server's default
+        self._page_size = page_size
+        self._prefetcher = ThreadPoolExecutor(max_workers=self.PREFETCH_WORKERS)
+        self._page_expand_fields = self.CONSOLIDATED_EXPAND_FIELDS if consolidated_fetch else self.EXPAND_FIELDS
+
+        # statistics of API calls by method and by copy phase
+        self._metrics = CopyMetrics()
+        if progress_interval:
+            self._metrics.start_progress(progress_interval)
+
         self._client = ConfluenceAPIDryRunProxy(
             username=username,
             password=password,
             uri_base=uri_base,
-            dry_run=dry_run
+            dry_run=dry_run,
+            pool_size=pool_size,
+            max_retries=max_retries,
+            rate_limit=rate_limit,
+            metrics=self._metrics
         )
 
-        self._cache = LRU()
+        # alternative source of pages (e.g. `XmlExportSource`), by default pages are read from the same server
+        self._source = source
+        self._source_client = self._client if source is None else source
+
+        # lookups of pages, limited by size of cached bodies, which are optionally persisted for the next runs
+        self._cache = PageCache(max_size=cache_size, store=PageBodyStore(page_store_path) if page_store_path else None)
+
+        # space key -> {title -> {'id', 'version', 'ancestor_id'}} of destination pages, built lazily per space
+        self._index_destination = index_destination
+        self._dst_index = dict()
+        self._dst_index_lock = threading.Lock()
+
+        # counts and sizes of transferred and skipped (identical in destination) attachments
+        self._attachment_stats = {
+            'transferred': 0, 'transferred_bytes': 0, 'skipped': 0, 'skipped_bytes': 0, 'reused': 0, 'reused_bytes': 0
+        }
+        self._attachment_stats_lock = threading.Lock()
+
+        # downloaded attachments, which could be uploaded again without download (e.g. the same logo on many pages)
+        self._attachment_spool = AttachmentSpool(attachment_cache_size) if attachment_cache_size else None
+
+        # links between copied pages are rewritten to point to copies
+        self._link_rewriter = LinkRewriter() if rewrite_links else None
+
+        # (space key, title template) -> next free `{counter}` value
+        self._counters = dict()
+        self._counters_lock = threading.Lock()
+
+        # journal of previous runs, allows to skip pages which were not changed since then
+        self._journal = CopyJournal(journal_path) if journal_path else None
 
     def copy(
             self,
@@ -66,115 +465,1117 @@ class ConfluencePageCopier(object):
             overwrite=False,
             skip_labels=False,
             skip_attachments=False,
+            recursion_limit=None,
+            workers=None,
+            src_summary=None,
+            copies=None,
+            targets=None,
+            page_filter=None
+    ):
+        """
+        Copy page tree `src`.
+        :param copies: number of copies of the tree to create. Source tree is read once and every page is written to
+                       all copies, `{counter}` of the title template is different in every copy.
+        :param targets: list of destinations to copy the tree to, each is a dictionary with optional
+                        `dst_space_key`, `dst_title_template`, `dst_parent_id` and `dst_parent_title` keys. If set,
+                        destination parameters are ignored. Source pages and attachments are read once for all
+                        destinations.
+        :param page_filter: `PageFilter`, subtrees of pages excluded by it are not copied.
+        """
+        if copies is not None and copies < 1:
+            raise ValueError("Number of copies should be at least 1, got {}".format(copies))
+        if targets is None:
+            targets = [{
+                'dst_space_key': dst_space_key,
+                'dst_title_template': dst_title_template,
+                'dst_parent_id': dst_parent_id,
+                'dst_parent_title': dst_parent_title,
+            }]
+
+        copy_targets = list()
+        for target in targets:
+            template = target.get('dst_title_template')
+            if copies is not None and copies > 1 and template and self.COUNTER_FIELD not in template:
+                raise ValueError("Title template should contain '{counter}' to create multiple copies".format(
+                    counter=self.COUNTER_FIELD
+                ))
+            copy_targets.extend(
+                _CopyTarget(
+                    dst_space_key=target.get('dst_space_key'),
+                    dst_title_template=template,
+                    dst_parent_id=target.get('dst_parent_id'),
+                    dst_parent_title=target.get('dst_parent_title'),
+                    ancestor_id=ancestor_id
+                )
+                for _ in range(copies or 1)
+            )
+
+        root = _CopyNode(src=src, summary=src_summary, targets=copy_targets, recursion_limit=recursion_limit)
+        settings = dict(
+            overwrite=overwrite, skip_labels=skip_labels, skip_attachments=skip_attachments, page_filter=page_filter
+        )
+
+        if workers is not None and workers > 1:
+            self._copy_concurrently(workers, root, settings)
+            return
+
+        # explicit stack of compact records instead of recursion: depth of the tree is not limited by interpreter and
+        # only the page being copied keeps it's body in memory
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            source, copied = self._copy_single(src=node.src, targets=node.targets, src_summary=node.summary,
+                                               recursion_limit=node.recursion_limit, **settings)
+            # children are pushed in reverse order, so they are copied in the original one
+            stack.extend(reversed(self._child_nodes(source, copied, node.recursion_limit, page_filter)))
+
+        self._patch_links()
+
+    def copy_space(self, src_space_key, page_filter=None, **kwargs):
+        """
+        Copy all page trees of the space. Top-level pages are listed page by page while trees are being copied
+        (unless copies are created at the top level of the same space), and all trees are copied by this copier, so
+        caches, connections and destination index are shared between them.
+        :param page_filter: `PageFilter` selecting top-level pages and excluding subtrees.
+        :param kwargs: parameters of `copy`.
+        :return: number of copied trees.
+        """
+        page_filter = page_filter or PageFilter()
+        copied = 0
+        with self._metrics.phase('children'):
+            roots = self._iter_results(
+                self._source_client.get_space_content_by_type,
+                space_key=src_space_key,
+                content_type='page',
+                depth='root',
+                expand=self.ROOT_EXPAND_FIELDS
+            )
+            # copies created at the top level of the source space are listed as roots too, so listing all roots
+            # before copying starts is the only way not to copy the copies again
+            targets = kwargs.get('targets') or [kwargs]
+            if self._source is None and not kwargs.get('ancestor_id') and any(
+                    target.get('dst_space_key') in (None, src_space_key) and
+                    not target.get('dst_parent_id') and not target.get('dst_parent_title')
+                    for target in targets
+            ):
+                roots = list(roots)
+        for root in roots:
+            if not page_filter.includes(root):
+                self.log.info(u"Skipping '{space}/{title}' tree as it's not selected".format(
+                    space=src_space_key, title=root['title']
+                ))
+                continue
+
+            self.copy(
+                src={'content_id': root['id']},
+                src_summary=_CopyNode.summarize(root, src_space_key or root.get('space', {}).get('key')),
+                page_filter=page_filter,
+                **kwargs
+            )
+            copied += 1
+
+        self.log.info(u"Copied {count} tree(s) of space '{space}'".format(count=copied, space=src_space_key))
+        return copied
+
+    def plan(
+            self,
+            plan_path,
+            src,
+            dst_space_key=None,
+            dst_title_template=None,
+            dst_parent_id=None,
+            dst_parent_title=None,
+            overwrite=False,
+            skip_labels=False,
+            skip_attachments=False,
             recursion_limit=None
     ):
-        source = self._find_page(**src)
-        dst_space_key, dst_title_template = self._init_destination_page(source, dst_space_key, dst_title_template)
-        dst_title = dst_title_template.replace('{title}', source['title'])
+        """
+        Walk source tree `src` and destination space and write plan of the copy to `plan_path` instead of copying.
+        Nothing is changed in destination, plan could be executed later with `execute_plan`. Page bodies are not
+        stored in the plan, pages are referenced by id and version.
+        :return: number of planned operations of every kind and expected number of requests and transferred bytes.
+        """
+        writer = PlanWriter(plan_path)
+        try:
+            # tuples of source, id of parent's operation, destination space, title template and recursion limit
+            stack = [(src, None, None, dst_space_key, dst_title_template, recursion_limit)]
+            while stack:
+                page_src, summary, parent, space_key, template, limit = stack.pop()
+                with self._metrics.phase('find'):
+                    source = self._find_source_page(
+                        version=summary.get('version', {}).get('number') if summary else None, **page_src
+                    )
+                space_key, template, page_operation = self._plan_page(
+                    writer, source, parent, space_key, template, dst_parent_id, dst_parent_title, overwrite,
+                    skip_labels, skip_attachments
+                )
 
-        # ancestor_id determines parent of the page being copied. If it's not provided, we take it from source page.
-        # If source page doesn't have ancestors, that means that it's root page, so we will copy to the root as well.
-        if ancestor_id is None:
-            if dst_parent_id is not None:
-                ancestor_id = dst_parent_id
-            elif dst_parent_title is not None:
-                dst_parent = self._find_page(space_key=dst_space_key, title=dst_parent_title)
-                ancestor_id = dst_parent['id']
-            elif 'ancestors' in source and source['space']['key'] == dst_space_key:
-                self.log.debug('Setting ancestor id to {}'.format(source['ancestors'][-1]['id']))
-                ancestor_id = source['ancestors'][-1]['id']
+                if limit is not None and limit <= 0:
+                    continue
+                children = list()
+                for child in self._iter_children(source):
+                    children.append((
+                        {'content_id': child['id']}, _CopyNode.summarize(child), page_operation, space_key, template,
+                        None if limit is None else limit - 1
+                    ))
+                stack.extend(reversed(children))
+        finally:
+            writer.close()
+
+        totals = writer.totals()
+        self.log.info(
+            "Planned {operations} operation(s) ({kinds}), expected {requests} request(s) and {bytes} byte(s)".format(
+                operations=sum(totals['operations'].values()),
+                kinds=', '.join('{} {}'.format(count, op) for op, count in sorted(totals['operations'].items())),
+                requests=totals['requests'],
+                bytes=totals['bytes']
+            )
+        )
+        return totals
+
+    def _plan_page(self, writer, source, parent, dst_space_key, dst_title_template, dst_parent_id, dst_parent_title,
+                   overwrite, skip_labels, skip_attachments):
+        """
+        Add operations copying single page with it's labels and attachments to the plan.
+        :param parent: id of operation copying parent page, `None` for the root page.
+        :return: tuple of destination space, title template for children and id of the page operation.
+        """
+        with self._metrics.phase('find'):
+            dst_space_key, dst_title_template = self._init_destination_page(source, dst_space_key, dst_title_template)
+            dst_title = dst_title_template.replace(self.TITLE_FIELD, source['title'])
+            journal_entry = self._get_journal_entry(source, dst_space_key, dst_title)
+            if self._index_destination:
+                existing = self._find_dst_page(dst_space_key, dst_title)
             else:
-                ancestor_id = None
+                existing = self._find_page(space_key=dst_space_key, title=dst_title)
+
+        page = {
+            'src_id': source['id'],
+            'src_version': source['version']['number'],
+            'src_space': source['space']['key'],
+            'src_title': source['title'],
+            'dst_space': dst_space_key,
+            'dst_title': dst_title,
+            'dst_title_template': dst_title_template,
+        }
+        deps = list()
+        if parent is None:
+            page['ancestor_id'] = self._resolve_ancestor(source, dst_space_key, dst_parent_id, dst_parent_title)[0]
+        else:
+            deps.append(parent)
+        body_size = len(source.get('body', {}).get('storage', {}).get('value', u'').encode('utf-8'))
 
-        # check if page in selected space and with specific title already exists.
-        existing_dst_page = self._find_page(space_key=dst_space_key, title=dst_title)
-        if existing_dst_page:
-            if overwrite:
-                page_copy = self._overwrite_page(source, ancestor_id, existing_dst_page, dst_space_key, dst_title)
-            else:
+        if journal_entry is not None and journal_entry['src_version'] == source['version']['number']:
+            page_operation = writer.add('skip', deps, dst_id=journal_entry['dst_id'], **page)
+        elif existing is not None:
+            if not overwrite:
                 raise RuntimeError(u"Can't copy to '{space}/{title}' as it already exists!".format(
                     space=dst_space_key,
                     title=dst_title
                 ))
+            # source body is fetched again, existing page is fetched to compare with and then updated
+            page_operation = writer.add(
+                'update', deps, requests=3, bytes=3 * body_size, dst_id=existing['id'], **page
+            )
         else:
-            page_copy = self._copy_page(source, ancestor_id, dst_space_key, dst_title)
+            # source body is fetched again and then uploaded
+            page_operation = writer.add('create', deps, requests=2, bytes=2 * body_size, **page)
 
-        if self._dry_run:
-            page_copy_id = source['id']
+        if not skip_labels:
+            with self._metrics.phase('labels'):
+                labels, digest = self._source_labels(source)
+            if labels and (journal_entry is None or journal_entry['labels_digest'] != digest):
+                writer.add('labels', [page_operation], requests=1, bytes=len(json.dumps(labels)), labels=labels,
+                           digest=digest)
+
+        if not skip_attachments:
+            with self._metrics.phase('attachments'):
+                self._plan_attachments(writer, source, page_operation, journal_entry, existing)
+
+        return dst_space_key, dst_title_template, page_operation
+
+    def _plan_attachments(self, writer, source, page_operation, journal_entry, existing):
+        copied = journal_entry['attachments'] if journal_entry else dict()
+        dst_attachments = None
+        for attachment in self._iter_source_attachments(source):
+            if copied.get(attachment['title']) == self._attachment_marker(attachment):
+                continue
+
+            if dst_attachments is None:
+                dst_attachments = dict()
+                if existing is not None or journal_entry is not None:
+                    dst_id = journal_entry['dst_id'] if journal_entry is not None else existing['id']
+                    dst_attachments = dict(
+                        (attach['title'], attach)
+                        for attach in self._iter_results(self._client.get_content_attachments, content_id=dst_id,
+                                                         expand=self.ATTACHMENT_EXPAND_FIELDS)
+                    )
+            existing_attachment = dst_attachments.get(attachment['title'])
+            if existing_attachment is not None and self._is_attachment_equal(attachment, existing_attachment):
+                continue
+
+            size = attachment.get('extensions', {}).get('fileSize') or 0
+            writer.add(
+                'attachment', [page_operation], requests=2, bytes=2 * size,
+                dst_attachment_id=existing_attachment['id'] if existing_attachment is not None else None,
+                attachment={
+                    'id': attachment.get('id'),
+                    'title': attachment['title'],
+                    'version': attachment.get('version', {}),
+                    'metadata': dict(
+                        (key, value) for key, value in attachment.get('metadata', {}).items()
+                        if key in ('mediaType', 'comment')
+                    ),
+                    'extensions': {'fileSize': attachment.get('extensions', {}).get('fileSize')},
+                    '_links': {'download': attachment['_links']['download']},
+                }
+            )
+
+    def execute_plan(self, plan_path, workers=None, resume_from=None):
+        """
+        Execute plan written by `plan`. Results of done operations are saved next to the plan (with `.state`
+        suffix), so repeated execution continues from where previous one stopped.
+        :param workers: number of parallel workers, operation is started as soon as operations it depends on are done.
+        :param resume_from: id of operation to start from, operations before it are considered done.
+        :return: number of executed operations.
+        """
+        operations = read_plan(plan_path)
+        if self._link_rewriter is not None:
+            # all pages of the tree are known in advance, so links are never patched afterwards
+            for operation in operations:
+                if operation['op'] in ('create', 'update', 'skip'):
+                    self._link_rewriter.add(operation['src_space'], operation['src_title'])
+
+        executor = PlanExecutor(
+            operations, self._execute_operation, state_path=plan_path + '.state', workers=workers,
+            resume_from=resume_from
+        )
+        return executor.execute()
+
+    def _execute_operation(self, operation, dependencies):
+        """
+        Execute single plan operation.
+        :param dependencies: list of tuples of operations it depends on and their results.
+        :return: id of the page copy for page operations, `None` for others.
+        """
+        kind = operation['op']
+        if kind == 'skip':
+            self.log.info(u"Skipping '{space}/{title}' as it's not changed since previous run".format(
+                space=operation['dst_space'], title=operation['dst_title']
+            ))
+            return operation['dst_id']
+
+        if kind in ('create', 'update'):
+            ancestor_id = operation.get('ancestor_id')
+            if dependencies:
+                ancestor_id = self._operation_page_id(*dependencies[0])
+            with self._metrics.phase('find'):
+                source = self._find_source_page(content_id=operation['src_id'], version=operation['src_version'])
+            if source['version']['number'] != operation['src_version']:
+                self.log.warning(u"Page '{space}/{title}' was changed since the plan was made".format(
+                    space=operation['src_space'], title=operation['src_title']
+                ))
+            content, _ = self._rewrite_links(source, operation['dst_space'], operation['dst_title_template'])
+
+            dst_space_key, dst_title = operation['dst_space'], operation['dst_title']
+            with self._metrics.phase('create'):
+                with self._metrics.phase('find'):
+                    if kind == 'update':
+                        existing = self._find_page(content_id=operation['dst_id'])
+                    else:
+                        # copy could be created by execution interrupted before result of the operation was saved
+                        existing = None
+                        if not self._index_destination or self._find_dst_page(dst_space_key, dst_title):
+                            existing = self._find_page(space_key=dst_space_key, title=dst_title)
+                if existing is not None:
+                    page_copy = self._overwrite_page(content, ancestor_id, existing, dst_space_key, dst_title)
+                else:
+                    page_copy = self._copy_page(content, ancestor_id, dst_space_key, dst_title)
+            self._metrics.page_copied()
+            if self._dry_run:
+                return source['id']
+
+            if self._journal is not None:
+                # labels and attachments are recorded by their own operations, state of previous copy is kept
+                # until then, if it's the same page
+                previous = self._journal.get(source['id'], dst_space_key, dst_title)
+                if previous is not None and previous['dst_id'] != unicode(page_copy['id']):
+                    previous = None
+                self._journal.record(
+                    src_id=source['id'],
+                    src_version=source['version']['number'],
+                    dst_space_key=dst_space_key,
+                    dst_title=dst_title,
+                    dst_id=page_copy['id'],
+                    labels_digest=previous['labels_digest'] if previous else None,
+                    attachments=previous['attachments'] if previous else None
+                )
+            return page_copy['id']
+
+        page_operation = dependencies[0][0]
+        page_copy_id = self._operation_page_id(*dependencies[0])
+        journal = self._journal if not self._dry_run else None
+        if kind == 'labels':
+            with self._metrics.phase('labels'):
+                self.log.info("Copying {} label(s)".format(len(operation['labels'])))
+                self._client.create_new_label_by_content_id(content_id=page_copy_id, label_names=operation['labels'])
+            if journal is not None and operation.get('digest'):
+                journal.update(page_operation['src_id'], page_operation['dst_space'], page_operation['dst_title'],
+                               labels_digest=operation['digest'])
+        elif kind == 'attachment':
+            attachment = operation['attachment']
+            with self._metrics.phase('attachments'):
+                existing_attachment = None
+                if operation['dst_attachment_id'] is not None:
+                    existing_attachment = {'id': operation['dst_attachment_id']}
+                elif not self._dry_run:
+                    # attachment could be uploaded by execution interrupted before result of the operation was saved
+                    with self._metrics.phase('find'):
+                        existing_attachment = next(iter(self._client.get_content_attachments(
+                            content_id=page_copy_id, filename=attachment['title'],
+                            expand=self.ATTACHMENT_EXPAND_FIELDS
+                        ).get('results', [])), None)
+
+                spool = self._download_attachment(attachment)
+                try:
+                    spool.seek(0, os.SEEK_END)
+                    size = spool.tell()
+                    body = MultipartAttachmentStream(
+                        name=attachment['title'].encode('utf8'),
+                        fileobj=spool,
+                        content_type=attachment['metadata'].get('mediaType', u''),
+                        comment=attachment['metadata'].get('comment', u'')
+                    )
+                    self._upload_attachment(body, size, page_copy_id, existing_attachment)
+                finally:
+                    spool.close()
+            if journal is not None:
+                journal.update(page_operation['src_id'], page_operation['dst_space'], page_operation['dst_title'],
+                               attachment=(attachment['title'], self._attachment_marker(attachment)))
+        return None
+
+    def _operation_page_id(self, operation, result):
+        """
+        :return: id of the page copy made by page operation. If result of the operation is unknown (execution was
+                 resumed after it), the copy is looked up by title.
+        """
+        if result is not None:
+            return result
+        with self._metrics.phase('find'):
+            page = self._find_page(space_key=operation['dst_space'], title=operation['dst_title'])
+        if page is None:
+            raise RuntimeError(u"Can't find copy '{space}/{title}' made by operation {id}".format(
+                space=operation['dst_space'], title=operation['dst_title'], id=operation['id']
+            ))
+        return page['id']
+
+    def sync(
+            self,
+            src,
+            dst_space_key=None,
+            dst_title_template=None,
+            dst_parent_id=None,
+            dst_parent_title=None,
+            delete=False,
+            skip_labels=False,
+            skip_attachments=False,
+            recursion_limit=None
+    ):
+        """
+        Synchronise copy of page tree `src` with the source. Source tree (from children listings) and destination
+        tree (from destination index) are compared by versions and ancestors without fetching page bodies, and only
+        the difference is applied: new pages are created, changed ones updated, moved or renamed ones moved.
+        Copies are matched to source pages by journal, existing copies without journal entry (e.g. made without
+        journal) are found by title and compared with the source once, like with `overwrite`. Labels and
+        attachments are copied for created and updated pages only.
+        :param delete: delete pages of destination tree, which don't have source page anymore. Only pages within
+                       `recursion_limit` are checked.
+        :return: dictionary with number of created, updated, moved, unchanged and deleted (or stale, if `delete`
+                 is not set) pages.
+        """
+        if not self._index_destination:
+            raise ValueError("Synchronisation requires destination index")
+        if self._journal is None:
+            raise ValueError("Synchronisation requires journal")
+        if dst_title_template and self.COUNTER_FIELD in dst_title_template:
+            raise ValueError("Title template shouldn't contain '{counter}' for synchronisation".format(
+                counter=self.COUNTER_FIELD
+            ))
+
+        with self._metrics.phase('find'):
+            root = self._find_source_summary(**src)
+        dst_space_key = dst_space_key or root['space']['key']
+        dst_title_template = dst_title_template or self.TITLE_FIELD
+        if self.TITLE_FIELD not in dst_title_template:
+            dst_title_template = self.TITLE_FIELD + dst_title_template
+        if dst_space_key == root['space']['key'] and dst_title_template == self.TITLE_FIELD:
+            raise ValueError("Copies would have the same titles as source pages in the same space, set destination "
+                             "space or title template")
+        root_ancestor_id = self._resolve_ancestor(root, dst_space_key, dst_parent_id, dst_parent_title)[0]
+        src_space_key = root['space']['key']
+
+        stats = {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 0}
+        matched = set()
+        root_copy_id = None
+        # tuples of summary of the source page, id of the parent copy and recursion limit
+        stack = [(root, root_ancestor_id, recursion_limit)]
+        while stack:
+            summary, ancestor_id, limit = stack.pop()
+            if self._link_rewriter is not None:
+                self._link_rewriter.add(src_space_key, summary['title'])
+
+            page_copy_id, action = self._sync_page(
+                summary, dst_space_key, dst_title_template, ancestor_id, skip_labels, skip_attachments, limit
+            )
+            stats[action] += 1
+            matched.add(unicode(page_copy_id))
+            if root_copy_id is None:
+                root_copy_id = page_copy_id
+
+            if limit is not None and limit <= 0:
+                continue
+            stack.extend(reversed([
+                (_CopyNode.summarize(child, src_space_key), page_copy_id, None if limit is None else limit - 1)
+                for child in self._iter_children(summary)
+            ]))
+
+        self._patch_links()
+
+        stale = self._stale_pages(dst_space_key, root_copy_id, matched, recursion_limit)
+        if delete:
+            for title, record in stale:
+                self.log.info(u"Deleting '{space}/{title}' as it doesn't exist in source".format(
+                    space=dst_space_key, title=title
+                ))
+                with self._metrics.phase('create'):
+                    self._client.delete_content_by_id(content_id=record['id'])
+                if not self._dry_run:
+                    with self._dst_index_lock:
+                        self._dst_index[dst_space_key].pop(title, None)
+                    self._cache.invalidate(self._cache_key(space_key=dst_space_key, title=title))
+            stats['deleted'] = len(stale)
         else:
-            page_copy_id = page_copy['id']
+            stats['stale'] = len(stale)
+            if stale:
+                self.log.info("{} page(s) of destination tree don't exist in source, use `delete` to remove "
+                              "them".format(len(stale)))
+
+        self.log.info(', '.join('{} {}'.format(count, action) for action, count in sorted(stats.items())))
+        return stats
+
+    def _find_source_summary(self, content_id=None, space_key=None, title=None):
+        """
+        :return: source page with space, ancestors and version, but without body.
+        """
+        if self._source is not None:
+            return self._source.find_page(content_id=content_id, space_key=space_key, title=title)
+        if content_id:
+            return self._client.get_content_by_id(content_id=content_id, expand=self.SUMMARY_EXPAND_FIELDS)
+        return self._search_page(space_key, title, expand=self.SUMMARY_EXPAND_FIELDS)
+
+    def _sync_page(self, summary, dst_space_key, dst_title_template, ancestor_id, skip_labels, skip_attachments,
+                   recursion_limit=None):
+        """
+        Bring copy of single page in line with the source page.
+        :param summary: source page without body (e.g. from children listing).
+        :param ancestor_id: id of the copy of the parent page, copy is moved there if it's somewhere else.
+        :param recursion_limit: remaining recursion limit of the page.
+        :return: tuple of id of the copy and applied action.
+        """
+        dst_title = dst_title_template.replace(self.TITLE_FIELD, summary['title'])
+        with self._metrics.phase('find'):
+            existing, journal_entry = self._locate_copy(summary, dst_space_key, dst_title)
+
+        changed = journal_entry is None or journal_entry['src_version'] != summary['version']['number']
+        moved = existing is not None and (
+            existing['title'] != dst_title or unicode(existing['ancestor_id']) != unicode(ancestor_id)
+        )
+        if moved and (changed and existing['title'] == dst_title):
+            # parent is changed by the update itself
+            moved = False
+
+        if moved:
+            with self._metrics.phase('create'):
+                self._move_page(existing, dst_space_key, dst_title, ancestor_id)
+            if journal_entry is not None and journal_entry['dst_title'] != dst_title and not self._dry_run:
+                self._journal.remove(summary['id'], dst_space_key, journal_entry['dst_title'])
+                self._journal.record(
+                    src_id=summary['id'],
+                    src_version=journal_entry['src_version'],
+                    dst_space_key=dst_space_key,
+                    dst_title=dst_title,
+                    dst_id=journal_entry['dst_id'],
+                    labels_digest=journal_entry['labels_digest'],
+                    attachments=journal_entry['attachments']
+                )
+            if not changed:
+                return existing['id'], 'moved'
+        elif existing is not None and not changed:
+            self.log.debug(u"Skipping '{space}/{title}' as it's not changed".format(
+                space=dst_space_key, title=dst_title
+            ))
+            return existing['id'], 'unchanged'
+
+        _, copied = self._copy_single(
+            src={'content_id': summary['id']},
+            targets=[_CopyTarget(
+                dst_space_key=dst_space_key,
+                dst_title_template=dst_title_template,
+                dst_parent_id=None,
+                dst_parent_title=None,
+                ancestor_id=ancestor_id
+            )],
+            overwrite=True,
+            skip_labels=skip_labels,
+            skip_attachments=skip_attachments,
+            src_summary=summary,
+            recursion_limit=recursion_limit
+        )
+        if existing is None:
+            return copied[0].ancestor_id, 'created'
+        if not self._dry_run and self._find_dst_page(dst_space_key, dst_title)['version'] == existing['version']:
+            # copy found by title was the same as the source, so it wasn't written
+            return existing['id'], 'unchanged'
+        return existing['id'], 'updated'
+
+    def _locate_copy(self, summary, dst_space_key, dst_title):
+        """
+        Find existing copy of the source page: by journal, so renamed copies are found too, or by title.
+        :return: tuple of destination index record of the copy (with title) and it's journal entry, if any.
+        """
+        entries = self._journal.find(summary['id'], dst_space_key) if self._journal is not None else []
+        # copy with expected title is preferred
+        for entry in sorted(entries, key=lambda e: e['dst_title'] != dst_title):
+            record = self._find_dst_page(dst_space_key, entry['dst_title'])
+            if record is not None and unicode(record['id']) == entry['dst_id']:
+                return dict(record, title=entry['dst_title']), entry
+
+        record = self._find_dst_page(dst_space_key, dst_title)
+        return (dict(record, title=dst_title) if record is not None else None), None
+
+    def _move_page(self, existing, dst_space_key, dst_title, ancestor_id):
+        """
+        Move copy under new parent and/or rename it, keeping it's content.
+        :param existing: destination index record of the copy with it's title.
+        """
+        self.log.info(u"Moving '{space}/{title}' => '{new_title}' under {ancestor}".format(
+            space=dst_space_key, title=existing['title'], new_title=dst_title, ancestor=ancestor_id or 'space root'
+        ))
+        # body is required by update, it's fetched only for pages, which are not updated anyway
+        page = self._client.get_content_by_id(content_id=existing['id'], expand=self.EXPAND_FIELDS)
+        page_copy = self._client.update_content_by_id(
+            content_data={
+                'id': existing['id'],
+                'type': page['type'],
+                'space': {'key': dst_space_key},
+                'title': dst_title,
+                'body': {'storage': {'value': page['body']['storage']['value'], 'representation': 'storage'}},
+                'ancestors': [] if not ancestor_id else [{'id': ancestor_id}],
+                'version': {'number': page['version']['number'] + 1},
+            },
+            content_id=existing['id']
+        )
+        if self._dry_run:
+            return
+
+        with self._dst_index_lock:
+            self._dst_index[dst_space_key].pop(existing['title'], None)
+        self._update_dst_index(dst_space_key, dst_title, page_copy, ancestor_id)
+        for title in (existing['title'], dst_title):
+            self._cache.invalidate(self._cache_key(space_key=dst_space_key, title=title))
+
+    def _stale_pages(self, dst_space_key, root_copy_id, matched, recursion_limit=None):
+        """
+        :param recursion_limit: depth of the walked source tree, deeper pages of destination tree are not checked.
+        :return: list of tuples of title and destination index record of pages under the copy of the root, which
+                 don't have source page, children go before their parents.
+        """
+        with self._dst_index_lock:
+            index = dict(self._dst_index.get(dst_space_key, {}))
+
+        children = dict()
+        for title, record in index.items():
+            children.setdefault(unicode(record['ancestor_id']), list()).append((title, record))
+
+        subtree = list()
+        # tuples of page id and recursion limit, like in the walk of the source tree
+        queue = [(unicode(root_copy_id), recursion_limit)]
+        while queue:
+            page_id, limit = queue.pop()
+            if limit is not None and limit <= 0:
+                continue
+            for title, record in children.get(page_id, []):
+                subtree.append((title, record))
+                queue.append((unicode(record['id']), None if limit is None else limit - 1))
+        return [(title, record) for title, record in reversed(subtree) if unicode(record['id']) not in matched]
+
+    def _child_nodes(self, source, copied, recursion_limit, page_filter=None):
+        """
+        :param copied: list of `_CopyTarget` records, with copies of the `source` page as ancestors.
+        :param page_filter: `PageFilter`, children excluded by it are skipped with their subtrees.
+        :return: list of `_CopyNode` records of children of the `source` page.
+        """
+        if recursion_limit is not None and recursion_limit <= 0:
+            self.log.debug("Breaking copy cycle as recursion limit is reached.")
+            return []
+
+        space_key = source.get('space', {}).get('key')
+        nodes = list()
+        with_labels = page_filter is not None and bool(page_filter.exclude_labels)
+        for child in self._iter_children(source, with_labels=with_labels):
+            if page_filter is not None and page_filter.excludes(child):
+                self.log.info(u"Skipping '{title}' with it's children as it's excluded".format(title=child['title']))
+                continue
+            if self._link_rewriter is not None and child.get('title') is not None:
+                # children are known before they are copied, so links to them don't need to be patched afterwards
+                self._link_rewriter.add(space_key, child['title'])
+            nodes.append(_CopyNode(
+                src={'content_id': child['id']},
+                summary=_CopyNode.summarize(child, space_key),
+                targets=copied,
+                recursion_limit=None if recursion_limit is None else recursion_limit - 1
+            ))
+        return nodes
+
+    def _copy_concurrently(self, workers, root, settings):
+        """
+        Copy page tree using `TaskPool` of `workers` threads. Page is added to the pool by the copy of it's parent, so
+        siblings and whole subtrees are copied in parallel.
+        """
+        pool = TaskPool(workers)
+
+        def copy_node(node):
+            source, copied = self._copy_single(src=node.src, targets=node.targets, src_summary=node.summary,
+                                               recursion_limit=node.recursion_limit, **settings)
+            for child in self._child_nodes(source, copied, node.recursion_limit, settings['page_filter']):
+                pool.add(partial(copy_node, child))
+
+        self.log.debug("Copying with {} worker(s)".format(workers))
+        pool.add(partial(copy_node, root))
+        pool.join()
+
+        self._patch_links()
+
+    def _copy_single(self, src, targets, overwrite=False, skip_labels=False, skip_attachments=False, src_summary=None,
+                     page_filter=None, recursion_limit=None):
+        """
+        Copy single page with it's labels and attachments to every target, without children. Source page is read
+        once for all targets.
+        `src_summary` is short description of the source page (id, title and version) from children listing,
+        when journal is used it allows to skip fetching of pages which were not changed since previous run.
+        :param targets: list of `_CopyTarget` records, destinations of the page.
+        :param recursion_limit: remaining recursion limit of the page, children are not copied if it's exhausted.
+        :return: tuple of source page and list of `_CopyTarget` records for children of the page, one per target.
+        """
+        with self._metrics.phase('find'):
+            if self._journal is not None and src_summary is not None:
+                source = src_summary
+            else:
+                source = self._find_source_page(
+                    version=src_summary.get('version', {}).get('number') if src_summary else None, **src
+                )
+        if self._link_rewriter is not None:
+            space_key = source.get('space', {}).get('key')
+            self._link_rewriter.add(space_key, source['title'])
+            # children expanded together with the page are known before it's body is rewritten (unless they could be
+            # excluded by labels, which are not expanded there, or are not copied at all because of recursion limit)
+            if (recursion_limit is None or recursion_limit > 0) and (
+                    page_filter is None or not page_filter.exclude_labels
+            ):
+                for child in (self._expanded(source, 'children', 'page') or {}).get('results', []):
+                    if page_filter is None or not page_filter.excludes(child):
+                        self._link_rewriter.add(space_key, child['title'])
+
+        copies = list()
+        for target in targets:
+            with self._metrics.phase('find'):
+                dst_space_key, dst_title_template = self._init_destination_page(
+                    source, target.dst_space_key, target.dst_title_template
+                )
+                dst_title = dst_title_template.replace('{title}', source['title'])
+
+                journal_entry = self._get_journal_entry(source, dst_space_key, dst_title)
 
+            if journal_entry is not None and journal_entry['src_version'] == source['version']['number']:
+                self.log.info(u"Skipping '{space}/{title}' as it's not changed since previous run".format(
+                    space=dst_space_key, title=dst_title
+                ))
+                page_copy_id = journal_entry['dst_id']
+            else:
+                if source is src_summary:
+                    with self._metrics.phase('find'):
+                        source = self._find_source_page(content_id=source['id'], version=source['version']['number'])
+                content, unresolved = self._rewrite_links(source, dst_space_key, dst_title_template)
+                with self._metrics.phase('create'):
+                    page_copy_id = self._copy_page_content(
+                        content, dst_space_key, dst_title, target.dst_parent_id, target.dst_parent_title,
+                        target.ancestor_id, overwrite
+                    )
+                if unresolved and not self._dry_run:
+                    self._link_rewriter.defer(
+                        page_copy_id, source['body']['storage']['value'], unresolved, source['space']['key'],
+                        dst_space_key, dst_title_template
+                    )
+            copies.append((dst_space_key, dst_title_template, dst_title, page_copy_id, journal_entry))
+
+        # body is not needed anymore, so it's not kept while labels, attachments and children are copied
+        source = dict((key, value) for key, value in source.items() if key != 'body')
+
+        labels_digest = None
         if not skip_labels:
             # copy labels
-            self._copy_labels(source, page_copy_id)
+            with self._metrics.phase('labels'):
+                labels_digest = self._copy_labels(source, [
+                    (copy_id, entry['labels_digest'] if entry else None)
+                    for _, _, _, copy_id, entry in copies
+                ])
 
+        attachments = None
         if not skip_attachments:
             # copy attachments
-            self._copy_attachments(source, page_copy_id)
+            with self._metrics.phase('attachments'):
+                attachments = self._copy_attachments(source, [
+                    (copy_id, entry['attachments'] if entry else None)
+                    for _, _, _, copy_id, entry in copies
+                ])
+
+        copied = list()
+        for dst_space_key, dst_title_template, dst_title, page_copy_id, journal_entry in copies:
+            if self._journal is not None and not self._dry_run:
+                self._journal.record(
+                    src_id=source['id'],
+                    src_version=source['version']['number'],
+                    dst_space_key=dst_space_key,
+                    dst_title=dst_title,
+                    dst_id=page_copy_id,
+                    labels_digest=labels_digest,
+                    attachments=attachments
+                )
 
-        if recursion_limit is not None and recursion_limit <= 0:
-            self.log.debug("Breaking copy cycle as recursion limit is reached.")
-            return
+            copied.append(_CopyTarget(
+                dst_space_key=dst_space_key,
+                dst_title_template=dst_title_template,
+                dst_parent_id=None,
+                dst_parent_title=dst_title,
+                ancestor_id=page_copy_id
+            ))
 
-        # recursively copy children
-        children = self._client.get_content_children_by_type(content_id=source['id'], child_type='page')
-        if children and children.get('results'):
-            if recursion_limit is not None:
-                recursion_limit -= 1
+        self._metrics.page_copied(len(copied))
+        return source, copied
 
-            for child in children['results']:
-                self.copy(
-                    src={'content_id': child['id']},
-                    dst_space_key=dst_space_key,
-                    dst_title_template=dst_title_template,
-                    ancestor_id=page_copy_id,
-                    overwrite=overwrite,
-                    recursion_limit=recursion_limit,
-                    skip_labels=skip_labels,
-                    skip_attachments=skip_attachments
+    def _rewrite_links(self, source, dst_space_key, dst_title_template):
+        """
+        :return: tuple of source page with links to pages of the copied tree pointing to their copies and set of
+                 linked pages, which are not known yet.
+        """
+        if self._link_rewriter is None or 'body' not in source:
+            return source, None
+
+        body, unresolved = self._link_rewriter.rewrite(
+            source['body']['storage']['value'], source['space']['key'], dst_space_key, dst_title_template
+        )
+        return dict(source, body={'storage': {'value': body, 'representation': 'storage'}}), unresolved
+
+    def _patch_links(self):
+        """
+        Update copies of pages, which had links to pages copied after them. Only metadata of the copy is fetched,
+        body is rewritten from the source one, which was kept locally.
+        """
+        if self._link_rewriter is None:
+            return
+
+        with self._metrics.phase('links'):
+            for page_copy_id, body in self._link_rewriter.iter_patches():
+                page = self._client.get_content_by_id(content_id=page_copy_id, expand='space,version,ancestors')
+                self.log.info(u"Updating links of '{space}/{title}'".format(
+                    space=page['space']['key'], title=page['title']
+                ))
+                ancestor_id = page['ancestors'][-1]['id'] if page.get('ancestors') else None
+                page_copy = self._client.update_content_by_id(
+                    content_data={
+                        'id': page_copy_id,
+                        'type': page['type'],
+                        'space': {'key': page['space']['key']},
+                        'title': page['title'],
+                        'body': {'storage': {'value': body, 'representation': 'storage'}},
+                        'ancestors': [] if not ancestor_id else [{'id': ancestor_id}],
+                        'version': {'number': page['version']['number'] + 1},
+                    },
+                    content_id=page_copy_id
                 )
+                if self._index_destination:
+                    self._update_dst_index(page['space']['key'], page['title'], page_copy, ancestor_id)
+                self._cache.invalidate(self._cache_key(space_key=page['space']['key'], title=page['title']))
+
+    def _get_journal_entry(self, source, dst_space_key, dst_title):
+        """
+        :return: journal entry of previous copy of the page, if the copy still exists in destination.
+        """
+        if self._journal is None:
+            return None
+
+        journal_entry = self._journal.get(source['id'], dst_space_key, dst_title)
+        if journal_entry is not None and self._index_destination:
+            existing = self._find_dst_page(dst_space_key, dst_title)
+            if existing is None or unicode(existing['id']) != journal_entry['dst_id']:
+                self.log.debug(u"Copy of '{space}/{title}' from journal doesn't exist anymore".format(
+                    space=dst_space_key, title=dst_title
+                ))
+                return None
+        return journal_entry
+
+    def _copy_page_content(self, source, dst_space_key, dst_title, dst_parent_id, dst_parent_title, ancestor_id,
+                           overwrite):
+        """
+        Create copy of the page or overwrite existing one.
+        :return: id of the page copy.
+        """
+        if ancestor_id is None:
+            ancestor_id, dst_parent_title = self._resolve_ancestor(
+                source, dst_space_key, dst_parent_id, dst_parent_title
+            )
+
+        # check if page in selected space and with specific title already exists.
+        existing_dst_page = None
+        with self._metrics.phase('find'):
+            if not self._index_destination or self._find_dst_page(dst_space_key, dst_title):
+                existing_dst_page = self._find_page(space_key=dst_space_key, title=dst_title)
+        if existing_dst_page:
+            if overwrite:
+                page_copy = self._overwrite_page(source, ancestor_id, existing_dst_page, dst_space_key, dst_title)
+            else:
+                raise RuntimeError(u"Can't copy to '{space}/{title}' as it already exists!".format(
+                    space=dst_space_key,
+                    title=dst_title
+                ))
+        else:
+            page_copy = self._copy_page(source, ancestor_id, dst_space_key, dst_title, dst_parent_title)
+
+        if self._index_destination and not self._dry_run:
+            self._update_dst_index(dst_space_key, dst_title, page_copy, ancestor_id)
+        if not self._dry_run:
+            self._cache_copy(page_copy, source, dst_space_key, dst_title, ancestor_id)
+
+        if self._dry_run:
+            return source['id']
+        else:
+            return page_copy['id']
+
+    def _resolve_ancestor(self, source, dst_space_key, dst_parent_id, dst_parent_title):
+        """
+        Determine parent of the copy of the root page.
+        :return: tuple of id and title of the parent, id is `None` if the copy is created in the root of the space.
+        """
+        # ancestor_id determines parent of the page being copied. If it's not provided, we take it from source page.
+        # If source page doesn't have ancestors, that means that it's root page, so we will copy to the root as well.
+        if dst_parent_id is not None:
+            return dst_parent_id, dst_parent_title
+        elif dst_parent_title is not None:
+            with self._metrics.phase('find'):
+                dst_parent = self._find_page(space_key=dst_space_key, title=dst_parent_title)
+            return dst_parent['id'], dst_parent_title
+        elif self._source is None and source.get('ancestors') and source['space']['key'] == dst_space_key:
+            self.log.debug('Setting ancestor id to {}'.format(source['ancestors'][-1]['id']))
+            return source['ancestors'][-1]['id'], source['ancestors'][-1].get('title')
+        return None, dst_parent_title
+
+    def _cache_copy(self, page_copy, source, dst_space_key, dst_title, ancestor_id):
+        """
+        Put created or updated page to the cache, so following lookups of it (e.g. as parent) don't go to server and
+        cached "not found" result is replaced. Fields, which server didn't expand in response, are taken from
+        the copied data. If the page can't be restored completely, cached lookup is just invalidated.
+        """
+        key = self._cache_key(space_key=dst_space_key, title=dst_title)
+        if 'version' not in page_copy or 'body' not in source:
+            self._cache.invalidate(key)
+            return
+
+        page = dict(page_copy)
+        page.setdefault('space', {'key': dst_space_key})
+        page.setdefault('title', dst_title)
+        if 'storage' not in page.get('body', {}):
+            page['body'] = {'storage': {'value': source['body']['storage']['value'], 'representation': 'storage'}}
+        if 'ancestors' not in page:
+            page['ancestors'] = [] if not ancestor_id else [{'id': ancestor_id}]
+        self._cache.put(key, page)
+
+    def _iter_results(self, api_call, first_response=None, **kwargs):
+        """
+        Lazily iterate over all results of paginated `api_call`, following `_links.next` of each response.
+        Next page is requested in background while results of the current one are being processed.
+        :param first_response: already fetched first page of results (e.g. expanded collection of the page),
+                               `api_call` is used only to fetch the following pages.
+        """
+        if self._page_size is not None:
+            kwargs.setdefault('limit', self._page_size)
+
+        # requests are attributed to the phase in which iterator was created, even if results are consumed later
+        # or fetched in background
+        return self._iter_pages(api_call, first_response, self._metrics.current_phase(), kwargs)
+
+    def _iter_pages(self, api_call, response, phase, kwargs):
+        if response is None:
+            response = self._call_in_phase(phase, api_call, **kwargs)
+        while response:
+            next_page = None
+            if response.get('_links', {}).get('next'):
+                kwargs['start'] = response['start'] + response['size']
+                kwargs['limit'] = response['limit']
+                next_page = self._prefetcher.submit(self._call_in_phase, phase, api_call, **kwargs)
+
+            for result in response.get('results', []):
+                yield result
+
+            response = next_page.result() if next_page else None
+
+    def _call_in_phase(self, phase, api_call, **kwargs):
+        if phase is None:
+            return api_call(**kwargs)
+        with self._metrics.phase(phase):
+            return api_call(**kwargs)
+
+    def _find_dst_page(self, space_key, title):
+        """
+        Look up page in destination index, scanning whole destination space on first access to it.
+        :return: index record of the page or `None` if there is no page with such title.
+        """
+        with self._dst_index_lock:
+            if space_key not in self._dst_index:
+                self.log.debug(u"Indexing pages of destination space '{}'".format(space_key))
+                index = dict()
+                with self._metrics.phase('find'):
+                    for page in self._iter_results(self._client.get_content, content_type='page',
+                                                   space_key=space_key, expand=self.INDEX_EXPAND_FIELDS):
+                        index[page['title']] = {
+                            'id': page['id'],
+                            'version': page['version']['number'],
+                            'ancestor_id': page['ancestors'][-1]['id'] if page['ancestors'] else None,
+                        }
+                self.log.debug(u"Indexed {count} page(s) of space '{space}'".format(count=len(index), space=space_key))
+                self._dst_index[space_key] = index
+
+            return self._dst_index[space_key].get(title)
+
+    def _update_dst_index(self, space_key, title, page, ancestor_id):
+        with self._dst_index_lock:
+            if space_key in self._dst_index:
+                self._dst_index[space_key][title] = {
+                    'id': page['id'],
+                    'version': page['version']['number'],
+                    'ancestor_id': ancestor_id,
+                }
 
-    @cachedmethod('_cache')
-    def _find_page(self, content_id=None, space_key=None, title=None):
+    @staticmethod
+    def _expanded(page, *path):
+        """
+        :return: collection expanded in the page by `path` (e.g. 'children', 'page'), or `None` if it wasn't expanded.
+        """
+        for key in path:
+            if not isinstance(page, dict) or key not in page:
+                return None
+            page = page[key]
+        return page if isinstance(page, dict) and 'results' in page else None
+
+    def _iter_children(self, source, with_labels=False):
+        """
+        :param with_labels: expand labels of children, expanded children of the page are not used then.
+        """
+        with self._metrics.phase('children'):
+            return self._iter_results(
+                self._source_client.get_content_children_by_type,
+                first_response=None if with_labels else self._expanded(source, 'children', 'page'),
+                content_id=source['id'],
+                child_type='page',
+                expand=self.CHILDREN_EXPAND_FIELDS + (',' + self.LABELS_EXPAND_FIELD if with_labels else '')
+            )
 
+    def _find_source_page(self, version=None, **src):
+        if self._source is None:
+            if version is not None:
+                src['version'] = version
+            return self._find_page(**src)
+        return self._source.find_page(**src)
+
+    @staticmethod
+    def _cache_key(content_id=None, space_key=None, title=None):
         if content_id:
+            return 'id', unicode(content_id)
+
+        if space_key and not isinstance(space_key, unicode):
+            space_key = space_key.decode('utf-8')
+        if title and not isinstance(title, unicode):
+            title = title.decode('utf-8')
+        return 'title', space_key, title
+
+    def _find_page(self, content_id=None, space_key=None, title=None, version=None):
+        """
+        Find page by id or by title (and optionally space key), results are cached.
+        :param version: expected version of the page (e.g. from children listing). If body of this version is already
+                        known, page is fetched without body.
+        """
+        key = self._cache_key(content_id, space_key, title)
+        found, page = self._cache.get(key)
+        if found:
+            return page
+
+        if content_id:
+            page = self._fetch_page_by_id(content_id, version)
+            self._cache.put(key, page, persist=True)
+        else:
+            page = self._search_page(*key[1:])
+            self._cache.put(key, page)
+        return page
+
+    def _fetch_page_by_id(self, content_id, version=None):
+        body = self._cache.get_body(content_id, version) if version is not None else None
+        if body is None:
             self.log.debug("Searching page by id '{}'".format(content_id))
-            content = self._client.get_content_by_id(
+            return self._client.get_content_by_id(
                 content_id=content_id,
-                expand=self.EXPAND_FIELDS
+                expand=self._page_expand_fields
             )
-            return content
-        else:
-            assert space_key or title, "Can't search page without space key or title!"
 
-            if space_key and not isinstance(space_key, unicode):
-                space_key = space_key.decode('utf-8')
+        self.log.debug("Searching page by id '{}' without body".format(content_id))
+        page = self._client.get_content_by_id(
+            content_id=content_id,
+            expand=self._page_expand_fields.replace(self.BODY_EXPAND_FIELD + ',', '')
+        )
+        if page['version']['number'] != version:
+            # page was changed after listing
+            body = self._cache.get_body(content_id, page['version']['number'])
+            if body is None:
+                body = self._client.get_content_by_id(
+                    content_id=content_id, expand=self.BODY_EXPAND_FIELD
+                )['body']['storage']['value']
+        page['body'] = {'storage': {'value': body, 'representation': 'storage'}}
+        return page
+
+    def _search_page(self, space_key, title, expand=EXPAND_FIELDS):
+        assert space_key or title, "Can't search page without space key or title!"
+        self.log.debug(u"Searching page by{space}{and_msg}{title}".format(
+            space=u" space '%s'" % space_key if space_key else '',
+            and_msg=u" and" if space_key and title else '',
+            title=u" title '%s'" % title if title else ''
+        ))
+        content = self._client.get_content(
+            space_key=space_key, title=title,
+            expand=expand
+        )
 
-            if not isinstance(title, unicode):
-                title = title.decode('utf-8')
-            self.log.debug(u"Searching page by{space}{and_msg}{title}".format(
-                space=u" space '%s'" % space_key if space_key else '',
-                and_msg=u" and" if space_key and title else '',
-                title=u" title '%s'" % title if title else ''
-            ))
-            content = self._client.get_content(
-                space_key=space_key, title=title,
-                expand=self.EXPAND_FIELDS
+        self.log.debug('Found {} page(s)'.format(content['size']))
+        if content['size'] == 0:
+            return None
+        elif content['size'] == 1:
+            return content['results'][0]
+        else:
+            spaces = set([r['space']['name'] for r in content['results']])
+            raise ValueError(
+                "Unexpected result count: {count}, possibly you have to specify space to search in. "
+                "Results includes these spaces: {spaces}".format(
+                    count=content['size'], spaces=', '.join(spaces))
             )
 
-            self.log.debug('Found {} page(s)'.format(content['size']))
-            if content['size'] == 0:
-                return None
-            elif content['size'] == 1:
-                return content['results'][0]
-            else:
-                spaces = set([r['space']['name'] for r in content['results']])
-                raise ValueError(
-                    "Unexpected result count: {count}, possibly you have to specify space to search in. "
-                    "Results includes these spaces: {spaces}".format(
-                        count=content['size'], spaces=', '.join(spaces))
-                )
-
     def _init_destination_page(self, source, dst_space_key, title_template):
         if not dst_space_key:
             src_space_key = source['space']['key']
@@ -198,19 +1599,39 @@ class ConfluencePageCopier(object):
         return dst_space_key, unicode(title_template)
 
     def _get_title_counter(self, space_key, title, template):
-        counter = 0
+        """
+        Reserve next free counter for the title. Destination space is searched only once for every title, after that
+        counters are allocated locally, so multiple copies don't depend on search index being up to date.
+        """
         template = template.replace(self.TITLE_FIELD, title)
+        key = (space_key, template)
+        with self._counters_lock:
+            if key not in self._counters:
+                self._counters[key] = self._find_max_title_counter(space_key, title, template) + 1
+            counter = self._counters[key]
+            self._counters[key] += 1
+        return counter
+
+    def _find_max_title_counter(self, space_key, title, template):
+        """
+        :return: maximal counter of existing pages with titles matching the template, 0 if there are no such pages.
+        """
         template = re.escape(template)
-        template = template.replace(re.escape(self.COUNTER_FIELD), '\d+')
+        template = template.replace(re.escape(self.COUNTER_FIELD), '(\d+)')
         regex = re.compile(u"^{template}$".format(template=template))
-        search_results = self._client.search_content(cql_str='space = "{space}" and title ~ "{title}"'.format(
-            space=space_key.encode('utf-8'), title=urllib.quote_plus(title.encode('utf-8'))
-        ))
-        for result in search_results['results']:
-            if regex.match(result['title']):
-                counter += 1
+        search_results = self._iter_results(
+            self._client.search_content,
+            cql_str='space = "{space}" and title ~ "{title}"'.format(
+                space=space_key.encode('utf-8'), title=urllib.quote_plus(title.encode('utf-8'))
+            )
+        )
+        counter = 0
+        for result in search_results:
+            match = regex.match(result['title'])
+            if match:
+                counter = max(counter, int(match.group(1)))
 
-        return counter + 1
+        return counter
 
     def _overwrite_page(self, source, ancestor_id, existing_dst_page, dst_space_key, dst_title):
         is_page_equal = True
@@ -218,7 +1639,8 @@ class ConfluencePageCopier(object):
             source['body']['storage']['value'] == existing_dst_page['body']['storage']['value']
         )
         # TODO: https://answers.atlassian.com/questions/5278993/answers/11442314
-        is_page_equal = is_page_equal and ancestor_id == existing_dst_page['ancestors'][-1]['id']
+        existing_ancestors = existing_dst_page.get('ancestors')
+        is_page_equal = is_page_equal and ancestor_id == (existing_ancestors[-1]['id'] if existing_ancestors else None)
 
         if is_page_equal:
             self.log.info("Skipping '{space}/{title}' overwrite, as it's the same as original".format(
@@ -255,25 +1677,17 @@ class ConfluencePageCopier(object):
 
         return page_copy
 
-    def _copy_page(self, source, ancestor_id, dst_space_key, dst_title):
-        src_parent_page = None
-        dst_parent_page = None
-
-        if source['ancestors']:
-            src_parent_page = self._find_page(content_id=source['ancestors'][0]['id'])
-        if ancestor_id:
-            dst_parent_page = self._find_page(content_id=ancestor_id)
-
+    def _copy_page(self, source, ancestor_id, dst_space_key, dst_title, dst_parent_title=None):
         self.log.info(
             (
                 u"Copying [{src_space}]:'{src_parent_title}'/'{src_title}' => "
                 u"[{dst_space}]:'{dst_parent_title}'/'{dst_title}'"
             ).format(
                 src_space=source['space']['key'],
-                src_parent_title=src_parent_page['title'] if src_parent_page else '',
+                src_parent_title=source['ancestors'][-1].get('title', '') if source.get('ancestors') else '',
                 src_title=source['title'],
                 dst_space=dst_space_key,
-                dst_parent_title=dst_parent_page['title'] if dst_parent_page else '',
+                dst_parent_title=dst_parent_title or ancestor_id or '',
                 dst_title=dst_title,
             ))
         page_copy = self._client.create_new_content({
@@ -291,61 +1705,285 @@ class ConfluencePageCopier(object):
 
         return page_copy
 
-    def _copy_labels(self, source, page_copy_id):
+    def _copy_labels(self, source, destinations):
+        """
+        Read labels of the source page once and add them to all copies of the page.
+        :param destinations: list of tuples of page copy id and digest of labels copied there by previous run,
+                             labels are not copied if they are the same.
+        :return: digest of source labels.
+        """
+        labels, digest = self._source_labels(source)
+        for page_copy_id, copied_digest in destinations:
+            if digest == copied_digest:
+                self.log.debug("Skipping labels as they are not changed since previous run")
+            elif labels:
+                self.log.info("Copying {} label(s)".format(len(labels)))
+                self._client.create_new_label_by_content_id(content_id=page_copy_id, label_names=labels)
+
+        return digest
+
+    def _source_labels(self, source):
+        """
+        :return: tuple of list of labels of the source page and their digest.
+        """
         labels = list()
-        for label in self._client.get_content_labels(content_id=source['id'])['results']:
+        for label in self._iter_results(self._source_client.get_content_labels, content_id=source['id'],
+                                        first_response=self._expanded(source, 'metadata', 'labels')):
             labels.append({'prefix': label['prefix'], 'name': label['name']})
-        if labels:
-            self.log.info("Copying {} label(s)".format(len(labels)))
-            self._client.create_new_label_by_content_id(content_id=page_copy_id, label_names=labels)
-
-    def _copy_attachments(self, source, page_copy_id):
-        src_attachments = self._client.get_content_attachments(content_id=source['id'])['results']
-        if not src_attachments:
-            return
 
-        if self._dry_run:
-            dst_attachments = list()
-        else:
-            dst_attachments = self._client.get_content_attachments(content_id=page_copy_id)['results']
+        digest = hashlib.sha1(
+            u'\n'.join(sorted(u'{prefix}:{name}'.format(**label) for label in labels)).encode('utf-8')
+        ).hexdigest()
+        return labels, digest
+
+    @staticmethod
+    def _attachment_marker(attachment):
+        """
+        :return: string, which changes whenever new version of attachment is uploaded.
+        """
+        return u'{id}:{version}:{size}'.format(
+            id=attachment.get('id'),
+            version=attachment.get('version', {}).get('number'),
+            size=attachment.get('extensions', {}).get('fileSize')
+        )
 
-        self.log.info("Copying {} attachment(s)".format(len(src_attachments)))
+    def _copy_attachments(self, source, destinations):
+        """
+        Copy attachments of the source page to all copies of the page. Every attachment is downloaded once and the
+        same spooled content is uploaded to every copy, which needs it.
+        :param destinations: list of tuples of page copy id and attachment title -> marker of attachments copied there
+                             by previous run, which are not copied again unless they are changed.
+        :return: attachment title -> marker of copied source attachments.
+        """
+        markers = dict()
+        src_attachments = list()
+        for attachment in self._iter_source_attachments(source):
+            markers[attachment['title']] = self._attachment_marker(attachment)
+            src_attachments.append(attachment)
+
+        # tuples of page copy id, titles of attachments to copy there and existing attachments by title
+        required = list()
+        for page_copy_id, copied in destinations:
+            copied = copied or dict()
+            titles = set()
+            for attachment in src_attachments:
+                if copied.get(attachment['title']) == markers[attachment['title']]:
+                    self.log.debug(u"Skipping '{}' attachment as it's not changed since previous run".format(
+                        attachment['title']
+                    ))
+                else:
+                    titles.add(attachment['title'])
+            if not titles:
+                continue
+
+            if self._dry_run:
+                dst_attachments = list()
+            else:
+                dst_attachments = list(self._iter_results(self._client.get_content_attachments,
+                                                          content_id=page_copy_id,
+                                                          expand=self.ATTACHMENT_EXPAND_FIELDS))
+            dst_attachments = dict((attach['title'], attach) for attach in dst_attachments)
+            required.append((page_copy_id, titles, dst_attachments))
+        if not required:
+            return markers
+
+        self.log.info("Copying {} attachment(s)".format(
+            len(set.union(*[required_titles for _, required_titles, _ in required]))
+        ))
 
         for attachment in src_attachments:
             attachment_name = attachment['title'].encode('utf8')
             attachment_type = attachment.get('metadata', {}).get('mediaType', u'')
             attachment_comment = attachment.get('metadata', {}).get('comment', u'')
-            self.log.debug("Downloading '{name}' attachment".format(name=attachment_name))
 
-            if not self._dry_run:
-                link_name = attachment['_links']['download'][1:].encode('utf8')
-                content = self._client._service_get_request(sub_uri=link_name, raw=True)
-            else:
-                content = None
-
-            for attach in dst_attachments:
-                if attachment['title'] == attach['title']:
-                    self.log.debug("Updating existing attachment '{name}'".format(name=attachment_name))
-
-                    self._client.update_attachment(
-                        content_id=page_copy_id,
-                        attachment_id=attach['id'],
-                        attachment={
-                            'file': (attachment_name, content, attachment_type),
-                            'comment': attachment_comment
-                        }
-                    )
-                    break
-            else:
-                self.log.debug("Creating new attachment '{name}'".format(name=attachment_name))
-                self._client.create_new_attachment_by_content_id(
-                    content_id=page_copy_id,
-                    attachments={
-                        'file': (attachment_name, content, attachment_type),
-                        'comment': attachment_comment
-                    }
+            uploads = list()
+            for page_copy_id, titles, dst_attachments in required:
+                if attachment['title'] not in titles:
+                    continue
+                existing_attachment = dst_attachments.get(attachment['title'])
+                if existing_attachment is not None and self._is_attachment_equal(attachment, existing_attachment):
+                    self.log.debug("Skipping '{name}' attachment as it's the same as original".format(
+                        name=attachment_name
+                    ))
+                    self._update_attachment_stats('skipped', attachment['extensions']['fileSize'])
+                else:
+                    uploads.append((page_copy_id, existing_attachment))
+            if not uploads:
+                continue
+
+            spool = self._download_attachment(attachment)
+            try:
+                spool.seek(0, os.SEEK_END)
+                size = spool.tell()
+
+                body = MultipartAttachmentStream(
+                    name=attachment_name,
+                    fileobj=spool,
+                    content_type=attachment_type,
+                    comment=attachment_comment
                 )
 
+                for page_copy_id, existing_attachment in uploads:
+                    self._upload_attachment(body, size, page_copy_id, existing_attachment)
+            finally:
+                spool.close()
+
+        return markers
+
+    def _iter_source_attachments(self, source):
+        return self._iter_results(self._source_client.get_content_attachments, content_id=source['id'],
+                                  expand=self.ATTACHMENT_EXPAND_FIELDS,
+                                  first_response=self._expanded(source, 'children', 'attachment'))
+
+    def _upload_attachment(self, body, size, page_copy_id, existing_attachment):
+        """
+        Upload attachment `body` to the page copy, as new version of `existing_attachment` if it's set.
+        """
+        body.rewind()
+        if existing_attachment is not None:
+            self.log.debug("Updating existing attachment '{name}'".format(name=body.name))
+            self._client.update_attachment_stream(
+                content_id=page_copy_id,
+                attachment_id=existing_attachment['id'],
+                attachment=body
+            )
+        else:
+            self.log.debug("Creating new attachment '{name}'".format(name=body.name))
+            self._client.create_new_attachment_stream_by_content_id(
+                content_id=page_copy_id,
+                attachment=body
+            )
+        self._update_attachment_stats('transferred', size)
+
+    @staticmethod
+    def _attachment_keys(attachment):
+        """
+        :return: keys of attachment content in attachment spool: exact one (id and version) and the one identifying
+                 duplicates attached to other pages (title, size and media type).
+        """
+        keys = [('id', attachment.get('id'), attachment.get('version', {}).get('number'))]
+        size = attachment.get('extensions', {}).get('fileSize')
+        if size is not None:
+            keys.append(('content', attachment['title'], size, attachment.get('metadata', {}).get('mediaType')))
+        return keys
+
+    def _download_attachment(self, attachment):
+        """
+        Download attachment content or take it from attachment spool, if the same content was downloaded before.
+        :return: file object with attachment content.
+        """
+        attachment_name = attachment['title'].encode('utf8')
+        if self._dry_run:
+            return tempfile.SpooledTemporaryFile(max_size=self._attachment_spool_size)
+
+        keys = None
+        if self._attachment_spool is not None:
+            keys = self._attachment_keys(attachment)
+            spooled = self._attachment_spool.open(keys)
+            if spooled is not None:
+                self.log.debug("Taking '{name}' attachment from spool".format(name=attachment_name))
+                spooled.seek(0, os.SEEK_END)
+                self._update_attachment_stats('reused', spooled.tell())
+                return spooled
+            fileobj = self._attachment_spool.create()
+        else:
+            fileobj = tempfile.SpooledTemporaryFile(max_size=self._attachment_spool_size)
+
+        try:
+            self.log.debug("Downloading '{name}' attachment".format(name=attachment_name))
+            link_name = attachment['_links']['download'][1:].encode('utf8')
+            self._source_client.download_attachment(
+                download_link=link_name,
+                fileobj=fileobj,
+                chunk_size=MultipartAttachmentStream.CHUNK_SIZE
+            )
+        except Exception:
+            if keys is not None:
+                self._attachment_spool.discard(fileobj)
+            else:
+                fileobj.close()
+            raise
+
+        if keys is not None:
+            return self._attachment_spool.store(keys, fileobj)
+        return fileobj
+
+    def _is_attachment_equal(self, attachment, existing_attachment):
+        """
+        Compare source attachment with existing one in destination by metadata only, without downloading content.
+        Attachments are considered equal if they have the same size and media type and destination version was
+        uploaded after the source one.
+        """
+        src_size = attachment.get('extensions', {}).get('fileSize')
+        dst_size = existing_attachment.get('extensions', {}).get('fileSize')
+        if src_size is None or src_size != dst_size:
+            return False
+
+        if attachment.get('metadata', {}).get('mediaType') != existing_attachment.get('metadata', {}).get('mediaType'):
+            return False
+
+        src_when = self._parse_timestamp(attachment.get('version', {}).get('when'))
+        dst_when = self._parse_timestamp(existing_attachment.get('version', {}).get('when'))
+        return src_when is not None and dst_when is not None and dst_when >= src_when
+
+    @classmethod
+    def _parse_timestamp(cls, value):
+        """
+        Convert Confluence timestamp (e.g. '2016-06-17T15:37:02.000+03:00') to UTC unix time.
+        """
+        match = cls.TIMESTAMP_RE.match(value or '')
+        if not match:
+            return None
+
+        timestamp = calendar.timegm(time.strptime(match.group('datetime'), '%Y-%m-%dT%H:%M:%S'))
+        if match.group('sign'):
+            offset = int(match.group('hours')) * 3600 + int(match.group('minutes')) * 60
+            timestamp += -offset if match.group('sign') == '+' else offset
+        return timestamp
+
+    def _update_attachment_stats(self, action, size):
+        with self._attachment_stats_lock:
+            self._attachment_stats[action] += 1
+            self._attachment_stats[action + '_bytes'] += size
+
+    def log_attachment_summary(self):
+        with self._attachment_stats_lock:
+            self.log.info(
+                "Attachments: {transferred} transferred ({transferred_bytes} bytes), "
+                "{skipped} skipped as identical ({skipped_bytes} bytes), "
+                "{reused} taken from spool without download ({reused_bytes} bytes)".format(**self._attachment_stats)
+            )
+
+    def close(self):
+        """
+        Release local resources: attachment spool, page store, journal and deferred link patches.
+        """
+        if self._attachment_spool is not None:
+            self._attachment_spool.close()
+        self._cache.close()
+        if self._journal is not None:
+            self._journal.close()
+        if self._link_rewriter is not None:
+            self._link_rewriter.close()
+
+    def write_metrics_report(self, json_path=None, prometheus_path=None):
+        """
+        Stop progress reporting, log summary of the copy and write statistics of API calls.
+        :param json_path: path of JSON report.
+        :param prometheus_path: path of report in Prometheus text format (e.g. for node exporter textfile collector).
+        """
+        self._metrics.stop_progress()
+        report = self._metrics.report()
+        self.log.info("Copied {pages} page(s) in {elapsed_seconds}s ({pages_per_sec} pages/sec)".format(**report))
+        for phase, stats in sorted(report['phases'].items()):
+            self.log.debug("Phase '{phase}': {calls} call(s), {requests} request(s), {errors} error(s), "
+                           "{seconds:.3f}s in API calls".format(phase=phase, **stats))
+
+        if json_path:
+            self._metrics.write_json(json_path)
+        if prometheus_path:
+            self._metrics.write_prometheus(prometheus_path)
+
 
 def init_args():
     parser = argparse.ArgumentParser(description='Script for smart copying Confluence pages.')
@@ -387,18 +2025,26 @@ def init_args():
         help='Source page title. Should unambiguously determine page.'
     )
 
+    parser.add_argument(
+        '--src-export',
+        help=(
+            'Path to Confluence XML export (zip archive). If set, source pages are read from the export instead of '
+            'Confluence server, `--src-id`, `--src-space` and `--src-title` are looked up in the export.'
+        )
+    )
+
     parser.add_argument(
         '--dst-space',
         help='Destination page space. If not set, then source space will be used (after it will be found).')
     parser.add_argument(
         '--dst-title-template',
-        default=ConfluencePageCopier.DEFAULT_TEMPLATE,
         help=(
             "Destination page title template. "
             "This parameter supports meta variables: '{title}' and '{counter}'. "
             "You can use this parameter to set various suffixes/prefixes for resulting pages. "
             "Also, '{counter}' parameter allows you to create multiple copies of the same page "
-            "incrementing counter in title.".format(
+            "incrementing counter in title. Default is '{default}', or '{title}' with `--sync`.".format(
+                default=ConfluencePageCopier.DEFAULT_TEMPLATE,
                 title=ConfluencePageCopier.TITLE_FIELD, counter=ConfluencePageCopier.COUNTER_FIELD
             )
         )
@@ -432,6 +2078,17 @@ def init_args():
     parser.add_argument('--skip-attachments', action="store_true", default=False,
                         help='Use this flag to skip attachments copying.')
 
+    parser.add_argument('--skip-dst-index', action="store_true", default=False,
+                        help='Use this flag to check existence of every destination page with separate request '
+                             'instead of indexing titles of whole destination space once. Could be faster when '
+                             'copying few pages into a big space.')
+
+    parser.add_argument('--journal',
+                        help='Path to journal (SQLite database) of copied pages. Pages, which were not changed since '
+                             'previous run with the same journal, are skipped and only changed labels and '
+                             'attachments are copied. This way interrupted copy could be resumed and repeated runs '
+                             'synchronise only the difference.')
+
     parser.add_argument('--recursion-limit', type=int, default=None,
                         help='Set recursion limit for copying pages. Setting thin parameter you can choose '
                              'how deep should script go when copying pages. By default limit is not set and all '
@@ -439,7 +2096,182 @@ def init_args():
                              'any children. Setting to 1 will copy only direct pages etc.'
                         )
 
-    return parser.parse_args()
+    parser.add_argument('--attachment-spool-size', type=int, default=ConfluencePageCopier.DEFAULT_ATTACHMENT_SPOOL_SIZE,
+                        help='Attachments are transferred by chunks. Attachments up to this size (in bytes) are kept '
+                             'in memory during transfer, bigger ones are spilled to temporary file.'
+                        )
+
+    parser.add_argument('--attachment-cache-size', type=int, default=None,
+                        help='Keep downloaded attachments in local spool of this size (in bytes), so attachment '
+                             'with the same title, size and media type attached to other pages is uploaded from '
+                             'the spool without downloading it again. By default attachments are downloaded for '
+                             'every page.'
+                        )
+
+    parser.add_argument('--page-size', type=int, default=None,
+                        help='Number of results requested per page from paginated endpoints (children, labels, '
+                             'attachments, search). Bigger value means less requests, but bigger responses. '
+                             'By default server limit is used.'
+                        )
+
+    parser.add_argument('--pool-size', type=int, default=ConfluenceAPIDryRunProxy.DEFAULT_POOL_SIZE,
+                        help='Number of HTTP connections kept alive for reuse. Should be not less than number of '
+                             'workers.'
+                        )
+
+    parser.add_argument('--max-retries', type=int, default=ConfluenceAPIDryRunProxy.DEFAULT_MAX_RETRIES,
+                        help='Number of retries of failed request. Requests are retried with jittered exponential '
+                             'backoff. Requests modifying data are retried only if server rejected them with '
+                             '429 or 503 status.'
+                        )
+
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximal number of requests per second. Regardless of this parameter rate is lowered '
+                             'automatically, when server responds with 429 or 503 status, and restored gradually '
+                             'after that.'
+                        )
+
+    parser.add_argument('--skip-link-rewrite', action="store_true", default=False,
+                        help='Use this flag to copy page bodies as is. By default links to pages of the copied tree '
+                             'are rewritten to point to their copies.'
+                        )
+
+    parser.add_argument('--separate-fetch', action="store_true", default=False,
+                        help='Use this flag to fetch labels, attachments and children of every page with separate '
+                             'requests, instead of expanding them in the same request as the page.'
+                        )
+
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of parallel workers used for copying. Page is copied as soon as its parent is '
+                             'copied, so siblings and whole subtrees are copied in parallel. By default pages are '
+                             'copied one by one.'
+                        )
+
+    parser.add_argument('--target', nargs='+', action='append', metavar=('SPACE', 'PARENT TEMPLATE'),
+                        help='Destination of the copy: space key, optionally followed by parent page (id or title, '
+                             'empty string for no parent) and title template. Could be repeated to copy the same tree '
+                             'into many destinations, source pages and attachments are read only once for all of '
+                             'them. If set, `--dst-space`, `--dst-parent-id` and `--dst-parent-title` are ignored, '
+                             '`--dst-title-template` is used for targets without template.'
+                        )
+
+    parser.add_argument('--copies', type=int, default=None,
+                        help="Number of copies of the page tree to create. Source tree is read only once and every "
+                             "page is written to all copies. Title template should contain '{counter}', which is "
+                             "different in every copy.".format(counter=ConfluencePageCopier.COUNTER_FIELD)
+                        )
+
+    parser.add_argument('--cache-size', type=int, default=PageCache.DEFAULT_SIZE,
+                        help='Maximal total size (in bytes) of page bodies kept in memory cache. Least recently used '
+                             'pages are evicted first.'
+                        )
+
+    parser.add_argument('--page-store',
+                        help='Path to persistent store (SQLite database) of source page bodies, keyed by page id and '
+                             'version. On repeated run bodies of unchanged pages are taken from the store, so only '
+                             'page metadata is requested.'
+                        )
+
+    parser.add_argument('--metrics-json',
+                        help='Path to JSON report with number of calls, errors, latency histograms and transferred '
+                             'bytes of every API method and every copy phase (find, create, labels, attachments, '
+                             'children).'
+                        )
+
+    parser.add_argument('--metrics-prometheus',
+                        help='Path to the same report in Prometheus text format, e.g. for textfile collector of '
+                             'node exporter.'
+                        )
+
+    parser.add_argument('--whole-space', action="store_true", default=False,
+                        help='Copy all page trees of `--src-space` (or of the export) instead of single page. '
+                             'Top-level pages are listed while trees are being copied, and all trees share caches '
+                             'and destination index.'
+                        )
+
+    parser.add_argument('--include-title', action='append', metavar='PATTERN',
+                        help="With `--whole-space`, copy only top-level pages with titles matching shell-style "
+                             "pattern (e.g. 'Project*'). Could be repeated."
+                        )
+
+    parser.add_argument('--exclude-title', action='append', metavar='PATTERN',
+                        help="Skip pages with titles matching shell-style pattern (e.g. 'Draft*') together with "
+                             "their children. Could be repeated."
+                        )
+
+    parser.add_argument('--include-label', action='append', metavar='LABEL',
+                        help='With `--whole-space`, copy only top-level pages with the label. Could be repeated.'
+                        )
+
+    parser.add_argument('--exclude-label', action='append', metavar='LABEL',
+                        help='Skip pages with the label together with their children. Could be repeated. Children '
+                             'are listed with separate request then, as labels of children are not expanded with '
+                             'the page.'
+                        )
+
+    parser.add_argument('--sync', action="store_true", default=False,
+                        help='Synchronise existing copy with the source tree instead of copying it again. Trees are '
+                             'compared by page versions and parents without fetching bodies, and only new, changed, '
+                             'moved and renamed pages are written. Requires `--journal` to match copies to source '
+                             'pages, copies without journal entry are found by title and compared with the source '
+                             'once. Title template should not contain counter, by default copies have the same titles '
+                             'as source pages, so it should be set when synchronising within the same space.'
+                        )
+
+    parser.add_argument('--delete', action="store_true", default=False,
+                        help='Delete pages of destination tree, which were deleted (or moved out of the tree) in '
+                             'source. Used with `--sync` only.'
+                        )
+
+    parser.add_argument('--plan',
+                        help='Path to plan of the copy (JSON lines of create, update, skip, labels and attachment '
+                             'operations with their dependencies). If set, source tree and destination are only '
+                             'walked and the plan is written there instead of copying, expected number of requests '
+                             'and bytes is logged.'
+                        )
+
+    parser.add_argument('--execute-plan',
+                        help='Path to plan written with `--plan` to execute. Source and destination parameters are '
+                             'ignored, `--workers` operations are run in parallel as soon as operations they depend '
+                             'on are done. Results of done operations are saved next to the plan, so repeated '
+                             'execution continues from where previous one stopped. Copied pages, labels and '
+                             'attachments are recorded in `--journal`, so the next plan skips them.'
+                        )
+
+    parser.add_argument('--resume-from', type=int, default=None,
+                        help='Id of plan operation to start execution from, operations before it are treated as '
+                             'done.'
+                        )
+
+    parser.add_argument('--progress-interval', type=float, default=None,
+                        help='Log number of copied pages and current pages per second every given number of seconds. '
+                             'By default progress is not logged.'
+                        )
+
+    args = parser.parse_args()
+    if args.target and any(len(target) > 3 for target in args.target):
+        parser.error('--target accepts space key, parent page and title template only')
+    if args.sync and not args.journal:
+        parser.error('--sync requires --journal')
+    if args.copies is not None and args.copies < 1:
+        parser.error('--copies should be at least 1')
+    if args.whole_space and not args.src_space and not args.src_export:
+        parser.error('--whole-space requires --src-space or --src-export')
+    return args
+
+
+def parse_target(values, default_template):
+    """
+    Convert `--target` values (space key and optional parent page and title template) to target of
+    `ConfluencePageCopier.copy`. Numeric parent is treated as page id, any other as page title.
+    """
+    space_key, parent, template = (list(values) + [None, None])[:3]
+    return {
+        'dst_space_key': space_key,
+        'dst_title_template': template or default_template,
+        'dst_parent_id': parent if parent and parent.isdigit() else None,
+        'dst_parent_title': parent if parent and not parent.isdigit() else None,
+    }
 
 
 if __name__ == '__main__':
@@ -452,21 +2284,81 @@ if __name__ == '__main__':
         username=args.username,
         password=args.password,
         uri_base=args.endpoint,
-        dry_run=args.dry_run
+        dry_run=args.dry_run,
+        attachment_spool_size=args.attachment_spool_size,
+        page_size=args.page_size,
+        index_destination=not args.skip_dst_index,
+        journal_path=args.journal,
+        pool_size=args.pool_size,
+        max_retries=args.max_retries,
+        rate_limit=args.rate_limit,
+        consolidated_fetch=not args.separate_fetch,
+        source=XmlExportSource(args.src_export) if args.src_export else None,
+        progress_interval=args.progress_interval,
+        cache_size=args.cache_size,
+        page_store_path=args.page_store,
+        attachment_cache_size=args.attachment_cache_size,
+        rewrite_links=not args.skip_link_rewrite
     )
 
-    copier.copy(
-        src={
-            'title': args.src_title,
-            'space_key': args.src_space,
-            'content_id': args.src_id,
-        },
-        dst_space_key=args.dst_space,
-        dst_title_template=args.dst_title_template,
-        dst_parent_id=args.dst_parent_id,
-        dst_parent_title=args.dst_parent_title,
-        overwrite=args.overwrite,
-        skip_labels=args.skip_labels,
-        skip_attachments=args.skip_attachments,
-        recursion_limit=args.recursion_limit
-    )
+    src = {
+        'title': args.src_title,
+        'space_key': args.src_space,
+        'content_id': args.src_id,
+    }
+    if args.execute_plan:
+        copier.execute_plan(args.execute_plan, workers=args.workers, resume_from=args.resume_from)
+    elif args.sync:
+        copier.sync(
+            src=src,
+            dst_space_key=args.dst_space,
+            dst_title_template=args.dst_title_template,
+            dst_parent_id=args.dst_parent_id,
+            dst_parent_title=args.dst_parent_title,
+            delete=args.delete,
+            skip_labels=args.skip_labels,
+            skip_attachments=args.skip_attachments,
+            recursion_limit=args.recursion_limit
+        )
+    elif args.plan:
+        copier.plan(
+            args.plan,
+            src=src,
+            dst_space_key=args.dst_space,
+            dst_title_template=args.dst_title_template,
+            dst_parent_id=args.dst_parent_id,
+            dst_parent_title=args.dst_parent_title,
+            overwrite=args.overwrite,
+            skip_labels=args.skip_labels,
+            skip_attachments=args.skip_attachments,
+            recursion_limit=args.recursion_limit
+        )
+    else:
+        page_filter = PageFilter(
+            include_titles=args.include_title,
+            exclude_titles=args.exclude_title,
+            include_labels=args.include_label,
+            exclude_labels=args.exclude_label
+        )
+        settings = dict(
+            dst_space_key=args.dst_space,
+            dst_title_template=args.dst_title_template,
+            dst_parent_id=args.dst_parent_id,
+            dst_parent_title=args.dst_parent_title,
+            overwrite=args.overwrite,
+            skip_labels=args.skip_labels,
+            skip_attachments=args.skip_attachments,
+            recursion_limit=args.recursion_limit,
+            workers=args.workers,
+            copies=args.copies,
+            targets=[
+                parse_target(target, args.dst_title_template) for target in args.target
+            ] if args.target else None
+        )
+        if args.whole_space:
+            copier.copy_space(args.src_space, page_filter=page_filter, **settings)
+        else:
+            copier.copy(src=src, page_filter=page_filter, **settings)
+    copier.log_attachment_summary()
+    copier.write_metrics_report(json_path=args.metrics_json, prometheus_path=args.metrics_prometheus)
+    copier.close()
@@ -0,0 +1,114 @@
+# coding=utf-8
+import json
+import sqlite3
+import threading
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class CopyJournal(object):
+    """
+    Persistent journal of copied pages, stored in SQLite database.
+    For every copied page it keeps source version, id of the copy and state of copied labels and attachments,
+    so repeated run can skip pages which were not changed since previous one and copy only the difference.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            src_id TEXT NOT NULL,
+            dst_space_key TEXT NOT NULL,
+            dst_title TEXT NOT NULL,
+            src_version INTEGER NOT NULL,
+            dst_id TEXT NOT NULL,
+            labels_digest TEXT,
+            attachments TEXT,
+            PRIMARY KEY (src_id, dst_space_key, dst_title)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(self.SCHEMA)
+
+    def get(self, src_id, dst_space_key, dst_title):
+        """
+        :return: journal entry of the page copy as dictionary or `None` if page wasn't copied yet.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT * FROM pages WHERE src_id = ? AND dst_space_key = ? AND dst_title = ?',
+                (unicode(src_id), dst_space_key, dst_title)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        entry = dict(zip(row.keys(), row))
+        entry['attachments'] = json.loads(entry['attachments']) if entry['attachments'] else {}
+        return entry
+
+    def find(self, src_id, dst_space_key):
+        """
+        :return: list of journal entries of all copies of the page in destination space.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT * FROM pages WHERE src_id = ? AND dst_space_key = ?', (unicode(src_id), dst_space_key)
+            ).fetchall()
+
+        entries = list()
+        for row in rows:
+            entry = dict(zip(row.keys(), row))
+            entry['attachments'] = json.loads(entry['attachments']) if entry['attachments'] else {}
+            entries.append(entry)
+        return entries
+
+    def remove(self, src_id, dst_space_key, dst_title):
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM pages WHERE src_id = ? AND dst_space_key = ? AND dst_title = ?',
+                (unicode(src_id), dst_space_key, dst_title)
+            )
+
+    def record(self, src_id, src_version, dst_space_key, dst_title, dst_id, labels_digest=None, attachments=None):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO pages '
+                '(src_id, dst_space_key, dst_title, src_version, dst_id, labels_digest, attachments) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    unicode(src_id), dst_space_key, dst_title, src_version, unicode(dst_id), labels_digest,
+                    json.dumps(attachments or {}, sort_keys=True)
+                )
+            )
+
+    def update(self, src_id, dst_space_key, dst_title, labels_digest=None, attachment=None):
+        """
+        Update state of copied labels and attachments of already recorded page copy, does nothing if there is no
+        such entry.
+        :param attachment: tuple of title and marker of copied attachment.
+        """
+        key = (unicode(src_id), dst_space_key, dst_title)
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT labels_digest, attachments FROM pages WHERE src_id = ? AND dst_space_key = ? AND dst_title = ?',
+                key
+            ).fetchone()
+            if row is None:
+                return
+
+            attachments = json.loads(row['attachments']) if row['attachments'] else {}
+            if attachment is not None:
+                attachments[attachment[0]] = attachment[1]
+            self._db.execute(
+                'UPDATE pages SET labels_digest = ?, attachments = ? '
+                'WHERE src_id = ? AND dst_space_key = ? AND dst_title = ?',
+                (labels_digest or row['labels_digest'], json.dumps(attachments, sort_keys=True)) + key
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,130 @@
+# coding=utf-8
+import re
+import tempfile
+import threading
+from xml.sax.saxutils import escape, unescape
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class LinkRewriter(object):
+    """
+    Rewrites links between pages of the copied tree in storage format bodies, so links in copies point to copies
+    instead of original pages. Pages are referenced by space key and title (`<ri:page ri:content-title="..."/>`,
+    also inside of `<ri:attachment>`), so it's enough to know which source pages belong to the copied tree: title
+    of the copy is derived from the title template.
+
+    Link to a page, which is not known yet, may be a forward link to the page which is copied later. Such pages are
+    remembered with their source bodies (in temporary file) and could be patched after the whole tree is copied.
+    """
+    PAGE_RE = re.compile(r'<ri:page\b[^>]*>')
+    ATTRIBUTE_RE = re.compile(r'\s(ri:content-title|ri:space-key)="([^"]*)"')
+    ESCAPE_ENTITIES = {'"': '&quot;'}
+    UNESCAPE_ENTITIES = {'&quot;': '"'}
+    TITLE_FIELD = '{title}'
+
+    def __init__(self):
+        # (space key, title) of source pages of the copied tree
+        self._pages = set()
+        self._deferred = list()
+        self._bodies = None
+        self._lock = threading.Lock()
+
+    def add(self, space_key, title):
+        """
+        Register source page as a part of the copied tree.
+        """
+        with self._lock:
+            self._pages.add((space_key, title))
+
+    def rewrite(self, body, src_space_key, dst_space_key, dst_title_template):
+        """
+        Rewrite links to pages of the copied tree in one pass over the body.
+        :param src_space_key: space of the source page, links without space key refer to it.
+        :return: tuple of rewritten body and set of (space key, title) of pages from the source space, which are not
+                 known yet, so links to them are left pointing to original pages.
+        """
+        unresolved = set()
+
+        def rewrite_page(match):
+            tag = match.group(0)
+            attributes = dict(
+                (name, unescape(value, self.UNESCAPE_ENTITIES)) for name, value in self.ATTRIBUTE_RE.findall(tag)
+            )
+            title = attributes.get('ri:content-title')
+            if title is None:
+                return tag
+            space_key = attributes.get('ri:space-key') or src_space_key
+
+            with self._lock:
+                known = (space_key, title) in self._pages
+            if known:
+                replacements = {'ri:content-title': dst_title_template.replace(self.TITLE_FIELD, title)}
+                if 'ri:space-key' in attributes:
+                    replacements['ri:space-key'] = dst_space_key
+            else:
+                if space_key == src_space_key:
+                    unresolved.add((space_key, title))
+                if 'ri:space-key' in attributes or dst_space_key == src_space_key:
+                    return tag
+                # link without space key would point to destination space, where original page doesn't exist
+                return tag.replace(
+                    '<ri:page', '<ri:page ri:space-key="{}"'.format(escape(src_space_key, self.ESCAPE_ENTITIES)), 1
+                )
+
+            return self.ATTRIBUTE_RE.sub(
+                lambda m: m.group(0) if m.group(1) not in replacements else ' {name}="{value}"'.format(
+                    name=m.group(1), value=escape(replacements[m.group(1)], self.ESCAPE_ENTITIES)
+                ),
+                tag
+            )
+
+        return self.PAGE_RE.sub(rewrite_page, body), unresolved
+
+    def defer(self, page_copy_id, body, unresolved, src_space_key, dst_space_key, dst_title_template):
+        """
+        Remember copied page, which has links to pages not known at the moment of copy.
+        """
+        data = body.encode('utf-8')
+        with self._lock:
+            if self._bodies is None:
+                self._bodies = tempfile.TemporaryFile()
+            self._bodies.seek(0, 2)
+            offset = self._bodies.tell()
+            self._bodies.write(data)
+            self._deferred.append(
+                (page_copy_id, offset, len(data), unresolved, src_space_key, dst_space_key, dst_title_template)
+            )
+
+    def iter_patches(self):
+        """
+        Rewrite bodies of deferred pages, which links are resolved now. Pages with links, which are still unknown,
+        stay deferred (e.g. until the next tree is copied).
+        :return: iterator over tuples of page copy id and rewritten body.
+        """
+        with self._lock:
+            deferred, self._deferred = self._deferred, list()
+            pages = set(self._pages)
+
+        for page_copy_id, offset, length, unresolved, src_space_key, dst_space_key, dst_title_template in deferred:
+            resolved = unresolved & pages
+            if unresolved - resolved:
+                with self._lock:
+                    self._deferred.append((
+                        page_copy_id, offset, length, unresolved - resolved, src_space_key, dst_space_key,
+                        dst_title_template
+                    ))
+            if not resolved:
+                continue
+
+            with self._lock:
+                self._bodies.seek(offset)
+                body = self._bodies.read(length).decode('utf-8')
+            yield page_copy_id, self.rewrite(body, src_space_key, dst_space_key, dst_title_template)[0]
+
+    def close(self):
+        with self._lock:
+            if self._bodies is not None:
+                self._bodies.close()
+                self._bodies = None
+            self._deferred = list()
@@ -0,0 +1,259 @@
+# coding=utf-8
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class _Stats(object):
+    """
+    Aggregated statistics of API calls: count, errors, latency histogram and transferred bytes.
+    """
+    __slots__ = ('calls', 'errors', 'requests', 'seconds', 'buckets', 'bytes_in', 'bytes_out')
+
+    def __init__(self, bucket_count):
+        self.calls = 0
+        self.errors = 0
+        self.requests = 0
+        self.seconds = 0.0
+        self.buckets = [0] * bucket_count
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self, bounds):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'requests': self.requests,
+            'seconds': round(self.seconds, 6),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            # cumulative, as Prometheus histograms are
+            'latency_buckets': dict(
+                ('+Inf' if bound is None else str(bound), sum(self.buckets[:i + 1]))
+                for i, bound in enumerate(bounds)
+            ),
+        }
+
+
+class CopyMetrics(object):
+    """
+    Thread safe collector of API call statistics, grouped by API method and by copy phase (find, create, labels,
+    attachments, children). Phase is set for the current thread with `phase` context manager, so calls made by
+    parallel workers are attributed correctly.
+    """
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, None)
+    PROMETHEUS_PREFIX = 'confluence_copier'
+
+    def __init__(self):
+        self.log = logging.getLogger('metrics')
+        self._started = time.time()
+        self._methods = dict()
+        self._phases = dict()
+        self._phase_seconds = dict()
+        self._pages = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._progress_thread = None
+        self._progress_stop = threading.Event()
+
+    def current_phase(self):
+        return getattr(self._local, 'phase', None)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Attribute API calls made by the current thread inside of the block to phase `name`.
+        Nested phases are allowed, calls are attributed to the innermost one.
+        """
+        previous = self.current_phase()
+        self._local.phase = name
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._local.phase = previous
+            with self._lock:
+                self._phase_seconds[name] = self._phase_seconds.get(name, 0.0) + time.time() - started
+
+    @contextmanager
+    def call(self, method):
+        """
+        Measure API call `method` made inside of the block. Requests and bytes reported by `add_request` while the
+        block is running are attributed to this call.
+        """
+        if getattr(self._local, 'call', None) is not None:
+            # call made by another API method, it's measured as part of the outer one
+            yield
+            return
+
+        record = self._local.call = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+        started = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._local.call = None
+            self._record(method, self.current_phase(), time.time() - started, failed, record)
+
+    def add_request(self, bytes_in=0, bytes_out=0):
+        """
+        Account HTTP request made by current API call (retries are counted as separate requests).
+        """
+        record = getattr(self._local, 'call', None)
+        if record is None:
+            return
+        record['requests'] += 1
+        record['bytes_in'] += bytes_in
+        record['bytes_out'] += bytes_out
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        """
+        Account bytes, which were transferred outside of request itself (e.g. streamed response).
+        """
+        record = getattr(self._local, 'call', None)
+        if record is None:
+            return
+        record['bytes_in'] += bytes_in
+        record['bytes_out'] += bytes_out
+
+    def _record(self, method, phase, seconds, failed, record):
+        bucket = len(self.LATENCY_BUCKETS) - 1
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if bound is not None and seconds <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            for group, key in ((self._methods, method), (self._phases, phase or 'other')):
+                stats = group.get(key)
+                if stats is None:
+                    stats = group[key] = _Stats(len(self.LATENCY_BUCKETS))
+                stats.calls += 1
+                stats.errors += int(failed)
+                stats.requests += record['requests']
+                stats.seconds += seconds
+                stats.buckets[bucket] += 1
+                stats.bytes_in += record['bytes_in']
+                stats.bytes_out += record['bytes_out']
+
+    def page_copied(self, count=1):
+        with self._lock:
+            self._pages += count
+
+    def report(self):
+        """
+        :return: dictionary with all collected statistics.
+        """
+        with self._lock:
+            elapsed = time.time() - self._started
+            phases = dict((name, stats.as_dict(self.LATENCY_BUCKETS)) for name, stats in self._phases.items())
+            for name, seconds in self._phase_seconds.items():
+                phases.setdefault(name, _Stats(len(self.LATENCY_BUCKETS)).as_dict(self.LATENCY_BUCKETS))
+                phases[name]['wall_seconds'] = round(seconds, 6)
+            return {
+                'elapsed_seconds': round(elapsed, 3),
+                'pages': self._pages,
+                'pages_per_sec': round(self._pages / elapsed, 3) if elapsed else 0,
+                'methods': dict((name, stats.as_dict(self.LATENCY_BUCKETS)) for name, stats in self._methods.items()),
+                'phases': phases,
+            }
+
+    def write_json(self, path):
+        self._write_atomic(path, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        """
+        Write statistics in Prometheus text format, e.g. for textfile collector of node exporter.
+        """
+        report = self.report()
+        prefix = self.PROMETHEUS_PREFIX
+        lines = [
+            '# TYPE {}_pages_total counter'.format(prefix),
+            '{}_pages_total {}'.format(prefix, report['pages']),
+            '# TYPE {}_elapsed_seconds gauge'.format(prefix),
+            '{}_elapsed_seconds {}'.format(prefix, report['elapsed_seconds']),
+        ]
+        for label, group in (('method', report['methods']), ('phase', report['phases'])):
+            name = '{prefix}_api_{label}'.format(prefix=prefix, label=label)
+            for metric, key, kind in (
+                    ('calls_total', 'calls', 'counter'),
+                    ('errors_total', 'errors', 'counter'),
+                    ('requests_total', 'requests', 'counter'),
+                    ('received_bytes_total', 'bytes_in', 'counter'),
+                    ('sent_bytes_total', 'bytes_out', 'counter'),
+            ):
+                lines.append('# TYPE {name}_{metric} {kind}'.format(name=name, metric=metric, kind=kind))
+                for value, stats in sorted(group.items()):
+                    lines.append('{name}_{metric}{{{label}="{value}"}} {number}'.format(
+                        name=name, metric=metric, label=label, value=value, number=stats[key]
+                    ))
+
+            lines.append('# TYPE {name}_duration_seconds histogram'.format(name=name))
+            for value, stats in sorted(group.items()):
+                for bound in self.LATENCY_BUCKETS:
+                    le = '+Inf' if bound is None else str(bound)
+                    lines.append('{name}_duration_seconds_bucket{{{label}="{value}",le="{le}"}} {number}'.format(
+                        name=name, label=label, value=value, le=le, number=stats['latency_buckets'][le]
+                    ))
+                lines.append('{name}_duration_seconds_sum{{{label}="{value}"}} {number}'.format(
+                    name=name, label=label, value=value, number=stats['seconds']
+                ))
+                lines.append('{name}_duration_seconds_count{{{label}="{value}"}} {number}'.format(
+                    name=name, label=label, value=value, number=stats['calls']
+                ))
+
+        self._write_atomic(path, '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _write_atomic(path, content):
+        # write to temp file and rename it, so readers never see partially written report
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def start_progress(self, interval):
+        """
+        Log number of copied pages and current copy rate every `interval` seconds in background thread.
+        """
+        if self._progress_thread is not None:
+            return
+
+        def report_progress():
+            last_time, last_pages = time.time(), 0
+            while not self._progress_stop.wait(interval):
+                now = time.time()
+                with self._lock:
+                    pages = self._pages
+                    requests = sum(stats.requests for stats in self._methods.values())
+                self.log.info("Progress: {pages} page(s) copied, {rate:.2f} pages/sec, {requests} request(s)".format(
+                    pages=pages, rate=(pages - last_pages) / (now - last_time), requests=requests
+                ))
+                last_time, last_pages = now, pages
+
+        self._progress_stop.clear()
+        self._progress_thread = threading.Thread(target=report_progress, name='copy-progress')
+        self._progress_thread.daemon = True
+        self._progress_thread.start()
+
+    def stop_progress(self):
+        if self._progress_thread is None:
+            return
+        self._progress_stop.set()
+        self._progress_thread.join()
+        self._progress_thread = None
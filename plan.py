@@ -0,0 +1,152 @@
+# coding=utf-8
+import io
+import json
+import logging
+import threading
+from functools import partial
+
+from pool import TaskPool
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class PlanWriter(object):
+    """
+    Writer of copy plan: JSON lines file with one operation per line. Every operation has unique `id`, kind `op`
+    (create, update, skip, labels or attachment), `deps` - ids of operations, which should be done before it, and
+    estimation of `requests` and `bytes` needed to execute it. Operations are written in the order they are added,
+    and could depend only on previously added ones, so the order of the file is always a valid execution order.
+    """
+    OPERATIONS = ('create', 'update', 'skip', 'labels', 'attachment')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = io.open(path, 'w', encoding='utf-8')
+        self._next_id = 1
+        self._totals = {'operations': dict((op, 0) for op in self.OPERATIONS), 'requests': 0, 'bytes': 0}
+
+    def add(self, op, deps=(), requests=0, bytes=0, **fields):
+        """
+        Append operation to the plan.
+        :param fields: operation specific fields, should be JSON serializable.
+        :return: id of the operation.
+        """
+        assert op in self.OPERATIONS, "Unknown operation '{}'".format(op)
+        operation = dict(fields, id=self._next_id, op=op, deps=list(deps), requests=requests, bytes=bytes)
+        self._file.write(unicode(json.dumps(operation, sort_keys=True)) + u'\n')
+        self._next_id += 1
+
+        self._totals['operations'][op] += 1
+        self._totals['requests'] += requests
+        self._totals['bytes'] += bytes
+        return operation['id']
+
+    def totals(self):
+        """
+        :return: number of operations of every kind and expected number of requests and transferred bytes.
+        """
+        return {
+            'operations': dict(self._totals['operations']),
+            'requests': self._totals['requests'],
+            'bytes': self._totals['bytes'],
+        }
+
+    def close(self):
+        self._file.close()
+
+
+def read_plan(path):
+    """
+    :return: list of operations of the plan written by `PlanWriter`.
+    """
+    with io.open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class PlanExecutor(object):
+    """
+    Executor of copy plan. With `workers`, operations are run by `TaskPool`, so independent operations (e.g.
+    attachments of one page and subtrees of its children) run in parallel. Result of every done operation is appended
+    to state file, so interrupted execution is resumed from the first not done operation.
+    """
+
+    def __init__(self, operations, run, state_path, workers=None, resume_from=None):
+        """
+        :param operations: list of plan operations.
+        :param run: function called with operation and list of tuples of operations it depends on and their
+                    results, it returns JSON serializable result of the operation.
+        :param state_path: path of the file with results of done operations.
+        :param resume_from: id of operation to start from, all operations before it are treated as done even if
+                            they are not in the state file (their results are `None` then).
+        """
+        self.log = logging.getLogger('plan')
+        self._operations = operations
+        self._run = run
+        self._state_path = state_path
+        self._workers = workers
+        self._resume_from = resume_from
+
+    def _load_state(self):
+        results = dict()
+        try:
+            with io.open(self._state_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # line was partially written when execution was interrupted
+                        continue
+                    results[record['id']] = record['result']
+        except IOError:
+            pass
+
+        if self._resume_from is not None:
+            for operation in self._operations:
+                if operation['id'] < self._resume_from:
+                    results.setdefault(operation['id'], None)
+        return results
+
+    def execute(self):
+        """
+        Run all operations, which are not done yet.
+        :return: number of executed operations.
+        """
+        results = self._load_state()
+        operations = dict((operation['id'], operation) for operation in self._operations)
+        pending = [operation for operation in self._operations if operation['id'] not in results]
+        if len(pending) < len(self._operations):
+            self.log.info("Resuming plan: {done} of {total} operation(s) are done".format(
+                done=len(self._operations) - len(pending), total=len(self._operations)
+            ))
+
+        lock = threading.Lock()
+        state = io.open(self._state_path, 'a', encoding='utf-8')
+
+        def run(operation):
+            with lock:
+                dependencies = [(operations[dep], results[dep]) for dep in operation['deps']]
+            result = self._run(operation, dependencies)
+            with lock:
+                results[operation['id']] = result
+                state.write(unicode(json.dumps({'id': operation['id'], 'result': result})) + u'\n')
+                state.flush()
+
+        try:
+            if self._workers is not None and self._workers > 1:
+                self._execute_concurrently(pending, run)
+            else:
+                for operation in pending:
+                    run(operation)
+        finally:
+            state.close()
+        return len(pending)
+
+    def _execute_concurrently(self, pending, run):
+        pool = TaskPool(self._workers)
+        self.log.debug("Executing plan with {} worker(s)".format(self._workers))
+        # done operations are not added to the pool, so dependencies on them are treated as satisfied
+        for operation in pending:
+            pool.add(partial(run, operation), key=operation['id'], deps=operation['deps'])
+        pool.join()
@@ -0,0 +1,85 @@
+# coding=utf-8
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class TaskPool(object):
+    """
+    Pool of worker threads running tasks, which could depend on other tasks. Task is started as soon as all tasks it
+    depends on are done, so independent tasks run in parallel. Tasks are added either before `join` or by already
+    running tasks (e.g. copy of page adds copies of it's children). First error stops starting of new tasks and is
+    raised by `join` after all already running tasks are finished.
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # reentrant, as task could be started from done callback, which is called in place for finished future
+        self._condition = threading.Condition(threading.RLock())
+        # keys of added tasks, which are not done yet
+        self._pending = set()
+        # task key -> list of function and number of not done tasks it depends on
+        self._waiting = dict()
+        # task key -> keys of tasks depending on it
+        self._dependents = dict()
+        self._running = set()
+        self._failed = list()
+
+    def add(self, function, key=None, deps=()):
+        """
+        Add task to the pool.
+        :param function: callable without arguments.
+        :param key: key of the task, other tasks could depend on it using the key.
+        :param deps: keys of tasks, which should be done before this one. Task could depend only on previously added
+                     tasks, keys of unknown tasks are treated as done ones.
+        """
+        with self._condition:
+            deps = [dep for dep in deps if dep in self._pending]
+            if key is not None:
+                self._pending.add(key)
+            if not deps:
+                self._start(function, key)
+                return
+            self._waiting[key] = [function, len(deps)]
+            for dep in deps:
+                self._dependents.setdefault(dep, list()).append(key)
+
+    def _start(self, function, key):
+        with self._condition:
+            if self._failed:
+                return
+            future = self._executor.submit(function)
+            self._running.add(future)
+            future.add_done_callback(lambda f: self._on_done(key, f))
+
+    def _on_done(self, key, future):
+        with self._condition:
+            if future.exception() is not None:
+                self._failed.append(future)
+            elif key is not None:
+                self._pending.discard(key)
+                # dependents are started before the task is removed from running ones, so `join` never stops in
+                # between
+                for dependent in self._dependents.pop(key, []):
+                    task = self._waiting[dependent]
+                    task[1] -= 1
+                    if not task[1]:
+                        del self._waiting[dependent]
+                        self._start(task[0], dependent)
+            self._running.discard(future)
+            self._condition.notify_all()
+
+    def join(self):
+        """
+        Wait until all tasks are done (or first of them fails) and stop worker threads.
+        """
+        try:
+            with self._condition:
+                while self._running and not self._failed:
+                    self._condition.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+        if self._failed:
+            self._failed[0].result()
@@ -0,0 +1,113 @@
+# coding=utf-8
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class AttachmentSpool(object):
+    """
+    Local content addressed storage of downloaded attachments. Files are stored by digest of their content, and
+    any number of keys (e.g. attachment id with version or title with size) could refer to the same file, so
+    attachment, which is known by any of it's keys, is not downloaded again. When total size of files exceeds the
+    limit, least recently used files are removed.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, max_size, directory=None):
+        """
+        :param max_size: maximal total size of stored files in bytes.
+        :param directory: directory to store files in, temporary one is created by default and removed on `close`.
+        """
+        self.max_size = max_size
+        self._own_directory = directory is None
+        self._directory = tempfile.mkdtemp(prefix='confl-spool-') if directory is None else directory
+        # digest -> size, in order of usage
+        self._files = OrderedDict()
+        self._size = 0
+        # key -> digest
+        self._keys = dict()
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self._directory, digest)
+
+    def open(self, keys):
+        """
+        :return: file object for reading content known by any of `keys` or `None` if it's not stored.
+        """
+        with self._lock:
+            for key in keys:
+                digest = self._keys.get(key)
+                if digest is None or digest not in self._files:
+                    continue
+                self._files[digest] = self._files.pop(digest)
+                # file is opened under the lock, so it couldn't be evicted in between, but could be read after
+                # eviction, as removed file stays readable while it's open
+                return open(self._path(digest), 'rb')
+        return None
+
+    def create(self):
+        """
+        :return: temporary file object to write new content to, it should be passed to `store` afterwards.
+        """
+        return tempfile.NamedTemporaryFile(dir=self._directory, prefix='.download-', delete=False)
+
+    def store(self, keys, fileobj):
+        """
+        Move content written to file object returned by `create` to the spool and make it known by `keys`.
+        :return: file object for reading stored content.
+        """
+        fileobj.flush()
+        fileobj.seek(0)
+        digest = hashlib.sha1()
+        for chunk in iter(lambda: fileobj.read(self.CHUNK_SIZE), b''):
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        size = fileobj.tell()
+        fileobj.close()
+
+        with self._lock:
+            if digest in self._files:
+                os.remove(fileobj.name)
+                self._files[digest] = self._files.pop(digest)
+            else:
+                os.rename(fileobj.name, self._path(digest))
+                self._files[digest] = size
+                self._size += size
+            for key in keys:
+                self._keys[key] = digest
+            result = open(self._path(digest), 'rb')
+            self._evict()
+        return result
+
+    def _evict(self):
+        # just stored file is the most recently used, it's kept even if it's bigger than the limit alone
+        while self._size > self.max_size and len(self._files) > 1:
+            digest, size = next(iter(self._files.items()))
+            del self._files[digest]
+            self._size -= size
+            os.remove(self._path(digest))
+
+    def discard(self, fileobj):
+        """
+        Remove file returned by `create`, which content wasn't stored (e.g. download failed).
+        """
+        fileobj.close()
+        if os.path.exists(fileobj.name):
+            os.remove(fileobj.name)
+
+    def close(self):
+        with self._lock:
+            if self._own_directory:
+                shutil.rmtree(self._directory, ignore_errors=True)
+            else:
+                for digest in self._files:
+                    os.remove(self._path(digest))
+            self._files.clear()
+            self._keys.clear()
+            self._size = 0
@@ -1,9 +1,24 @@
 import unittest
 import sys, os
-from mock import MagicMock
+import json
+import shutil
+import tempfile
+from io import BytesIO
+from mock import MagicMock, patch
+from concurrent.futures import Future
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from copier import ConfluencePageCopier
+from copier import ConfluencePageCopier, ConfluenceAPIDryRunProxy, MultipartAttachmentStream, PageFilter
+from transport import AdaptiveRateLimiter, parse_retry_after
+from xmlexport import XmlExportSource
+from metrics import CopyMetrics
+from cache import PageCache
+from spool import AttachmentSpool
+from pool import TaskPool
+from journal import CopyJournal
+
+EXPORT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'examples-backup', 'xmlexport-20160617-153702-3.zip')
 
 class TestOverwrite(unittest.TestCase):
 
@@ -16,6 +31,7 @@ class TestOverwrite(unittest.TestCase):
         self.dst = {'title': 'title', 'space_key': 'space'}
         self.cp = ConfluencePageCopier('user','password','bah')
         self.cp._find_page = MagicMock(side_effect=TestOverwrite._find_page)
+        self.cp._find_dst_page = MagicMock(return_value={'id': 10, 'version': 1, 'ancestor_id': None})
         self.cp._init_destination_page = MagicMock(return_value=[self.dst['space_key'], self.dst['title']])
         self.cp._client.get_content_children_by_type = MagicMock(return_value={})
         self.cp._overwrite_page = MagicMock()
@@ -36,5 +52,1190 @@ class TestOverwrite(unittest.TestCase):
         self.cp._overwrite_page.assert_called_with(self.source, ancestor, self.dst, self.dst['space_key'],
                                                    self.dst['title'])
 
+class TestConcurrentCopy(unittest.TestCase):
+    TREE = {1: [2, 3], 2: [4, 5], 3: [6], 4: [], 5: [7], 6: [], 7: []}
+
+    def _find_page(self, content_id=None, space_key=None, title=None):
+        if content_id is None:
+            return None
+        return {'id': content_id, 'title': 'page %s' % content_id, 'space': {'key': 'space'}, 'ancestors': []}
+
+    def _children(self, content_id, child_type, **kwargs):
+        return {'results': [{'id': child} for child in self.TREE[content_id]]}
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.cp._find_page = MagicMock(side_effect=self._find_page)
+        self.cp._find_dst_page = MagicMock(return_value=None)
+        self.cp._client.get_content_children_by_type = MagicMock(side_effect=self._children)
+        self.cp._copy_page = MagicMock(side_effect=lambda source, *args: {'id': 'copy-%s' % source['id']})
+        self.cp._copy_labels = MagicMock()
+        self.cp._copy_attachments = MagicMock()
+
+    def _copied(self):
+        return dict((c[0][0]['id'], c[0][1]) for c in self.cp._copy_page.call_args_list)
+
+    def test_whole_tree(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key='other', dst_title_template='{title} copy', workers=4)
+        self.assertEqual(self._copied(), {
+            1: None, 2: 'copy-1', 3: 'copy-1', 4: 'copy-2', 5: 'copy-2', 6: 'copy-3', 7: 'copy-5'
+        })
+        self.assertEqual(len(self.cp._copy_labels.call_args_list), 7)
+        self.assertEqual(len(self.cp._copy_attachments.call_args_list), 7)
+
+    def test_recursion_limit(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key='other', dst_title_template='{title} copy', workers=4,
+                     recursion_limit=1, skip_labels=True, skip_attachments=True)
+        self.assertEqual(sorted(self._copied()), [1, 2, 3])
+        self.assertFalse(self.cp._copy_labels.called)
+        self.assertFalse(self.cp._copy_attachments.called)
+
+    def test_error_is_raised(self):
+        self.cp._copy_page = MagicMock(side_effect=RuntimeError('boom'))
+        self.assertRaises(RuntimeError, self.cp.copy, src={'content_id': 1}, dst_space_key='other',
+                          dst_title_template='{title} copy', workers=4)
+
+
+class TestTraversal(unittest.TestCase):
+    DEPTH = 3000
+
+    def _find_page(self, content_id=None, **kwargs):
+        return {'id': content_id, 'title': u'page %s' % content_id, 'space': {'key': u'space'}, 'ancestors': [],
+                'body': {'storage': {'value': u'body'}}}
+
+    def _children(self, content_id, child_type, **kwargs):
+        children = [{'id': content_id + 1}] if content_id < self.DEPTH else []
+        if content_id == 1:
+            children.append({'id': self.DEPTH + 1})
+        return {'results': children}
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.cp._find_page = MagicMock(side_effect=self._find_page)
+        self.cp._find_dst_page = MagicMock(return_value=None)
+        self.cp._client.get_content_children_by_type = MagicMock(side_effect=self._children)
+        self.cp._copy_page = MagicMock(side_effect=lambda source, *args: {'id': 'copy-%s' % source['id']})
+        self.cp._copy_attachments = MagicMock()
+
+    def test_deep_tree(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key=u'other', dst_title_template=u'{title} copy',
+                     skip_labels=True)
+
+        copied = [(c[0][0]['id'], c[0][1]) for c in self.cp._copy_page.call_args_list]
+        self.assertEqual(len(copied), self.DEPTH + 1)
+        # depth first, in the order of children
+        self.assertEqual(copied[:2], [(1, None), (2, 'copy-1')])
+        self.assertEqual(copied[-1], (self.DEPTH + 1, 'copy-1'))
+        # body is released as soon as page content is copied
+        self.assertNotIn('body', self.cp._copy_attachments.call_args[0][0])
+
+
+class TestMultipleCopies(unittest.TestCase):
+    TREE = {1: [2, 3], 2: [], 3: []}
+
+    def _find_page(self, content_id=None, **kwargs):
+        return {'id': content_id, 'title': u'page %s' % content_id, 'space': {'key': u'space'}, 'ancestors': []}
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.cp._find_page = MagicMock(side_effect=self._find_page)
+        self.cp._find_dst_page = MagicMock(return_value=None)
+        self.cp._client.get_content_children_by_type = MagicMock(
+            side_effect=lambda content_id, child_type, **kwargs: {'results': [{'id': c} for c in self.TREE[content_id]]}
+        )
+        self.cp._client.search_content = MagicMock(return_value={'results': [{'title': u'page 1 (2)'}]})
+        self.cp._copy_page = MagicMock(side_effect=lambda source, ancestor_id, space, title, *args: {'id': title})
+        self.cp._copy_labels = MagicMock()
+        self.cp._copy_attachments = MagicMock()
+
+    def test_copies(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key=u'other', dst_title_template=u'{title} ({counter})',
+                     copies=3)
+
+        copied = sorted((c[0][3], c[0][1]) for c in self.cp._copy_page.call_args_list)
+        self.assertEqual(copied, sorted(
+            [(u'page 1 (%s)' % n, None) for n in (3, 4, 5)] +
+            [(u'page %s (%s)' % (child, n), u'page 1 (%s)' % n) for n in (3, 4, 5) for child in (2, 3)]
+        ))
+        # source is read once, used counters are searched once
+        self.assertEqual(self.cp._find_page.call_count, 3)
+        self.assertEqual(self.cp._client.search_content.call_count, 1)
+        self.assertEqual(self.cp._copy_attachments.call_count, 3)
+
+    def test_template_without_counter(self):
+        self.assertRaises(ValueError, self.cp.copy, src={'content_id': 1}, dst_title_template=u'{title} copy',
+                          copies=2)
+
+    def test_invalid_number_of_copies(self):
+        for copies in (0, -1):
+            self.assertRaises(ValueError, self.cp.copy, src={'content_id': 1},
+                              dst_title_template=u'{title} ({counter})', copies=copies)
+        self.assertFalse(self.cp._find_page.called)
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False)
+        self.cp._find_page = MagicMock(side_effect=lambda content_id=None, **kwargs: {
+            'id': 1, 'title': u'Release', 'space': {'key': u'src'}, 'ancestors': [], 'version': {'number': 1}
+        } if content_id else None)
+        self.cp._copy_page = MagicMock(side_effect=lambda source, ancestor_id, space, title, *args: {
+            'id': u'%s:%s:%s' % (space, ancestor_id, title)
+        })
+        attachment = {'title': u'notes.txt', 'metadata': {}, '_links': {'download': u'/download/notes.txt'}}
+        self.cp._client.get_content_attachments = MagicMock(
+            side_effect=lambda content_id, **kwargs: {'results': [attachment] if content_id == 1 else []}
+        )
+        self.cp._client.get_content_labels = MagicMock(return_value={'results': [{'prefix': 'global', 'name': 'l'}]})
+        self.cp._client.get_content_children_by_type = MagicMock(return_value={'results': []})
+        self.cp._client.download_attachment = MagicMock(
+            side_effect=lambda download_link, fileobj, chunk_size: fileobj.write(b'release notes')
+        )
+        self.uploaded = list()
+        self.cp._client.create_new_attachment_stream_by_content_id = MagicMock(
+            side_effect=lambda content_id, attachment: self.uploaded.append((content_id, b''.join(attachment)))
+        )
+        self.cp._client.create_new_label_by_content_id = MagicMock()
+
+    def test_targets(self):
+        self.cp.copy(src={'content_id': 1}, targets=[
+            {'dst_space_key': u'A', 'dst_title_template': u'{title}', 'dst_parent_id': 10},
+            {'dst_space_key': u'B', 'dst_title_template': u'{title} (B)', 'dst_parent_id': 20},
+        ])
+
+        self.assertEqual(sorted(c[0][3] for c in self.cp._copy_page.call_args_list), [u'Release', u'Release (B)'])
+        self.assertEqual([c[1] for c in self.cp._find_page.call_args_list if 'content_id' in c[1]], [{'content_id': 1}])
+        self.assertEqual(self.cp._client.get_content_labels.call_count, 1)
+        self.assertEqual(self.cp._client.create_new_label_by_content_id.call_count, 2)
+        self.assertEqual(self.cp._client.download_attachment.call_count, 1)
+        self.assertEqual(sorted(content_id for content_id, _ in self.uploaded), [u'A:10:Release', u'B:20:Release (B)'])
+        for _, body in self.uploaded:
+            self.assertIn(b'\r\n\r\nrelease notes\r\n', body)
+
+
+class TestLinkRewrite(unittest.TestCase):
+    TREE = {1: [2, 3], 2: [], 3: [4], 4: []}
+    BODIES = {
+        1: u'<ac:link><ri:page ri:content-title="Page 2" /></ac:link>',
+        2: u'<ri:page ri:content-title="Page 3" /><ri:page ri:content-title="Page 4" />'
+           u'<ri:page ri:space-key="SRC" ri:content-title="Other" />',
+        3: u'<ri:attachment ri:filename="a.png"><ri:page ri:content-title="Page &amp; 1" /></ri:attachment>',
+        4: u'<ri:page ri:space-key="SRC" ri:content-title="Page 2" />',
+    }
+
+    def _find_page(self, content_id=None, **kwargs):
+        if content_id is None:
+            return None
+        title = u'Page & 1' if content_id == 1 else u'Page %s' % content_id
+        return {'id': content_id, 'title': title, 'space': {'key': u'SRC'}, 'ancestors': [],
+                'version': {'number': 1}, 'body': {'storage': {'value': self.BODIES[content_id]}},
+                'children': {'page': self._children(content_id, 'page')}}
+
+    def _children(self, content_id, child_type, **kwargs):
+        return {'results': [{'id': child, 'title': u'Page %s' % child} for child in self.TREE[content_id]]}
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False)
+        self.cp._find_page = MagicMock(side_effect=self._find_page)
+        self.cp._client.get_content_children_by_type = MagicMock(side_effect=self._children)
+        self.cp._copy_page = MagicMock(side_effect=lambda source, *args: {'id': 'copy-%s' % source['id']})
+        self.cp._client.get_content_by_id = MagicMock(side_effect=lambda content_id, **kwargs: {
+            'id': content_id, 'type': 'page', 'title': u'Page 2 (copy)', 'space': {'key': u'DST'},
+            'ancestors': [{'id': 'copy-1'}], 'version': {'number': 1}
+        })
+        self.cp._client.update_content_by_id = MagicMock(return_value={'id': 'copy-2'})
+
+    def test_links_to_copies(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key=u'DST', dst_title_template=u'{title} (copy)',
+                     skip_labels=True, skip_attachments=True)
+
+        bodies = dict((c[0][0]['id'], c[0][0]['body']['storage']['value']) for c in self.cp._copy_page.call_args_list)
+        self.assertEqual(bodies[1], u'<ac:link><ri:page ri:content-title="Page 2 (copy)" /></ac:link>')
+        # forward link is left pointing to the original page until the page is patched
+        self.assertEqual(
+            bodies[2],
+            u'<ri:page ri:content-title="Page 3 (copy)" /><ri:page ri:space-key="SRC" ri:content-title="Page 4" />'
+            u'<ri:page ri:space-key="SRC" ri:content-title="Other" />'
+        )
+        self.assertEqual(
+            bodies[3],
+            u'<ri:attachment ri:filename="a.png"><ri:page ri:content-title="Page &amp; 1 (copy)" /></ri:attachment>'
+        )
+        self.assertEqual(bodies[4], u'<ri:page ri:space-key="DST" ri:content-title="Page 2 (copy)" />')
+
+        # only page with forward link is patched, without fetching of bodies
+        self.cp._client.update_content_by_id.assert_called_once()
+        self.cp._client.get_content_by_id.assert_called_once_with(
+            content_id='copy-2', expand='space,version,ancestors'
+        )
+        data = self.cp._client.update_content_by_id.call_args[1]['content_data']
+        self.assertEqual(
+            data['body']['storage']['value'],
+            u'<ri:page ri:content-title="Page 3 (copy)" /><ri:page ri:content-title="Page 4 (copy)" />'
+            u'<ri:page ri:space-key="SRC" ri:content-title="Other" />'
+        )
+        self.assertEqual(data['version'], {'number': 2})
+        self.assertEqual(data['ancestors'], [{'id': 'copy-1'}])
+
+    def test_recursion_limit(self):
+        self.cp.copy(src={'content_id': 1}, dst_space_key=u'DST', dst_title_template=u'{title} (copy)',
+                     skip_labels=True, skip_attachments=True, recursion_limit=0)
+
+        self.cp._copy_page.assert_called_once()
+        # child is not copied, so the link keeps pointing to the original page
+        self.assertEqual(self.cp._copy_page.call_args[0][0]['body']['storage']['value'],
+                         u'<ac:link><ri:page ri:space-key="SRC" ri:content-title="Page 2" /></ac:link>')
+        self.cp._client.update_content_by_id.assert_not_called()
+
+    def test_skip_link_rewrite(self):
+        self.cp._link_rewriter = None
+        self.cp.copy(src={'content_id': 1}, dst_space_key=u'DST', dst_title_template=u'{title} (copy)',
+                     skip_labels=True, skip_attachments=True)
+
+        for c in self.cp._copy_page.call_args_list:
+            self.assertEqual(c[0][0]['body']['storage']['value'], self.BODIES[c[0][0]['id']])
+        self.assertFalse(self.cp._client.update_content_by_id.called)
+
+
+class TestAttachmentStreaming(unittest.TestCase):
+
+    def test_multipart_body(self):
+        body = MultipartAttachmentStream('file.txt', BytesIO(b'x' * 100), u'text/plain', comment=u'note')
+        data = b''.join(body)
+        self.assertEqual(len(data), len(body))
+        self.assertTrue(data.startswith(b'--' + body.boundary.encode('ascii')))
+        self.assertIn(b'filename="file.txt"\r\nContent-Type: text/plain\r\n\r\n' + b'x' * 100 + b'\r\n', data)
+        self.assertIn(b'name="comment"\r\n\r\nnote\r\n', data)
+        self.assertTrue(data.endswith(b'--' + body.boundary.encode('ascii') + b'--\r\n'))
+
+    def test_copy_attachments(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', attachment_spool_size=10)
+        cp._client.get_content_attachments = MagicMock(side_effect=[
+            {'results': [
+                {'title': u'new.bin', 'metadata': {'mediaType': u'application/octet-stream'},
+                 '_links': {'download': u'/download/new.bin'}},
+                {'title': u'old.bin', 'metadata': {}, '_links': {'download': u'/download/old.bin'}},
+            ]},
+            {'results': [{'title': u'old.bin', 'id': 'att-1'}]},
+        ])
+        uploaded = dict()
+
+        def download(download_link, fileobj, chunk_size):
+            fileobj.write(download_link.encode('utf-8') * 10)
+
+        def upload(content_id, attachment, attachment_id=None):
+            uploaded[attachment.name] = (attachment_id, b''.join(attachment))
+
+        cp._client.download_attachment = MagicMock(side_effect=download)
+        cp._client.create_new_attachment_stream_by_content_id = MagicMock(side_effect=upload)
+        cp._client.update_attachment_stream = MagicMock(side_effect=upload)
+
+        cp._copy_attachments({'id': 1}, [(2, None)])
+
+        self.assertEqual(uploaded['new.bin'][0], None)
+        self.assertIn(b'download/new.bin' * 10, uploaded['new.bin'][1])
+        self.assertEqual(uploaded['old.bin'][0], 'att-1')
+        self.assertIn(b'download/old.bin' * 10, uploaded['old.bin'][1])
+
+    def test_identical_attachment_is_skipped(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah')
+        attachment = {'title': u'same.bin', 'metadata': {'mediaType': u'image/png'}, 'extensions': {'fileSize': 10},
+                      'version': {'when': u'2016-06-17T15:37:02.000+03:00'}, '_links': {'download': u'/d/same.bin'}}
+        cp._client.get_content_attachments = MagicMock(side_effect=[
+            {'results': [attachment]},
+            {'results': [dict(attachment, id='att-1', version={'when': u'2016-06-17T12:40:00.000Z'})]},
+        ])
+        cp._client.download_attachment = MagicMock()
+        cp._client.update_attachment_stream = MagicMock()
+
+        cp._copy_attachments({'id': 1}, [(2, None)])
+
+        self.assertFalse(cp._client.download_attachment.called)
+        self.assertFalse(cp._client.update_attachment_stream.called)
+        self.assertEqual(cp._attachment_stats['skipped_bytes'], 10)
+
+    def test_spool(self):
+        spool = AttachmentSpool(max_size=10)
+        self.addCleanup(spool.close)
+        for keys, content in ((['a', 'b'], b'123456'), (['c'], b'123456'), (['d'], b'abcdef')):
+            fileobj = spool.create()
+            fileobj.write(content)
+            spool.store(keys, fileobj).close()
+
+        # 'c' refers to the same file as 'a' and 'b', which is evicted as least recently used when 'd' is stored
+        self.assertEqual(spool.open(['x', 'b']), None)
+        self.assertEqual(spool.open(['d']).read(), b'abcdef')
+        self.assertEqual(spool.open(['c']), None)
+
+    def test_duplicate_attachments_are_downloaded_once(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', attachment_cache_size=1024)
+        self.addCleanup(cp.close)
+
+        def attachments(content_id, **kwargs):
+            if content_id not in (1, 2):
+                return {'results': []}
+            return {'results': [{
+                'id': 'att-%s' % content_id, 'title': u'logo.png', 'version': {'number': 1},
+                'metadata': {'mediaType': u'image/png'}, 'extensions': {'fileSize': 4},
+                '_links': {'download': u'/download/%s/logo.png' % content_id}
+            }]}
+
+        uploaded = list()
+        cp._client.get_content_attachments = MagicMock(side_effect=attachments)
+        cp._client.download_attachment = MagicMock(
+            side_effect=lambda download_link, fileobj, chunk_size: fileobj.write(b'logo')
+        )
+        cp._client.create_new_attachment_stream_by_content_id = MagicMock(
+            side_effect=lambda content_id, attachment: uploaded.append(b''.join(attachment))
+        )
+
+        cp._copy_attachments({'id': 1}, [(10, None)])
+        cp._copy_attachments({'id': 2}, [(20, None)])
+
+        self.assertEqual(cp._client.download_attachment.call_count, 1)
+        self.assertEqual(len(uploaded), 2)
+        self.assertTrue(all(b'\r\n\r\nlogo\r\n' in body for body in uploaded))
+        self.assertEqual((cp._attachment_stats['reused'], cp._attachment_stats['reused_bytes']), (1, 4))
+
+    def test_attachment_equality(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah')
+        src = {'metadata': {'mediaType': u'image/png'}, 'extensions': {'fileSize': 10},
+               'version': {'when': u'2016-06-17T15:37:02.000+03:00'}}
+        self.assertTrue(cp._is_attachment_equal(src, dict(src, version={'when': u'2016-06-17T12:37:02.000Z'})))
+        self.assertFalse(cp._is_attachment_equal(src, dict(src, version={'when': u'2016-06-17T12:37:01.000Z'})))
+        self.assertFalse(cp._is_attachment_equal(src, dict(src, extensions={'fileSize': 11})))
+        self.assertFalse(cp._is_attachment_equal(src, dict(src, metadata={'mediaType': u'image/gif'})))
+
+
+class TestPagination(unittest.TestCase):
+
+    @staticmethod
+    def _api_call(content_id, start=0, limit=2):
+        items = range(5)
+        response = {'results': items[start:start + limit], 'start': start, 'limit': limit, '_links': {}}
+        response['size'] = len(response['results'])
+        if start + limit < len(items):
+            response['_links']['next'] = '/next'
+        return response
+
+    def test_all_pages(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah')
+        api_call = MagicMock(side_effect=self._api_call)
+        self.assertEqual(list(cp._iter_results(api_call, content_id=1)), [0, 1, 2, 3, 4])
+        self.assertEqual([c[1].get('start') for c in api_call.call_args_list], [None, 2, 4])
+
+    def test_page_size(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', page_size=3)
+        api_call = MagicMock(side_effect=self._api_call)
+        self.assertEqual(list(cp._iter_results(api_call, content_id=1)), [0, 1, 2, 3, 4])
+        self.assertEqual(api_call.call_count, 2)
+        self.assertEqual(api_call.call_args_list[0][1]['limit'], 3)
+
+    def test_title_counter(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah')
+        titles = [u'page (1)', u'page (2)', u'other', u'page (3)', u'page (x)']
+        cp._client.search_content = MagicMock(side_effect=lambda cql_str, start=0, limit=2: {
+            'results': [{'title': t} for t in titles[start:start + limit]],
+            'start': start, 'limit': limit, 'size': len(titles[start:start + limit]),
+            '_links': {'next': '/next'} if start + limit < len(titles) else {}
+        })
+        self.assertEqual(cp._get_title_counter(u'space', u'page', u'{title} ({counter})'), 4)
+
+
+class TestDestinationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.cp._client.get_content = MagicMock(return_value={'results': [
+            {'id': 1, 'title': u'Home', 'version': {'number': 3}, 'ancestors': []},
+            {'id': 2, 'title': u'Child', 'version': {'number': 1}, 'ancestors': [{'id': 1}]},
+        ]})
+
+    def test_lookup(self):
+        self.assertEqual(self.cp._find_dst_page(u'space', u'Child'), {'id': 2, 'version': 1, 'ancestor_id': 1})
+        self.assertEqual(self.cp._find_dst_page(u'space', u'Home'), {'id': 1, 'version': 3, 'ancestor_id': None})
+        self.assertIsNone(self.cp._find_dst_page(u'space', u'Missing'))
+        self.assertEqual(self.cp._client.get_content.call_count, 1)
+
+    def test_created_pages_are_indexed(self):
+        source = {'id': 5, 'title': u'New', 'space': {'key': u'src'}, 'ancestors': []}
+        self.cp._find_page = MagicMock(return_value=source)
+        self.cp._copy_page = MagicMock(return_value={'id': 50, 'version': {'number': 1}})
+        self.cp.copy(src={'content_id': 5}, dst_space_key=u'space', dst_title_template=u'{title}', dst_parent_id=1,
+                     skip_labels=True, skip_attachments=True, recursion_limit=0)
+
+        self.assertEqual(self.cp._find_dst_page(u'space', u'New'), {'id': 50, 'version': 1, 'ancestor_id': 1})
+        self.assertRaises(RuntimeError, self.cp.copy, src={'content_id': 5}, dst_space_key=u'space',
+                          dst_title_template=u'{title}', dst_parent_id=1, recursion_limit=0)
+        self.assertEqual(self.cp._client.get_content.call_count, 1)
+        self.assertEqual(self.cp._find_page.call_count, 3)
+
+
+class TestJournal(unittest.TestCase):
+    TREE = {1: [2, 3], 2: [], 3: []}
+
+    def _page(self, content_id):
+        return {'id': content_id, 'title': u'page %s' % content_id, 'space': {'key': u'space'}, 'ancestors': [],
+                'version': {'number': self.versions[content_id]}}
+
+    def _children(self, content_id, child_type, **kwargs):
+        return {'results': [self._page(child) for child in self.TREE[content_id]]}
+
+    def _attachments(self, content_id, **kwargs):
+        return {'results': [{'id': 'att-%s' % a, 'title': a, 'version': {'number': 1},
+                             '_links': {'download': '/download/%s' % a}}
+                            for a in self.attachments.get(content_id, [])]}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.versions = {1: 1, 2: 1, 3: 1}
+        self.attachments = {3: [u'a.txt']}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False,
+                                  journal_path=os.path.join(self.tmp_dir, 'journal.db'))
+        cp._find_page = MagicMock(side_effect=lambda content_id=None, **kwargs: (
+            self._page(content_id) if content_id else None
+        ))
+        cp._client.get_content_children_by_type = MagicMock(side_effect=self._children)
+        cp._client.get_content_labels = MagicMock(return_value={'results': [{'prefix': 'global', 'name': 'x'}]})
+        cp._client.create_new_label_by_content_id = MagicMock()
+        cp._client.get_content_attachments = MagicMock(side_effect=self._attachments)
+        cp._client.download_attachment = MagicMock()
+        cp._client.create_new_attachment_stream_by_content_id = MagicMock()
+        cp._copy_page = MagicMock(side_effect=lambda source, *args: {'id': 'copy-%s' % source['id']})
+        cp.copy(src={'content_id': 1}, dst_space_key=u'other', dst_title_template=u'{title}')
+        return cp
+
+    def test_rerun_skips_unchanged(self):
+        cp = self._run()
+        self.assertEqual(cp._copy_page.call_count, 3)
+        self.assertEqual(cp._client.create_new_label_by_content_id.call_count, 3)
+        self.assertEqual(cp._client.create_new_attachment_stream_by_content_id.call_count, 1)
+
+        self.versions[3] = 2
+        self.attachments[2] = [u'b.txt']
+        cp = self._run()
+        self.assertEqual([c[0][0]['id'] for c in cp._copy_page.call_args_list], [3])
+        self.assertEqual([c[1]['content_id'] for c in cp._find_page.call_args_list if 'content_id' in c[1]], [1, 3])
+        self.assertFalse(cp._client.create_new_label_by_content_id.called)
+        self.assertEqual(cp._client.create_new_attachment_stream_by_content_id.call_count, 1)
+        self.assertEqual(cp._client.create_new_attachment_stream_by_content_id.call_args[1]['content_id'], 'copy-2')
+
+
+class _InPlaceExecutor(object):
+    """
+    Executor running task right in `submit`, so done callbacks are called while next tasks are still being added.
+    """
+
+    def __init__(self, max_workers):
+        pass
+
+    def submit(self, function):
+        future = Future()
+        try:
+            future.set_result(function())
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class TestPlan(unittest.TestCase):
+    TREE = {1: [2, 3], 2: [], 3: [4], 4: []}
+
+    def _find_page(self, content_id=None, space_key=None, title=None, version=None):
+        if content_id in self.TREE:
+            return {
+                'id': content_id, 'type': 'page', 'title': u'Page %s' % content_id, 'space': {'key': u'SRC'},
+                'ancestors': [], 'version': {'number': 1}, 'body': {'storage': {'value': u'body'}},
+                'children': {'page': {'results': [{'id': child, 'title': u'Page %s' % child}
+                                                  for child in self.TREE[content_id]]},
+                             'attachment': {'results': [self.attachment] if content_id == 2 else []}},
+                'metadata': {'labels': {'results': [{'prefix': 'global', 'name': 'x'}] if content_id == 1 else []}},
+            }
+        return self.dst_pages.get(title or content_id)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.plan_path = os.path.join(self.tmp_dir, 'plan.jsonl')
+        self.attachment = {'id': 'att-1', 'title': u'a.txt', 'version': {'number': 1},
+                           'metadata': {'mediaType': u'text/plain'}, 'extensions': {'fileSize': 10},
+                           '_links': {'download': u'/download/a.txt'}}
+        existing = {'id': 'd3', 'title': u'Page 3 (copy)', 'space': {'key': u'DST'}, 'version': {'number': 4}}
+        self.dst_pages = {u'Page 3 (copy)': existing, 'd3': existing}
+
+        self.cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False)
+        self.cp._find_page = MagicMock(side_effect=self._find_page)
+        self.cp._client.get_content_attachments = MagicMock(return_value={'results': []})
+        self.cp._copy_page = MagicMock(side_effect=lambda source, *args: {'id': 'copy-%s' % source['id']})
+        self.cp._overwrite_page = MagicMock(return_value={'id': 'd3'})
+        self.cp._client.create_new_label_by_content_id = MagicMock()
+        self.cp._client.download_attachment = MagicMock(
+            side_effect=lambda download_link, fileobj, chunk_size: fileobj.write(b'0123456789')
+        )
+        self.cp._client.create_new_attachment_stream_by_content_id = MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _plan(self):
+        return self.cp.plan(self.plan_path, src={'content_id': 1}, dst_space_key=u'DST',
+                            dst_title_template=u'{title} (copy)', dst_parent_id=10, overwrite=True)
+
+    def test_plan(self):
+        totals = self._plan()
+
+        with open(self.plan_path) as f:
+            operations = [json.loads(line) for line in f]
+        self.assertEqual([(op['id'], op['op'], op['deps']) for op in operations], [
+            (1, 'create', []), (2, 'labels', [1]), (3, 'create', [1]), (4, 'attachment', [3]), (5, 'update', [1]),
+            (6, 'create', [5]),
+        ])
+        self.assertEqual(operations[0]['ancestor_id'], 10)
+        self.assertEqual(operations[4]['dst_id'], 'd3')
+        self.assertEqual(totals['operations']['create'], 3)
+        self.assertEqual(totals['requests'], 3 * 2 + 1 + 2 + 3)
+        # nothing is changed while planning
+        self.assertFalse(self.cp._copy_page.called)
+        self.assertFalse(self.cp._client.download_attachment.called)
+
+    def test_execute(self):
+        self._plan()
+        self.assertEqual(self.cp.execute_plan(self.plan_path, workers=3), 6)
+
+        ancestors = dict((c[0][0]['id'], c[0][1]) for c in self.cp._copy_page.call_args_list)
+        self.assertEqual(ancestors, {1: 10, 2: 'copy-1', 4: 'd3'})
+        self.assertEqual(self.cp._overwrite_page.call_args[0][1], 'copy-1')
+        self.cp._client.create_new_label_by_content_id.assert_called_once_with(
+            content_id='copy-1', label_names=[{'prefix': 'global', 'name': 'x'}]
+        )
+        self.assertEqual(
+            self.cp._client.create_new_attachment_stream_by_content_id.call_args[1]['content_id'], 'copy-2'
+        )
+
+        # everything is done already
+        self.assertEqual(self.cp.execute_plan(self.plan_path), 0)
+        self.assertEqual(self.cp._copy_page.call_count, 3)
+
+    def test_execute_adopts_existing_copy(self):
+        self._plan()
+        # copy was created by execution interrupted before result of the operation was saved
+        self.dst_pages[u'Page 1 (copy)'] = {'id': 'copy-1', 'title': u'Page 1 (copy)', 'space': {'key': u'DST'},
+                                            'version': {'number': 1}}
+        self.cp._overwrite_page = MagicMock(side_effect=lambda source, ancestor_id, existing, *args: existing)
+        self.assertEqual(self.cp.execute_plan(self.plan_path), 6)
+
+        self.assertEqual([c[0][0]['id'] for c in self.cp._copy_page.call_args_list], [2, 4])
+        self.assertEqual([(c[0][0]['id'], c[0][2]['id']) for c in self.cp._overwrite_page.call_args_list],
+                         [(1, 'copy-1'), (3, 'd3')])
+        self.cp._client.create_new_label_by_content_id.assert_called_once_with(
+            content_id='copy-1', label_names=[{'prefix': 'global', 'name': 'x'}]
+        )
+
+    def test_execute_updates_uploaded_attachment(self):
+        self._plan()
+        # attachment was uploaded by execution interrupted before result of the operation was saved
+        self.dst_pages.update({u'Page 1 (copy)': {'id': 'copy-1'}, u'Page 2 (copy)': {'id': 'copy-2'}})
+        self.cp._client.get_content_attachments = MagicMock(return_value={'results': [{'id': 'att-copy'}]})
+        self.cp._client.update_attachment_stream = MagicMock()
+        self.assertEqual(self.cp.execute_plan(self.plan_path, resume_from=4), 3)
+
+        self.assertEqual(self.cp._client.get_content_attachments.call_args[1]['content_id'], 'copy-2')
+        self.assertEqual(self.cp._client.get_content_attachments.call_args[1]['filename'], u'a.txt')
+        self.assertFalse(self.cp._client.create_new_attachment_stream_by_content_id.called)
+        self.assertEqual(self.cp._client.update_attachment_stream.call_args[1]['attachment_id'], 'att-copy')
+
+    def test_execute_records_journal(self):
+        self.cp._journal = CopyJournal(os.path.join(self.tmp_dir, 'journal.db'))
+        self._plan()
+        self.cp.execute_plan(self.plan_path)
+
+        # everything is copied, so the next plan skips every page without labels and attachments operations
+        next_plan_path = os.path.join(self.tmp_dir, 'next.jsonl')
+        totals = self.cp.plan(next_plan_path, src={'content_id': 1}, dst_space_key=u'DST',
+                              dst_title_template=u'{title} (copy)', dst_parent_id=10, overwrite=True)
+        self.assertEqual(totals['operations'], {'create': 0, 'update': 0, 'skip': 4, 'labels': 0, 'attachment': 0})
+        self.assertEqual(self.cp._journal.get(2, u'DST', u'Page 2 (copy)')['dst_id'], u'copy-2')
+        self.cp._journal.close()
+
+    def test_execute_ready_while_adding(self):
+        self._plan()
+        # every operation is done before the next one is added, so dependents become ready in between
+        with patch('pool.ThreadPoolExecutor', _InPlaceExecutor):
+            self.assertEqual(self.cp.execute_plan(self.plan_path, workers=3), 6)
+
+        self.assertEqual(sorted(c[0][0]['id'] for c in self.cp._copy_page.call_args_list), [1, 2, 4])
+        self.cp._overwrite_page.assert_called_once()
+        self.cp._client.create_new_label_by_content_id.assert_called_once()
+        self.cp._client.create_new_attachment_stream_by_content_id.assert_called_once()
+
+    def test_resume_from(self):
+        self._plan()
+        self.dst_pages[u'Page 1 (copy)'] = {'id': 'copy-1'}
+        self.assertEqual(self.cp.execute_plan(self.plan_path, resume_from=5), 2)
+
+        # copy of the parent made before resumed operation is looked up by title
+        self.assertEqual(self.cp._overwrite_page.call_args[0][1], 'copy-1')
+        self.assertEqual([(c[0][0]['id'], c[0][1]) for c in self.cp._copy_page.call_args_list], [(4, 'd3')])
+
+
+class TestTaskPool(unittest.TestCase):
+
+    def test_dependencies(self):
+        done = list()
+        pool = TaskPool(4)
+        pool.add(lambda: done.append('a'), key='a')
+        pool.add(lambda: done.append('b'), key='b', deps=['a', 'unknown'])
+        pool.add(lambda: pool.add(lambda: done.append('d'), deps=['b']), key='c', deps=['b'])
+        pool.join()
+        self.assertEqual(done, ['a', 'b', 'd'])
+
+    def test_error_stops_dependents(self):
+        done = list()
+        pool = TaskPool(4)
+        pool.add(lambda: 1 / 0, key='a')
+        pool.add(lambda: done.append('b'), key='b', deps=['a'])
+        self.assertRaises(ZeroDivisionError, pool.join)
+        self.assertEqual(done, [])
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tree = {1: [2, 3, 5], 2: [], 3: [4], 4: [], 5: []}
+        self.titles = dict((page_id, u'Page %s' % page_id) for page_id in self.tree)
+        self.versions = dict((page_id, 1) for page_id in self.tree)
+        # id -> copy in destination space
+        self.dst = dict()
+        # copies are the same as source pages, so overwrite doesn't write them
+        self.identical = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _source(self, content_id):
+        return {'id': content_id, 'type': 'page', 'title': self.titles[content_id], 'space': {'key': u'SRC'},
+                'ancestors': [], 'version': {'number': self.versions[content_id]}, 'body': {'storage': {'value': u''}}}
+
+    def _dst_page(self, page):
+        return {'id': page['id'], 'type': 'page', 'title': page['title'], 'space': {'key': u'DST'},
+                'version': {'number': page['version']}, 'body': {'storage': {'value': u''}},
+                'ancestors': [{'id': page['ancestor_id']}] if page['ancestor_id'] else []}
+
+    def _find_page(self, content_id=None, space_key=None, title=None, version=None):
+        if content_id:
+            return self._source(content_id)
+        for page in self.dst.values():
+            if page['title'] == title:
+                return self._dst_page(page)
+        return None
+
+    def _create(self, source, ancestor_id, space_key, title, *args):
+        page_id = u'd%s' % source['id']
+        self.dst[page_id] = {'id': page_id, 'title': title, 'version': 1, 'ancestor_id': ancestor_id}
+        return {'id': page_id, 'version': {'number': 1}}
+
+    def _update(self, content_data, content_id):
+        page = self.dst[content_id]
+        page.update(title=content_data['title'], version=content_data['version']['number'],
+                    ancestor_id=content_data['ancestors'][0]['id'] if content_data['ancestors'] else None)
+        return {'id': content_id, 'version': content_data['version']}
+
+    def _overwrite(self, source, ancestor_id, existing, space_key, title):
+        if self.identical:
+            return existing
+        return self._update({'title': title, 'version': {'number': existing['version']['number'] + 1},
+                             'ancestors': [{'id': ancestor_id}]}, existing['id'])
+
+    def _sync(self, recursion_limit=None):
+        cp = ConfluencePageCopier('user', 'password', 'bah', journal_path=os.path.join(self.tmp_dir, 'journal.db'))
+        cp._find_page = MagicMock(side_effect=self._find_page)
+        cp._client.get_content_by_id = MagicMock(side_effect=lambda content_id, expand: (
+            self._source(content_id) if content_id in self.tree else self._dst_page(self.dst[content_id])
+        ))
+        cp._client.get_content = MagicMock(side_effect=lambda **kwargs: {'results': [
+            self._dst_page(page) for page in self.dst.values()
+        ]})
+        cp._client.get_content_children_by_type = MagicMock(side_effect=lambda content_id, child_type, **kwargs: {
+            'results': [dict(self._source(child), body=None) for child in self.tree[content_id]]
+        })
+        cp._copy_page = MagicMock(side_effect=self._create)
+        cp._overwrite_page = MagicMock(side_effect=self._overwrite)
+        cp._client.update_content_by_id = MagicMock(side_effect=self._update)
+        cp._client.delete_content_by_id = MagicMock(side_effect=lambda content_id: self.dst.pop(content_id))
+        stats = cp.sync(src={'content_id': 1}, dst_space_key=u'DST', dst_title_template=u'{title} (m)',
+                        dst_parent_id=u'100', delete=True, skip_labels=True, skip_attachments=True,
+                        recursion_limit=recursion_limit)
+        cp.close()
+        return cp, stats
+
+    def test_sync(self):
+        cp, stats = self._sync()
+        self.assertEqual(stats, {'created': 5, 'updated': 0, 'moved': 0, 'unchanged': 0, 'deleted': 0})
+        self.assertEqual(self.dst[u'd4'], {'id': u'd4', 'title': u'Page 4 (m)', 'version': 1, 'ancestor_id': u'd3'})
+        self.assertEqual(self.dst[u'd1']['ancestor_id'], u'100')
+
+        self.versions[2] = 2
+        self.tree.update({1: [2, 3], 2: [4], 3: []})
+        self.titles[3] = u'Renamed'
+        cp, stats = self._sync()
+
+        self.assertEqual(stats, {'created': 0, 'updated': 1, 'moved': 2, 'unchanged': 1, 'deleted': 1})
+        # only changed page is fetched with body
+        self.assertEqual([c[1]['content_id'] for c in cp._find_page.call_args_list if c[1].get('content_id')], [2])
+        self.assertEqual(cp._overwrite_page.call_count, 1)
+        self.assertEqual(self.dst[u'd2']['version'], 2)
+        self.assertEqual(self.dst[u'd4']['ancestor_id'], u'd2')
+        self.assertEqual(self.dst[u'd3']['title'], u'Renamed (m)')
+        self.assertNotIn(u'd5', self.dst)
+
+        # nothing to do
+        cp, stats = self._sync()
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 4, 'deleted': 0})
+        self.assertFalse(cp._client.update_content_by_id.called)
+
+    def test_copies_without_journal_entries(self):
+        self._sync()
+        os.remove(os.path.join(self.tmp_dir, 'journal.db'))
+
+        # copies are found by title and compared with the source once
+        self.identical = True
+        cp, stats = self._sync()
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 5, 'deleted': 0})
+        self.assertEqual(cp._overwrite_page.call_count, 5)
+
+        cp, stats = self._sync()
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 5, 'deleted': 0})
+        self.assertFalse(cp._overwrite_page.called)
+
+    def test_invalid_settings(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.assertRaises(ValueError, cp.sync, src={'content_id': 1}, dst_space_key=u'DST')
+
+        cp = ConfluencePageCopier('user', 'password', 'bah', journal_path=os.path.join(self.tmp_dir, 'journal.db'))
+        cp._client.get_content_by_id = MagicMock(side_effect=lambda content_id, expand: self._source(content_id))
+        # copies would be the source pages themselves
+        self.assertRaises(ValueError, cp.sync, src={'content_id': 1})
+        self.assertRaises(ValueError, cp.sync, src={'content_id': 1}, dst_space_key=u'SRC')
+        cp.close()
+
+    def test_recursion_limit(self):
+        self._sync()
+
+        # copies below the limit are not walked, so they are not stale
+        cp, stats = self._sync(recursion_limit=0)
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 1, 'deleted': 0})
+        self.assertEqual(sorted(self.dst), [u'd1', u'd2', u'd3', u'd4', u'd5'])
+
+        self.tree.update({1: [2, 3], 3: []})
+        cp, stats = self._sync(recursion_limit=1)
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'moved': 0, 'unchanged': 3, 'deleted': 1})
+        self.assertEqual(sorted(self.dst), [u'd1', u'd2', u'd3', u'd4'])
+
+
+class TestWholeSpace(unittest.TestCase):
+    TREE = {1: [4, 5], 2: [], 3: [], 4: [], 5: []}
+    TITLES = {1: u'Project', 2: u'Archive', 3: u'Draft notes', 4: u'Draft child', 5: u'Child'}
+
+    def _summary(self, content_id):
+        return {'id': content_id, 'title': self.TITLES[content_id], 'version': {'number': 1},
+                'metadata': {'labels': {'results': [{'prefix': 'global', 'name': 'old'}] if content_id == 2 else []}}}
+
+    def _roots(self, space_key, content_type, depth, expand, start=0, **kwargs):
+        # top-level pages are returned by two per response
+        roots = [1, 2, 3]
+        response = {'results': [self._summary(r) for r in roots[start:start + 2]], 'start': start, 'size': 2,
+                    'limit': 2, '_links': {}}
+        if start + 2 < len(roots):
+            response['_links']['next'] = '/next'
+        return response
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah')
+        self.cp._client.get_space_content_by_type = MagicMock(side_effect=self._roots)
+        self.cp._find_page = MagicMock(side_effect=lambda content_id=None, **kwargs: dict(
+            self._summary(content_id), space={'key': u'SRC'}, ancestors=[], body={'storage': {'value': u''}}
+        ) if content_id else None)
+        self.cp._client.get_content_children_by_type = MagicMock(side_effect=lambda content_id, child_type, **kwargs: {
+            'results': [self._summary(child) for child in self.TREE[content_id]]
+        })
+        self.cp._client.get_content = MagicMock(return_value={'results': []})
+        self.cp._copy_page = MagicMock(side_effect=lambda source, ancestor_id, space_key, title, *args: {
+            'id': 'copy-%s' % source['id'], 'version': {'number': 1}
+        })
+
+    def _copied(self):
+        return [(c[0][0]['id'], c[0][1]) for c in self.cp._copy_page.call_args_list]
+
+    def test_all_trees(self):
+        self.assertEqual(self.cp.copy_space(u'SRC', dst_space_key=u'DST', dst_title_template=u'{title}',
+                                            skip_labels=True, skip_attachments=True), 3)
+        self.assertEqual(self._copied(), [(1, None), (4, 'copy-1'), (5, 'copy-1'), (2, None), (3, None)])
+        # destination space is indexed once for all trees
+        self.assertEqual(self.cp._client.get_content.call_count, 1)
+
+    def test_filter(self):
+        page_filter = PageFilter(exclude_titles=[u'Draft*'], exclude_labels=[u'old'])
+        self.assertEqual(self.cp.copy_space(u'SRC', page_filter=page_filter, dst_space_key=u'DST',
+                                            dst_title_template=u'{title}', skip_labels=True,
+                                            skip_attachments=True), 1)
+        self.assertEqual(self._copied(), [(1, None), (5, 'copy-1')])
+        # filtered out pages are never fetched
+        self.assertEqual(sorted(c[1]['content_id'] for c in self.cp._find_page.call_args_list), [1, 5])
+
+        self.cp._copy_page.reset_mock()
+        self.cp.copy_space(u'SRC', page_filter=PageFilter(include_labels=[u'old'], include_titles=[u'Proj*']),
+                           dst_space_key=u'DST', dst_title_template=u'{title}', recursion_limit=0, skip_labels=True,
+                           skip_attachments=True)
+        self.assertEqual(self._copied(), [(1, None), (2, None)])
+
+    def test_same_space(self):
+        created = list()
+
+        def copy_page(source, ancestor_id, space_key, title, *args):
+            if ancestor_id is None:
+                created.append(dict(self._summary(source['id']), id='copy-%s' % source['id'], title=title))
+            return {'id': 'copy-%s' % source['id'], 'version': {'number': 1}}
+
+        def roots(space_key, content_type, depth, expand, start=0, **kwargs):
+            # one top-level page per response, copies created at the top level are listed as well
+            pages = [self._summary(r) for r in (1, 2, 3)] + created
+            response = {'results': pages[start:start + 1], 'start': start, 'size': 1, 'limit': 1, '_links': {}}
+            if start + 1 < len(pages):
+                response['_links']['next'] = '/next'
+            return response
+
+        self.cp._copy_page = MagicMock(side_effect=copy_page)
+        self.cp._client.get_space_content_by_type = MagicMock(side_effect=roots)
+        self.assertEqual(self.cp.copy_space(u'SRC', dst_title_template=u'{title} (copy)', skip_labels=True,
+                                            skip_attachments=True), 3)
+        self.assertEqual([page['title'] for page in created],
+                         [u'Project (copy)', u'Archive (copy)', u'Draft notes (copy)'])
+
+
+class TestConsolidatedFetch(unittest.TestCase):
+
+    @staticmethod
+    def _collection(results, next_link=False):
+        response = {'results': results, 'start': 0, 'limit': len(results), 'size': len(results), '_links': {}}
+        if next_link:
+            response['_links']['next'] = '/next'
+        return response
+
+    def _page(self, content_id, expand):
+        page = {'id': content_id, 'type': 'page', 'title': u'page %s' % content_id, 'space': {'key': u'src'},
+                'body': {'storage': {'value': u'body'}}, 'version': {'number': 1},
+                'ancestors': [{'id': 100, 'title': u'Src parent'}]}
+        if expand == ConfluencePageCopier.CONSOLIDATED_EXPAND_FIELDS:
+            page['metadata'] = {'labels': self._collection([{'prefix': u'global', 'name': u'l%s' % content_id}])}
+            page['children'] = {
+                'attachment': self._collection([]),
+                'page': self._collection([{'id': 2, 'title': u'page 2'}] if content_id == 1 else [],
+                                         next_link=content_id == 1),
+            }
+        return page
+
+    def setUp(self):
+        self.cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False)
+        self.cp._client.get_content_by_id = MagicMock(side_effect=self._page)
+        self.cp._client.get_content = MagicMock(return_value={'size': 0, 'results': []})
+        self.cp._client.get_content_labels = MagicMock()
+        self.cp._client.get_content_attachments = MagicMock()
+        self.cp._client.get_content_children_by_type = MagicMock(return_value=self._collection([]))
+        self.cp._client.create_new_label_by_content_id = MagicMock()
+        self.cp._client.create_new_content = MagicMock(side_effect=lambda data: {'id': 'copy', 'title': data['title']})
+
+    def test_single_read_per_page(self):
+        with patch.object(self.cp.log, 'info') as log_info:
+            self.cp.copy(src={'content_id': 1}, dst_space_key=u'dst', dst_title_template=u'{title} copy',
+                         dst_parent_title=u'Dst parent', ancestor_id=10)
+
+        self.assertEqual(self.cp._client.get_content_by_id.call_count, 2)
+        self.assertFalse(self.cp._client.get_content_labels.called)
+        self.assertFalse(self.cp._client.get_content_attachments.called)
+        self.assertEqual(self.cp._client.create_new_label_by_content_id.call_count, 2)
+        # expanded children had next page, which is fetched from the regular endpoint
+        self.cp._client.get_content_children_by_type.assert_called_once_with(
+            content_id=1, child_type='page', expand=ConfluencePageCopier.CHILDREN_EXPAND_FIELDS, start=1, limit=1
+        )
+        messages = [c[0][0] for c in log_info.call_args_list if c[0][0].startswith('Copying [')]
+        self.assertEqual(messages, [
+            u"Copying [src]:'Src parent'/'page 1' => [dst]:'Dst parent'/'page 1 copy'",
+            u"Copying [src]:'Src parent'/'page 2' => [dst]:'page 1 copy'/'page 2 copy'",
+        ])
+
+
+class TestPageCache(unittest.TestCase):
+
+    @staticmethod
+    def _page(content_id, body, version=1):
+        return {'id': content_id, 'type': 'page', 'title': u'page %s' % content_id, 'space': {'key': u'src'},
+                'body': {'storage': {'value': body, 'representation': 'storage'}}, 'version': {'number': version},
+                'ancestors': []}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_size_limit(self):
+        cache = PageCache(max_size=10)
+        cache.put(('id', u'1'), self._page(1, u'123456'))
+        self.assertEqual(cache.get(('id', u'1'))[1]['body']['storage']['value'], u'123456')
+        cache.put(('id', u'2'), self._page(2, u'abcdef'))
+        self.assertEqual(cache.get(('id', u'1')), (False, None))
+        self.assertTrue(cache.get(('id', u'2'))[0])
+
+    def test_size_limit_in_bytes(self):
+        cache = PageCache(max_size=10)
+        # 4 characters, but 12 bytes in UTF-8
+        cache.put(('id', u'1'), self._page(1, u'\u20ac' * 4))
+        self.assertEqual(cache.get(('id', u'1')), (False, None))
+        cache.put(('id', u'2'), self._page(2, u'\u20ac' * 3))
+        self.assertTrue(cache.get(('id', u'2'))[0])
+
+    def test_created_page_replaces_not_found(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', index_destination=False)
+        cp._client.get_content = MagicMock(return_value={'size': 0, 'results': []})
+        cp._client.create_new_content = MagicMock(return_value={'id': 50, 'title': u'Copy', 'version': {'number': 1}})
+
+        self.assertIsNone(cp._find_page(space_key=u'dst', title=u'Copy'))
+        cp._copy_page_content(self._page(5, u'body'), u'dst', u'Copy', None, None, None, overwrite=False)
+
+        copy = cp._find_page(space_key=u'dst', title=u'Copy')
+        self.assertEqual((copy['id'], copy['body']['storage']['value']), (50, u'body'))
+        self.assertEqual(cp._client.get_content.call_count, 1)
+
+    def test_persistent_bodies(self):
+        store_path = os.path.join(self.tmp_dir, 'pages.db')
+        cp = ConfluencePageCopier('user', 'password', 'bah', page_store_path=store_path)
+        cp._client.get_content_by_id = MagicMock(return_value=self._page(1, u'stored'))
+        cp._find_page(content_id=1, version=1)
+        cp._cache.close()
+
+        cp = ConfluencePageCopier('user', 'password', 'bah', page_store_path=store_path)
+        page = self._page(1, None)
+        page.pop('body')
+        cp._client.get_content_by_id = MagicMock(return_value=page)
+        self.assertEqual(cp._find_page(content_id=1, version=1)['body']['storage']['value'], u'stored')
+        self.assertNotIn(ConfluencePageCopier.BODY_EXPAND_FIELD, cp._client.get_content_by_id.call_args[1]['expand'])
+
+
+class TestXmlExportSource(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.source = XmlExportSource(EXPORT_PATH)
+
+    def test_page(self):
+        page = self.source.find_page(space_key='ONE', title='Page tree -- one')
+        self.assertEqual(page['id'], '753682')
+        self.assertEqual(page['space'], {'key': 'ONE'})
+        self.assertEqual(page['version'], {'number': 2})
+        self.assertEqual([a['title'] for a in page['ancestors']], ['First space Home'])
+        self.assertTrue(page['body']['storage']['value'])
+        self.assertEqual([c['id'] for c in page['children']['page']['results']], ['753684'])
+        self.assertIsNone(self.source.find_page(title='Missing'))
+
+    def test_space_roots(self):
+        roots = self.source.get_space_content_by_type('ONE', 'page', depth='root')['results']
+        self.assertEqual([(r['id'], r['title']) for r in roots], [('753678', 'First space Home')])
+        self.assertEqual(len(self.source.get_space_content_by_type('ONE', 'page')['results']), 17)
+
+    def test_attachment(self):
+        attachments = self.source.get_content_attachments('753686')['results']
+        self.assertEqual([a['title'] for a in attachments], ['corpus-example.txt'])
+        self.assertEqual(attachments[0]['extensions']['fileSize'], 308)
+
+        content = BytesIO()
+        self.source.download_attachment(attachments[0]['_links']['download'][1:], content, 64)
+        self.assertEqual(len(content.getvalue()), 308)
+
+    def test_copy(self):
+        cp = ConfluencePageCopier('user', 'password', 'bah', source=self.source)
+        cp._client = MagicMock()
+        cp._client.get_content.return_value = {'results': []}
+        cp._client.get_content_attachments.return_value = {'results': []}
+        cp._client.create_new_content.side_effect = lambda data: {'id': data['title'], 'version': {'number': 1}}
+        uploaded = dict()
+        cp._client.create_new_attachment_stream_by_content_id.side_effect = lambda content_id, attachment: (
+            uploaded.__setitem__(attachment.name, len(b''.join(attachment)))
+        )
+
+        cp.copy(src={'space_key': 'ONE', 'title': 'Page tree -- one'}, dst_space_key=u'NEW',
+                dst_title_template=u'{title}')
+
+        created = [c[0][0] for c in cp._client.create_new_content.call_args_list]
+        self.assertEqual(len(created), 3)
+        self.assertEqual(created[0]['ancestors'], [])
+        self.assertEqual(created[1]['ancestors'], [{'id': created[0]['title']}])
+        self.assertEqual(created[2]['ancestors'], [{'id': created[1]['title']}])
+        self.assertGreater(uploaded['corpus-example.txt'], 308)
+        self.assertFalse(cp._client.get_content_by_id.called)
+        self.assertFalse(cp._client.get_content_children_by_type.called)
+
+
+class TestTransport(unittest.TestCase):
+
+    @staticmethod
+    def _response(status, headers=None, text='{"ok": true}'):
+        return MagicMock(status_code=status, ok=status < 400, headers=headers or {}, text=text)
+
+    def setUp(self):
+        self.api = ConfluenceAPIDryRunProxy('user', 'password', 'http://localhost/', max_retries=2)
+        self.api.session = MagicMock()
+        self.api._rate_limiter = MagicMock()
+        sleep = patch('copier.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_retry_get(self):
+        self.api.session.request.side_effect = [
+            self._response(503, {'Retry-After': '3'}), self._response(502), self._response(200)
+        ]
+        self.assertEqual(self.api.get_content_by_id(content_id=1), {'ok': True})
+        self.assertEqual(self.api.session.request.call_count, 3)
+        self.assertGreaterEqual(self.sleep.call_args_list[0][0][0], 3)
+        self.api._rate_limiter.on_pushback.assert_called_once_with(3)
+
+    def test_retries_exhausted(self):
+        responses = [self._response(502) for _ in range(3)]
+        self.api.session.request.side_effect = responses
+        self.api.get_content_by_id(content_id=1)
+        self.assertEqual(self.api.session.request.call_count, 3)
+        self.assertTrue(responses[-1].raise_for_status.called)
+
+    def test_post_retried_only_on_pushback(self):
+        self.api.session.request.side_effect = [self._response(429), self._response(200)]
+        self.api.create_new_content({'type': 'page', 'title': 't', 'space': {'key': 's'}, 'body': {}})
+        self.assertEqual(self.api.session.request.call_count, 2)
+
+        self.api.session.request.reset_mock()
+        self.api.session.request.side_effect = [self._response(502), self._response(200)]
+        self.api.create_new_content({'type': 'page', 'title': 't', 'space': {'key': 's'}, 'body': {}})
+        self.assertEqual(self.api.session.request.call_count, 1)
+
+    def test_stream_is_rewound(self):
+        bodies = list()
+        self.api.session.request.side_effect = lambda method, uri, data=None, **kwargs: (
+            bodies.append(b''.join(data)) or self._response(429 if len(bodies) == 1 else 200)
+        )
+        body = MultipartAttachmentStream('file.txt', BytesIO(b'content'), u'text/plain')
+        self.api.create_new_attachment_stream_by_content_id(content_id=1, attachment=body)
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(bodies[0], bodies[1])
+
+    def test_dry_run(self):
+        api = ConfluenceAPIDryRunProxy('user', 'password', 'http://localhost/', dry_run=True)
+        api.session = MagicMock()
+        api.create_new_content({'type': 'page'})
+        self.assertFalse(api.session.request.called)
+
+    def test_rate_limiter(self):
+        limiter = AdaptiveRateLimiter(rate=8)
+        limiter.on_pushback()
+        self.assertEqual(limiter.rate, 4)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 8)
+
+        limiter = AdaptiveRateLimiter()
+        limiter.on_pushback(retry_after=1)
+        self.assertEqual(limiter.rate, AdaptiveRateLimiter.MIN_RATE)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = CopyMetrics()
+        self.api = ConfluenceAPIDryRunProxy('user', 'password', 'http://localhost/', max_retries=2,
+                                            metrics=self.metrics)
+        self.api.session = MagicMock()
+        self.api._rate_limiter = MagicMock()
+        sleep = patch('copier.time.sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_calls_by_method_and_phase(self):
+        self.api.session.request.side_effect = [
+            MagicMock(status_code=503, ok=False, headers={}, content='', text=''),
+            MagicMock(status_code=200, ok=True, headers={}, content='{"id": 1}', text='{"id": 1}'),
+        ]
+        with self.metrics.phase('find'):
+            self.api.get_content_by_id(content_id=1)
+
+        self.api.session.request.side_effect = None
+        self.api.session.request.return_value = MagicMock(status_code=404, ok=False, headers={}, text='')
+        self.api.session.request.return_value.raise_for_status.side_effect = ValueError('not found')
+        with self.metrics.phase('create'):
+            self.assertRaises(ValueError, self.api.create_new_content,
+                              {'type': 'page', 'title': u'T', 'space': {'key': 's'}, 'body': {}})
+
+        report = self.metrics.report()
+        method = report['methods']['get_content_by_id']
+        self.assertEqual((method['calls'], method['requests'], method['errors']), (1, 2, 0))
+        self.assertEqual(method['bytes_in'], len('{"id": 1}'))
+        self.assertEqual(method['latency_buckets']['+Inf'], 1)
+        self.assertEqual(report['phases']['find']['calls'], 1)
+
+        self.assertEqual(report['methods']['create_new_content']['errors'], 1)
+        self.assertGreater(report['phases']['create']['bytes_out'], 0)
+
+    def test_reports(self):
+        self.api.session.request.return_value = MagicMock(status_code=200, ok=True, headers={}, text='{}')
+        with self.metrics.phase('labels'):
+            self.api.get_content_labels(content_id=1)
+        self.metrics.page_copied()
+
+        json_path = os.path.join(self.tmp_dir, 'metrics.json')
+        self.metrics.write_json(json_path)
+        with open(json_path) as f:
+            report = json.load(f)
+        self.assertEqual(report['pages'], 1)
+        self.assertEqual(report['methods']['get_content_labels']['calls'], 1)
+
+        prometheus_path = os.path.join(self.tmp_dir, 'metrics.prom')
+        self.metrics.write_prometheus(prometheus_path)
+        with open(prometheus_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('confluence_copier_pages_total 1', lines)
+        self.assertIn('confluence_copier_api_phase_calls_total{phase="labels"} 1', lines)
+        self.assertIn('confluence_copier_api_method_duration_seconds_count{method="get_content_labels"} 1', lines)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['metrics.json', 'metrics.prom'])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_copy_of_fake_confluence(self):
+        import benchmark
+        result = benchmark.run(depth=2, fan_out=2, attachment_size=1024, latency=0)
+        self.assertEqual(7, result['pages'])
+        self.assertLess(result['requests_per_page'], 10)
+
+        self.assertEqual([], benchmark.compare(result, dict(result), 0.2))
+        regressed = benchmark.compare(result, dict(result, pages_per_sec=result['pages_per_sec'] * 2), 0.2)
+        self.assertEqual(1, len(regressed))
+        self.assertTrue(regressed[0].startswith('pages_per_sec'))
+
+    def test_overwrite_of_fake_confluence(self):
+        import benchmark
+        result = benchmark.run(depth=1, fan_out=2, attachment_size=1024, latency=0, overwrite=True)
+        self.assertEqual(3, result['pages'])
+        self.assertLess(result['requests_per_page'], 10)
+
+
 if __name__ == '__main__':
     unittest.main()
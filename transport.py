@@ -0,0 +1,95 @@
+# coding=utf-8
+import time
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+def parse_retry_after(value):
+    """
+    Parse value of `Retry-After` header, which could be either number of seconds or HTTP date.
+    :return: number of seconds to wait or `None` if header is missing or malformed.
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket rate limiter, that adapts to the server: every time server pushes back (429/503 responses) the rate
+    is halved, and all requests are paused for `Retry-After` period, if server asked to. After that the rate grows
+    back by about one request per second every second, while requests are successful.
+    """
+    MIN_RATE = 0.5
+
+    def __init__(self, rate=None):
+        """
+        :param rate: maximal number of requests per second. If `None`, requests aren't limited until the first
+                     pushback from server.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self._tokens = 1.0
+        self._updated = time.time()
+        self._paused_until = 0
+        self._window_start = time.time()
+        self._window_count = 0
+        self._observed_rate = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until next request is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate is None:
+                    self._count(now)
+                    return
+                else:
+                    self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._count(now)
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _count(self, now):
+        # measure actual request rate, it's needed to choose initial limit on first pushback
+        if now - self._window_start >= 1:
+            self._observed_rate = self._window_count / (now - self._window_start)
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+
+    def on_success(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            self.rate += 1.0 / max(self.rate, 1.0)
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    def on_pushback(self, retry_after=None):
+        with self._lock:
+            if self.rate is None:
+                self.rate = self._observed_rate or self._window_count or 1.0
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self._tokens = min(self._tokens, 1.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.time() + retry_after)
@@ -0,0 +1,351 @@
+# coding=utf-8
+import shutil
+import logging
+import tempfile
+import threading
+import zipfile
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+__author__ = 'Grigory Chernyshev <systray@yandex.ru>'
+
+
+class _Page(object):
+    __slots__ = ('id', 'title', 'space_id', 'parent_id', 'version', 'position')
+
+    def __init__(self, id, title, space_id, parent_id, version, position):
+        self.id = id
+        self.title = title
+        self.space_id = space_id
+        self.parent_id = parent_id
+        self.version = version
+        self.position = position
+
+
+class _Attachment(object):
+    __slots__ = ('id', 'title', 'page_id', 'version', 'when', 'comment', 'property_ids', 'size', 'media_type')
+
+    def __init__(self, id, title, page_id, version, when, comment, property_ids, size, media_type):
+        self.id = id
+        self.title = title
+        self.page_id = page_id
+        self.version = version
+        self.when = when
+        self.comment = comment
+        self.property_ids = property_ids
+        self.size = size
+        self.media_type = media_type
+
+
+class XmlExportSource(object):
+    """
+    Source of pages, which reads Confluence XML export (zip archive with `entities.xml`) instead of REST API.
+
+    `entities.xml` is parsed as a stream and only compact graph of current pages, attachments and labels is kept
+    in memory, while page bodies are stored in temporary file. Attachments are read directly from the archive.
+    Pages are returned in the same form as REST API returns them with all expansions used by the copier
+    (see `ConfluencePageCopier.CONSOLIDATED_EXPAND_FIELDS`), so no additional requests are needed.
+    """
+    ENTITIES = 'entities.xml'
+    LABEL_PREFIXES = {'global': u'global', 'my': u'my', 'team': u'team'}
+
+    def __init__(self, path):
+        self.log = logging.getLogger('xml-export')
+        self.path = path
+
+        self._spaces = dict()
+        self._pages = dict()
+        self._children = dict()
+        self._attachments = dict()
+        self._labels = dict()
+        self._titles = None
+
+        # page bodies are kept in temp file, only (offset, length) is kept in memory
+        self._bodies = dict()
+        self._bodies_file = tempfile.TemporaryFile()
+        self._bodies_lock = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        self.log.info("Reading export '{}'".format(self.path))
+        label_names = dict()
+        labellings = list()
+        content_properties = dict()
+        attachments = list()
+
+        with zipfile.ZipFile(self.path) as archive:
+            with archive.open(self.ENTITIES) as entities:
+                context = ElementTree.iterparse(entities, events=('start', 'end'))
+                _, root = next(context)
+                for event, elem in context:
+                    if event != 'end' or elem.tag != 'object':
+                        continue
+
+                    cls = elem.get('class')
+                    if cls == 'Page':
+                        self._load_page(elem)
+                    elif cls == 'BodyContent':
+                        self._load_body(elem)
+                    elif cls == 'Space':
+                        props, _, _ = self._parse(elem)
+                        self._spaces[props['id']] = props['key']
+                    elif cls == 'Attachment':
+                        attachment = self._parse_attachment(elem)
+                        if attachment is not None:
+                            attachments.append(attachment)
+                    elif cls == 'ContentProperty':
+                        props, _, _ = self._parse(elem)
+                        if props.get('name') in ('FILESIZE', 'MEDIA_TYPE'):
+                            content_properties[props['id']] = (
+                                props['name'], props.get('stringValue') or props.get('longValue')
+                            )
+                    elif cls == 'Label':
+                        props, _, _ = self._parse(elem)
+                        label_names[props['id']] = (
+                            self.LABEL_PREFIXES.get(props.get('namespace'), u'global'), props['name']
+                        )
+                    elif cls == 'Labelling':
+                        _, refs, _ = self._parse(elem)
+                        if 'label' in refs and 'content' in refs:
+                            labellings.append((refs['content'][1], refs['label'][1]))
+
+                    # free parsed elements, so memory doesn't grow with document size
+                    elem.clear()
+                    root.clear()
+
+        for page in self._pages.values():
+            self._children.setdefault(page.parent_id, list()).append(page.id)
+        for children in self._children.values():
+            children.sort(key=lambda page_id: (
+                self._pages[page_id].position is None,
+                self._pages[page_id].position,
+                self._pages[page_id].title
+            ))
+
+        for attachment in attachments:
+            if attachment.page_id not in self._pages:
+                continue
+            for property_id in attachment.property_ids:
+                name, value = content_properties.get(property_id, (None, None))
+                if name == 'FILESIZE':
+                    attachment.size = int(value)
+                elif name == 'MEDIA_TYPE':
+                    attachment.media_type = value
+            attachment.property_ids = None
+            self._attachments.setdefault(attachment.page_id, list()).append(attachment)
+
+        for page_id, label_id in labellings:
+            if page_id in self._pages and label_id in label_names:
+                self._labels.setdefault(page_id, list()).append(label_names[label_id])
+
+        self.log.info("Found {pages} page(s) and {attachments} attachment(s) in export".format(
+            pages=len(self._pages), attachments=sum(len(a) for a in self._attachments.values())
+        ))
+
+    @staticmethod
+    def _parse(elem):
+        """
+        :return: tuple of simple properties, references to other objects (name -> (class, id)) and
+                 collections (name -> list of ids) of exported object.
+        """
+        props = dict()
+        refs = dict()
+        collections = dict()
+        for child in elem:
+            name = child.get('name')
+            if child.tag == 'id':
+                props['id'] = child.text
+            elif child.tag == 'property':
+                ref = child.find('id')
+                if ref is not None:
+                    refs[name] = (child.get('class'), ref.text)
+                else:
+                    props[name] = child.text
+            elif child.tag == 'collection':
+                collections[name] = [e.find('id').text for e in child if e.find('id') is not None]
+        return props, refs, collections
+
+    @staticmethod
+    def _is_current(props, refs):
+        # historical versions refer to the current one with `originalVersion`
+        return 'originalVersion' not in refs and (props.get('contentStatus') or 'current') == 'current'
+
+    def _load_page(self, elem):
+        props, refs, _ = self._parse(elem)
+        if not self._is_current(props, refs):
+            return
+
+        self._pages[props['id']] = _Page(
+            id=props['id'],
+            title=props.get('title') or u'',
+            space_id=refs['space'][1] if 'space' in refs else None,
+            parent_id=refs['parent'][1] if 'parent' in refs else None,
+            version=int(props.get('version') or 1),
+            position=int(props['position']) if props.get('position') else None
+        )
+
+    def _load_body(self, elem):
+        props, refs, _ = self._parse(elem)
+        content = refs.get('content')
+        if not content or content[0] != 'Page':
+            return
+
+        body = (props.get('body') or u'').encode('utf-8')
+        self._bodies_file.seek(0, 2)
+        self._bodies[content[1]] = (self._bodies_file.tell(), len(body))
+        self._bodies_file.write(body)
+
+    def _parse_attachment(self, elem):
+        props, refs, collections = self._parse(elem)
+        if not self._is_current(props, refs) or 'containerContent' not in refs:
+            return None
+
+        return _Attachment(
+            id=props['id'],
+            title=props.get('title') or u'',
+            page_id=refs['containerContent'][1],
+            version=int(props.get('version') or 1),
+            when=(props.get('lastModificationDate') or u'').replace(u' ', u'T'),
+            comment=props.get('versionComment') or u'',
+            property_ids=collections.get('contentProperties', []),
+            # older exports keep these as attachment's own properties
+            size=int(props['fileSize']) if props.get('fileSize') else None,
+            media_type=props.get('contentType')
+        )
+
+    def _body(self, page_id):
+        if page_id not in self._bodies:
+            return u''
+        offset, length = self._bodies[page_id]
+        with self._bodies_lock:
+            self._bodies_file.seek(offset)
+            return self._bodies_file.read(length).decode('utf-8')
+
+    @staticmethod
+    def _collection(results):
+        return {'results': results, 'start': 0, 'limit': len(results), 'size': len(results), '_links': {}}
+
+    def _summary(self, page):
+        return {
+            'id': page.id,
+            'type': 'page',
+            'title': page.title,
+            'space': {'key': self._spaces.get(page.space_id)},
+            'version': {'number': page.version},
+            'metadata': {'labels': self.get_content_labels(page.id)},
+        }
+
+    def _ancestors(self, page):
+        ancestors = list()
+        while page.parent_id in self._pages:
+            page = self._pages[page.parent_id]
+            ancestors.insert(0, {'id': page.id, 'type': 'page', 'title': page.title})
+        return ancestors
+
+    def find_page(self, content_id=None, space_key=None, title=None):
+        """
+        Find page by id or by title (and optionally space key), same as `ConfluencePageCopier._find_page` does.
+        """
+        if content_id:
+            page = self._pages.get(unicode(content_id))
+        else:
+            if self._titles is None:
+                titles = dict()
+                for p in self._pages.values():
+                    titles.setdefault(p.title, list()).append(p)
+                self._titles = titles
+            if space_key and not isinstance(space_key, unicode):
+                space_key = space_key.decode('utf-8')
+            if title and not isinstance(title, unicode):
+                title = title.decode('utf-8')
+
+            pages = [
+                p for p in self._titles.get(title, []) if not space_key or self._spaces.get(p.space_id) == space_key
+            ]
+            if len(pages) > 1:
+                raise ValueError(
+                    "Unexpected result count: {count}, possibly you have to specify space to search in. "
+                    "Results includes these spaces: {spaces}".format(
+                        count=len(pages), spaces=', '.join(set(self._spaces.get(p.space_id) for p in pages)))
+                )
+            page = pages[0] if pages else None
+
+        if page is None:
+            return None
+
+        space_key = self._spaces.get(page.space_id)
+        return {
+            'id': page.id,
+            'type': 'page',
+            'title': page.title,
+            'space': {'key': space_key},
+            'body': {'storage': {'value': self._body(page.id), 'representation': 'storage'}},
+            'ancestors': self._ancestors(page),
+            'version': {'number': page.version},
+            'metadata': {'labels': self.get_content_labels(page.id)},
+            'children': {
+                'page': self.get_content_children_by_type(page.id, 'page'),
+                'attachment': self.get_content_attachments(page.id),
+            },
+        }
+
+    def get_content_children_by_type(self, content_id, child_type, **kwargs):
+        if child_type != 'page':
+            return self._collection([])
+        return self._collection([
+            self._summary(self._pages[page_id]) for page_id in self._children.get(unicode(content_id), [])
+        ])
+
+    def get_space_content_by_type(self, space_key, content_type, depth=None, **kwargs):
+        """
+        List pages of the space, only top-level ones if `depth` is 'root'. Pages of all spaces of the export are
+        listed if `space_key` is not set.
+        """
+        if content_type != 'page':
+            return self._collection([])
+        pages = [
+            page for page in self._pages.values()
+            if (not space_key or self._spaces.get(page.space_id) == space_key) and
+            (depth != 'root' or page.parent_id not in self._pages)
+        ]
+        pages.sort(key=lambda page: (page.position is None, page.position, page.title))
+        return self._collection([self._summary(page) for page in pages])
+
+    def get_content_labels(self, content_id, **kwargs):
+        return self._collection([
+            {'prefix': prefix, 'name': name} for prefix, name in self._labels.get(unicode(content_id), [])
+        ])
+
+    def get_content_attachments(self, content_id, **kwargs):
+        return self._collection([
+            {
+                'id': attachment.id,
+                'type': 'attachment',
+                'title': attachment.title,
+                'version': {'number': attachment.version, 'when': attachment.when},
+                'metadata': {'mediaType': attachment.media_type, 'comment': attachment.comment},
+                'extensions': {'mediaType': attachment.media_type, 'fileSize': attachment.size},
+                '_links': {'download': u'/attachments/{page}/{id}/{version}'.format(
+                    page=attachment.page_id, id=attachment.id, version=attachment.version
+                )},
+            }
+            for attachment in self._attachments.get(unicode(content_id), [])
+        ])
+
+    def download_attachment(self, download_link, fileobj, chunk_size):
+        """
+        Copy attachment content from the archive into `fileobj` without extracting it to disk.
+        :return: number of copied bytes.
+        """
+        with zipfile.ZipFile(self.path) as archive:
+            with archive.open(download_link) as content:
+                start = fileobj.tell()
+                shutil.copyfileobj(content, fileobj, chunk_size)
+                return fileobj.tell() - start
+
+    def close(self):
+        self._bodies_file.close()